@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ParserConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'parser'
+
+    def ready(self):
+        # Registers the MongoDB connection without connecting (see parser/db.py)
+        from . import db
+
+        db.register()
@@ -0,0 +1,88 @@
+import logging
+import lzma
+import os
+import tarfile
+import zipfile
+import zlib
+
+from django.utils.text import get_valid_filename
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# Streaming archive ingestion
+# =========================
+# ZIP and TAR uploads are read one member at a time and each member is streamed
+# into GridFS, so memory stays at one read buffer per member however large the
+# archive is, and members never touch the local disk. TAR archives (optionally
+# gzip/bzip2/xz compressed) are read strictly sequentially; ZIP needs the central
+# directory at the end of the file, so the upload must be seekable (a GridFS
+# file from GridFSUploadHandler, or Django's temp file).
+
+# Reading a corrupt or truncated archive, or one of its members (a bad CRC shows up on read)
+ARCHIVE_ERRORS = (zipfile.BadZipFile, zipfile.LargeZipFile, tarfile.TarError, EOFError, zlib.error,
+                  lzma.LZMAError, OSError)
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+def is_archive(name):
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def _member_name(path):
+    # Directories inside the archive are dropped; the name only labels the document
+    return get_valid_filename(os.path.basename(path.rstrip('/'))) if path else ''
+
+def _allowed(name, allowed_types):
+    return os.path.splitext(name)[1].lower().lstrip('.') in allowed_types
+
+def _truncated(name, count):
+    logger.warning("Archive member limit reached", extra={'event': 'archive_truncated',
+                   'archive': name, 'members': count})
+
+def _iter_zip(archive, name, allowed_types, max_members):
+    count = 0
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            member_name = _member_name(info.filename)
+            if info.is_dir() or not member_name or not _allowed(member_name, allowed_types):
+                continue
+            if max_members is not None and count >= max_members:
+                _truncated(name, count)
+                return
+            try:
+                stream = zf.open(info)
+            except (RuntimeError, NotImplementedError) as e:
+                # Encrypted, or compressed with a method zipfile can't read
+                logger.warning("Skipping archive member", extra={'event': 'archive_member_skipped',
+                               'archive': name, 'error': str(e)})
+                continue
+            count += 1
+            with stream:
+                yield member_name, stream
+
+def _iter_tar(archive, name, allowed_types, max_members):
+    count = 0
+    # r|* reads the (compressed) tar as a stream without seeking back
+    with tarfile.open(fileobj=archive, mode='r|*') as tf:
+        for member in tf:
+            member_name = _member_name(member.name)
+            if not member.isfile() or not member_name or not _allowed(member_name, allowed_types):
+                continue
+            if max_members is not None and count >= max_members:
+                _truncated(name, count)
+                return
+            count += 1
+            yield member_name, tf.extractfile(member)
+
+def iter_archive_members(archive, allowed_types, max_members=None):
+    # Yields (file name, readable stream) for each regular member of an allowed type. A stream is
+    # only valid until the next member is requested, so it must be consumed first. A corrupt or
+    # truncated archive ends the iteration (members read so far are kept) instead of raising.
+    name = getattr(archive, 'name', '') or ''
+    archive.seek(0)
+    iter_members = _iter_zip if name.lower().endswith('.zip') else _iter_tar
+    try:
+        yield from iter_members(archive, name, allowed_types, max_members)
+    except ARCHIVE_ERRORS as e:
+        logger.warning("Unreadable archive", extra={'event': 'archive_unreadable', 'archive': name,
+                                                    'error': str(e)})
@@ -0,0 +1,24 @@
+import asyncio
+
+# =========================
+# Blocking iterators in async code
+# =========================
+# GridFS reads, base64 encoding and result conversion block. In async code
+# they are pulled one chunk at a time in a worker thread, so the event loop
+# keeps serving other requests while a body streams.
+
+_DONE = object()
+
+async def iterate_in_thread(iterable):
+    iterator = iter(iterable)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, iterator, _DONE)
+            if chunk is _DONE:
+                return
+            yield chunk
+    finally:
+        # Client went away mid-stream: let the generator release its file handles
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await asyncio.to_thread(close)
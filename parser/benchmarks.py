@@ -0,0 +1,118 @@
+import datetime
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+# =========================
+# Shared helpers for the benchmark management commands
+# =========================
+# Everything is seeded so two runs with the same options generate the same
+# documents and the same stub behaviour; reports carry the options and the
+# environment so results can be compared across runs.
+
+def percentile(values, pct):
+    # Nearest-rank percentile, no interpolation
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def latency_summary(values):
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+def environment_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'git_commit': commit,
+    }
+
+class Stopwatch:
+    def __init__(self):
+        self.samples = []
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.samples.append(time.perf_counter() - started)
+        return timed
+
+def synthetic_invoice_pdf(rng, index, pages=1):
+    out = BytesIO()
+    pdf = canvas.Canvas(out, pagesize=letter)
+    for page in range(pages):
+        pdf.setFont('Helvetica-Bold', 18)
+        pdf.drawString(72, 720, f"INVOICE INV-{index:06d}")
+        pdf.setFont('Helvetica', 11)
+        pdf.drawString(72, 695, f"Vendor: Vendor {rng.randint(1, 50)} Ltd.   Date: 2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}")
+        y = 660
+        total = 0.0
+        for line in range(rng.randint(5, 25)):
+            qty, price = rng.randint(1, 10), round(rng.uniform(1, 500), 2)
+            total += qty * price
+            pdf.drawString(72, y, f"Item {line + 1:02d}   qty {qty}   unit {price:.2f}   amount {qty * price:.2f}")
+            y -= 18
+        pdf.drawString(72, y - 18, f"Total: {total:.2f} USD   (page {page + 1}/{pages})")
+        pdf.showPage()
+    pdf.save()
+    return out.getvalue()
+
+def synthetic_receipt_image(rng, index, size=(1240, 1754), image_format='PNG'):
+    image = Image.new('L', size, color=255)
+    draw = ImageDraw.Draw(image)
+    draw.text((60, 60), f"RECEIPT R-{index:06d}", fill=0)
+    y = 120
+    for line in range(rng.randint(5, 30)):
+        draw.text((60, y), f"Item {line + 1:02d} .......... {rng.uniform(1, 99):.2f}", fill=0)
+        y += 28
+    # A little noise so images do not compress to nothing, like real scans
+    for _ in range(size[0] * size[1] // 200):
+        draw.point((rng.randrange(size[0]), rng.randrange(size[1])), fill=rng.randint(120, 220))
+    out = BytesIO()
+    image.save(out, format=image_format)
+    return out.getvalue()
+
+def synthetic_documents(count, seed=0, pdf_ratio=0.5, max_pages=3):
+    # Returns [(file_name, bytes)] for a deterministic mix of invoice PDFs (1 to max_pages pages) and receipt PNGs
+    rng = random.Random(seed)
+    documents = []
+    for index in range(count):
+        if rng.random() < pdf_ratio:
+            documents.append((f'invoice_{index:06d}.pdf', synthetic_invoice_pdf(rng, index, pages=rng.randint(1, max(max_pages, 1)))))
+        else:
+            documents.append((f'receipt_{index:06d}.png', synthetic_receipt_image(rng, index)))
+    return documents
@@ -0,0 +1,143 @@
+import datetime
+import hashlib
+import itertools
+import logging
+
+from mongoengine.errors import NotUniqueError
+
+from .extraction_cache import file_sha256
+from .metrics import BLOB_UPLOADS, BLOB_DEDUPLICATED_BYTES
+from .models import FileBlob
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# Content-addressed document storage
+# =========================
+# Uploads are hashed and stored in GridFS once per distinct content. Every
+# UserDocument holding the content adds a reference to its FileBlob; the GridFS
+# file is deleted when the last reference is released.
+
+# (offset, magic bytes, MIME type); checked in order against the first bytes of a file
+MAGIC_NUMBERS = (
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (8, b'WEBP', 'image/webp'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (257, b'ustar', 'application/x-tar'),
+)
+SNIFF_BYTES = 512
+
+def sniff_mime_type(head, default=None):
+    # MIME type from the content rather than the client's name or Content-Type
+    for offset, magic, mime_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return mime_type
+    return default
+
+def _size_of(file_obj):
+    size = getattr(file_obj, 'size', None)  # Django UploadedFile
+    if isinstance(size, int):
+        return size
+    file_obj.seek(0, 2)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    return size
+
+def store_blob(file_obj, filename=None, content_type=None, file_hash=None):
+    # Returns the FileBlob for the content of file_obj with one more reference,
+    # writing to GridFS only when the content is new
+    if file_hash is None:
+        file_hash = file_sha256(file_obj)
+    now = datetime.datetime.utcnow()
+    blob = FileBlob.objects(sha256=file_hash).modify(inc__ref_count=1, set__last_referenced_at=now, new=True)
+    if blob is not None:
+        BLOB_UPLOADS.inc(result='deduplicated')
+        BLOB_DEDUPLICATED_BYTES.inc(blob.size)
+        return blob
+
+    blob = FileBlob(sha256=file_hash, size=_size_of(file_obj), ref_count=1, created_at=now, last_referenced_at=now)
+    file_obj.seek(0)
+    content_type = sniff_mime_type(file_obj.read(SNIFF_BYTES), content_type)
+    file_obj.seek(0)
+    blob.file.put(file_obj, filename=filename, content_type=content_type, sha256=file_hash)
+    try:
+        blob.save(force_insert=True)
+    except NotUniqueError:
+        # The same content was stored concurrently; drop our copy and reference theirs
+        blob.file.delete()
+        return store_blob(file_obj, filename, content_type, file_hash)
+    BLOB_UPLOADS.inc(result='stored')
+    return blob
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+class BlobTooLarge(ValueError):
+    pass
+
+def store_blob_stream(stream, filename=None, content_type=None, max_size=None):
+    # Like store_blob for streams that can only be read once (archive members): the bytes
+    # go to a new GridFS file while they are hashed, and the file is dropped afterwards
+    # when the content turns out to be stored already
+    proxy = FileBlob().file
+    head = stream.read(SNIFF_BYTES)
+    proxy.new_file(filename=filename, content_type=sniff_mime_type(head, content_type))
+    h = hashlib.sha256()
+    size = 0
+    try:
+        chunks = iter(lambda: stream.read(STREAM_CHUNK_SIZE), b'')
+        for chunk in itertools.chain([head] if head else [], chunks):
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise BlobTooLarge(f"{filename} is larger than {max_size} bytes")
+            h.update(chunk)
+            proxy.write(chunk)
+    except BaseException:
+        proxy.close()
+        proxy.delete()  # partial write
+        raise
+    proxy.newfile.sha256 = h.hexdigest()
+    proxy.close()
+    blob, adopted = adopt_blob(h.hexdigest(), proxy, size)
+    if adopted:
+        BLOB_UPLOADS.inc(result='stored')
+    else:
+        proxy.delete()
+        BLOB_UPLOADS.inc(result='deduplicated')
+        BLOB_DEDUPLICATED_BYTES.inc(size)
+    return blob
+
+def adopt_blob(file_hash, grid_file, size):
+    # For documents stored before blobs: references the existing blob for the content,
+    # or turns the document's own GridFS file into the blob. Returns the blob and
+    # whether grid_file was adopted (otherwise the caller's copy is now redundant).
+    now = datetime.datetime.utcnow()
+    blob = FileBlob.objects(sha256=file_hash).modify(inc__ref_count=1, set__last_referenced_at=now, new=True)
+    if blob is not None:
+        return blob, False
+    blob = FileBlob(sha256=file_hash, size=size, ref_count=1, created_at=now, last_referenced_at=now)
+    blob.file = grid_file
+    try:
+        blob.save(force_insert=True)
+    except NotUniqueError:
+        return adopt_blob(file_hash, grid_file, size)
+    return blob, True
+
+def release_blob(file_hash):
+    blob = FileBlob.objects(sha256=file_hash).modify(dec__ref_count=1, new=True)
+    if blob is None or blob.ref_count > 0:
+        return
+    # Only delete if nothing re-referenced the blob in the meantime
+    if FileBlob.objects(sha256=file_hash, ref_count__lte=0).delete():
+        blob.file.delete()
+        logger.info("Deleted unreferenced blob", extra={'event': 'blob_deleted', 'file_hash': file_hash,
+                                                        'bytes': blob.size})
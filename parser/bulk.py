@@ -0,0 +1,160 @@
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+# =========================
+# Offline bulk extraction
+# =========================
+# Used by `manage.py bulk_extract` for archive backfills that can't go through
+# the upload form. Files are sent to extract_data_from_file by a worker pool and
+# every result is appended to the output as soon as it arrives, followed by a
+# manifest line. A re-run skips files the manifest lists as done (same path,
+# size and mtime), so an interrupted backfill continues where it stopped. A crash
+# between the two writes can repeat one row, never lose one. As with batch
+# checkpoints, empty rows are not written or marked done (a failed extraction
+# also comes back empty): the next run retries them.
+
+def iter_input_files(patterns, allowed_types, recursive=False):
+    # Directories are listed (recursively with `recursive`), anything else is a glob
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            if recursive:
+                candidates = (os.path.join(root, name) for root, _, names in os.walk(pattern) for name in names)
+            else:
+                candidates = (entry.path for entry in os.scandir(pattern) if entry.is_file())
+        else:
+            candidates = glob.iglob(pattern, recursive=recursive)
+        for path in sorted(candidates):
+            path = os.path.abspath(path)
+            extension = os.path.splitext(path)[1].lower().lstrip('.')
+            if extension in allowed_types and os.path.isfile(path) and path not in seen:
+                seen.add(path)
+                yield path
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def load_manifest(path):
+    # {file path: (size, mtime_ns)} of the files already extracted
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # last line cut short by a crash
+            if entry.get('status') == 'done':
+                done[entry['path']] = (entry['size'], entry['mtime_ns'])
+            else:
+                done.pop(entry.get('path'), None)
+    return done
+
+def is_done(manifest, path):
+    return manifest.get(path) == _fingerprint(path)
+
+class NdjsonOutput:
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, source, row):
+        self.file.write(json.dumps({'source_file': source, **row}, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class CsvOutput:
+    # Columns can't be added to a CSV that is already being appended to: they are fixed by
+    # the existing header, or by the custom fields and the first row. Keys outside them go
+    # to the `extra` column as JSON.
+    def __init__(self, path, fields=()):
+        from .views import flatten_record
+
+        self._flatten = flatten_record
+        self.headers = None
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, newline='', encoding='utf-8') as f:
+                self.headers = next(csv.reader(f), None)
+        self.fields = list(fields)
+        self.file = open(path, 'a', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+
+    def write(self, source, row):
+        flat = self._flatten(row)
+        if self.headers is None:
+            columns = self.fields + [key for key in flat if key not in self.fields]
+            self.headers = ['source_file', *columns, 'extra']
+            self.writer.writerow(self.headers)
+        extra = {key: value for key, value in flat.items() if key not in self.headers}
+        values = {**flat, 'source_file': source, 'extra': json.dumps(extra, ensure_ascii=False) if extra else ''}
+        self.writer.writerow([values.get(header, '') for header in self.headers])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def _init_process(quota_share):
+    # Runs in each spawned worker process: set Django up and take a share of the API quota
+    import django
+
+    django.setup()
+    from . import gemini_parser
+
+    gemini_parser._scheduler = gemini_parser.build_scheduler(quota_share)
+
+def extract_file(path, prompt, use_cache=True):
+    # One file; never raises, so one bad scan doesn't stop the backfill
+    from .gemini_parser import extract_data_from_file
+
+    started = time.perf_counter()
+    try:
+        row = json.loads(extract_data_from_file(path, prompt=prompt, use_cache=use_cache))
+        status, error = ('done' if row else 'empty'), None
+    except Exception as e:
+        row, status, error = None, 'failed', f'{type(e).__name__}: {e}'
+    return {'path': path, 'status': status, 'row': row, 'error': error, 'seconds': time.perf_counter() - started}
+
+def create_executor(kind, workers):
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    # spawn: forked children would share the parent's MongoDB and HTTP connections
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_process, initargs=(1.0 / workers,))
+
+def run_bulk_extraction(paths, prompt, output, manifest_path, executor='process', workers=4, use_cache=True,
+                        on_result=None):
+    # Extracts `paths` (already filtered by the manifest) with at most 2 * workers files queued,
+    # so a 50k-file backfill doesn't hold 50k futures. on_result(result) runs in this process.
+    paths = iter(paths)
+    with create_executor(executor, workers) as pool, open(manifest_path, 'a', encoding='utf-8') as manifest:
+        in_flight = set()
+        while True:
+            for path in paths:
+                in_flight.add(pool.submit(extract_file, path, prompt, use_cache))
+                if len(in_flight) >= workers * 2:
+                    break
+            if not in_flight:
+                return
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                path = result['path']
+                if result['status'] == 'done':
+                    row = result['row'] if isinstance(result['row'], dict) else {'value': result['row']}
+                    output.write(path, row)
+                size, mtime_ns = _fingerprint(path)
+                manifest.write(json.dumps({
+                    'path': path, 'size': size, 'mtime_ns': mtime_ns, 'status': result['status'],
+                    'error': result['error'], 'seconds': round(result['seconds'], 3),
+                }) + '\n')
+                manifest.flush()
+                if on_result:
+                    on_result(result)
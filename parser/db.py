@@ -0,0 +1,41 @@
+import os
+
+from django.conf import settings
+from mongoengine import connection
+from mongoengine.base.common import _document_registry
+
+# =========================
+# MongoDB connection
+# =========================
+# The connection is registered when the app loads (ParserConfig.ready) but the
+# MongoClient is only created by the first query, so management commands and
+# pages that never read the database don't pay for it. A client must not cross
+# a fork either (gunicorn --preload, multiprocessing with fork): pymongo's
+# sockets and monitor threads belong to the parent. After a fork the child
+# forgets the inherited client and opens its own on first use.
+
+_registered = False
+
+def register():
+    global _registered
+    if _registered:
+        return
+    # The database named in MONGO_URI wins over MONGO_DB
+    connection.register_connection(connection.DEFAULT_CONNECTION_NAME, db=settings.MONGO_DB,
+                                   host=settings.MONGO_URI, connect=False)
+    _registered = True
+
+def reset_after_fork():
+    # Drop the parent's client and every collection handle documents cached from it
+    connection._connections.clear()
+    connection._dbs.clear()
+    for document in _document_registry.values():
+        if getattr(document, '_collection', None) is not None:
+            document._collection = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+def ping():
+    # Round trip to the server; creates the client on first use
+    return connection.get_db().command('ping')
@@ -0,0 +1,186 @@
+import atexit
+import datetime
+import hashlib
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from .metrics import CACHE_LOOKUPS
+from .models import ExtractionCacheEntry, ExtractionCacheStats
+
+STATS_NAME = 'gemini'
+
+HASH_CHUNK_SIZE = 256 * 1024
+
+def file_sha256(data):
+    # Accepts bytes or a seekable file-like object, which is hashed in chunks
+    h = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray)):
+        h.update(data)
+        return h.hexdigest()
+    data.seek(0)
+    for chunk in iter(lambda: data.read(HASH_CHUNK_SIZE), b''):
+        h.update(chunk)
+    data.seek(0)
+    return h.hexdigest()
+
+def cache_key(file_hash, prompt, endpoint):
+    h = hashlib.sha256()
+    for part in (file_hash, prompt or '', endpoint or ''):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+# Hits, misses and stores are counted in memory and written together every
+# STATS_FLUSH_INTERVAL seconds (and with each store), so a cache hit costs no
+# stats write. The byte total is kept with $inc on store and eviction; entries
+# dropped by the TTL monitor are not subtracted, so each process recomputes it
+# every BYTES_RESYNC_INTERVAL seconds.
+STATS_FLUSH_INTERVAL = 10.0
+BYTES_RESYNC_INTERVAL = 3600.0
+
+_pending = Counter()
+_pending_lock = threading.Lock()
+_flushed_at = time.monotonic()
+_resynced_at = None
+
+def _take_pending(**counters):
+    global _flushed_at
+    with _pending_lock:
+        _pending.update(counters)
+        taken = {name: value for name, value in _pending.items() if value}
+        _pending.clear()
+        _flushed_at = time.monotonic()
+    return taken
+
+def _write_stats(counters):
+    # Applies the counters and returns the updated stats
+    inc = {f'inc__{name}': value for name, value in counters.items()}
+    if not inc:
+        return ExtractionCacheStats.objects(name=STATS_NAME).first()
+    return ExtractionCacheStats.objects(name=STATS_NAME).modify(upsert=True, new=True, **inc)
+
+def _record(**counters):
+    with _pending_lock:
+        _pending.update(counters)
+        due = time.monotonic() - _flushed_at >= STATS_FLUSH_INTERVAL
+    if due:
+        flush_stats()
+
+def flush_stats():
+    counters = _take_pending()
+    if counters:
+        _write_stats(counters)
+
+def _reset_after_fork():
+    # The parent's unwritten counts are the parent's to write
+    global _pending, _pending_lock, _resynced_at
+    _pending, _pending_lock, _resynced_at = Counter(), threading.Lock(), None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(flush_stats)
+
+def _total_bytes():
+    totals = list(ExtractionCacheEntry.objects.aggregate([{'$group': {'_id': None, 'size': {'$sum': '$size'}}}]))
+    return totals[0]['size'] if totals else 0
+
+def _resync_bytes(stats):
+    global _resynced_at
+    now = time.monotonic()
+    if _resynced_at is not None and now - _resynced_at < BYTES_RESYNC_INTERVAL:
+        return stats
+    _resynced_at = now
+    return ExtractionCacheStats.objects(name=STATS_NAME).modify(upsert=True, new=True, set__bytes=_total_bytes())
+
+def get_cached_result(file_hash, prompt, endpoint):
+    if not settings.GEMINI_CACHE_ENABLED:
+        return None
+    now = datetime.datetime.utcnow()
+    # The TTL monitor only runs once a minute, so filter out expired entries ourselves
+    entry = ExtractionCacheEntry.objects(
+        key=cache_key(file_hash, prompt, endpoint),
+    ).filter(__raw__={'$or': [{'expires_at': None}, {'expires_at': {'$gt': now}}]}).modify(
+        inc__hits=1,
+        set__last_used_at=now,
+        new=True,
+    )
+    if entry is None:
+        CACHE_LOOKUPS.inc(result='miss')
+        _record(misses=1)
+        return None
+    CACHE_LOOKUPS.inc(result='hit')
+    _record(hits=1)
+    return entry.result
+
+def store_result(file_hash, prompt, endpoint, result):
+    if not settings.GEMINI_CACHE_ENABLED:
+        return
+    now = datetime.datetime.utcnow()
+    ttl = settings.GEMINI_CACHE_TTL
+    expires_at = now + datetime.timedelta(seconds=ttl) if ttl > 0 else None
+    size = len(result.encode('utf-8'))
+    previous = ExtractionCacheEntry.objects(key=cache_key(file_hash, prompt, endpoint)).modify(
+        upsert=True,
+        new=False,
+        set__file_hash=file_hash,
+        set__prompt=prompt,
+        set__endpoint=endpoint,
+        set__result=result,
+        set__size=size,
+        set__created_at=now,
+        set__last_used_at=now,
+        set__expires_at=expires_at,
+    )
+    # The pending lookup counts go out with this write
+    stats = _write_stats(_take_pending(stores=1, bytes=size - (previous.size if previous else 0)))
+    evict_overflow(_resync_bytes(stats).bytes)
+
+def _total_bytes():
+    totals = list(ExtractionCacheEntry.objects.aggregate([{'$group': {'_id': None, 'size': {'$sum': '$size'}}}]))
+    return totals[0]['size'] if totals else 0
+
+def evict_overflow(total_bytes=None):
+    # Least recently used entries go until the cache is within GEMINI_CACHE_MAX_ENTRIES entries
+    # and GEMINI_CACHE_MAX_BYTES bytes of results (0 disables either limit). total_bytes: the
+    # running total when the caller has just read it.
+    max_entries = settings.GEMINI_CACHE_MAX_ENTRIES
+    max_bytes = settings.GEMINI_CACHE_MAX_BYTES
+    excess_entries = excess_bytes = 0
+    if max_entries > 0:
+        excess_entries = ExtractionCacheEntry._get_collection().estimated_document_count() - max_entries
+    if max_bytes > 0:
+        if total_bytes is None:
+            stats = ExtractionCacheStats.objects(name=STATS_NAME).first()
+            total_bytes = stats.bytes if stats else 0
+        excess_bytes = total_bytes - max_bytes
+    if excess_entries <= 0 and excess_bytes <= 0:
+        return 0
+    evicted = freed = 0
+    for entry in ExtractionCacheEntry.objects.order_by('last_used_at').only('id', 'size'):
+        if excess_entries <= 0 and excess_bytes <= 0:
+            break
+        # One by one, so an entry another worker evicted first is not subtracted twice
+        if ExtractionCacheEntry.objects(id=entry.id).delete():
+            evicted += 1
+            freed += entry.size
+        excess_entries -= 1
+        excess_bytes -= entry.size
+    if evicted:
+        _write_stats({'evictions': evicted, 'bytes': -freed})
+    return evicted
+
+def cache_stats():
+    flush_stats()
+    stats = ExtractionCacheStats.objects(name=STATS_NAME).first()
+    return {
+        'hits': stats.hits if stats else 0,
+        'misses': stats.misses if stats else 0,
+        'stores': stats.stores if stats else 0,
+        'evictions': stats.evictions if stats else 0,
+        'entries': ExtractionCacheEntry._get_collection().estimated_document_count(),
+        'bytes': stats.bytes if stats else 0,
+    }
@@ -1,91 +1,827 @@
 import os
+import asyncio
 import base64
+import random
+import weakref
 import requests
-from decouple import config
+from decouple import config, Csv
 import mimetypes
 import re
+import json
+import threading
+import time
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from parser.async_utils import iterate_in_thread
+from parser.extraction_cache import file_sha256, get_cached_result, store_result
+from parser.preprocessing import preprocess_image
+from parser.splitting import SplitError, count_pdf_pages, merge_results, parse_merge_rules, split_document
+from parser.rate_limit import AdaptiveConcurrency, TokenBucket
+from parser.metrics import (STAGE_SECONDS, PAYLOAD_BYTES, GEMINI_TOKENS, GEMINI_RESPONSES,
+                            EXTRACTION_ERRORS, PREPROCESS_SAVED_BYTES, GEMINI_THROTTLED,
+                            GEMINI_SCHEDULER_WAIT_SECONDS, GEMINI_CONCURRENCY_LIMIT)
 
-GEMINI_API_KEY = config("GEMINI_API_KEY")
-GEMINI_ENDPOINT = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+logger = logging.getLogger(__name__)
 
-def extract_data_from_file(file_or_path, prompt=None):
-    print(f"[Gemini] Fetching file: {file_or_path}")
+# Longest model text included in debug logs
+LOG_TEXT_LIMIT = 500
 
-    # Determine if file_or_path is a file-like object or a path
-    if hasattr(file_or_path, 'read'):
-        # It's a file-like object (GridFSProxy)
-        file_obj = file_or_path
-        file_name = getattr(file_obj, 'name', None)
-        if not file_name:
-            file_name = 'file'  # fallback to a generic name
-        mime_type, _ = mimetypes.guess_type(str(file_name))
-        if not mime_type:
-            mime_type = "application/octet-stream"
-        file_obj.seek(0)
-        file_content = base64.b64encode(file_obj.read()).decode("utf-8")
-    else:
-        # It's a file path
-        file_name = file_or_path
-        mime_type, _ = mimetypes.guess_type(str(file_name))
-        if not mime_type:
-            mime_type = "application/octet-stream"
-        with open(file_name, "rb") as f:
-            file_content = base64.b64encode(f.read()).decode("utf-8")
+GEMINI_API_KEY = config("GEMINI_API_KEY", default="")
+# Comma-separated keys (e.g. from several projects) rotated by the scheduler; defaults to GEMINI_API_KEY
+GEMINI_API_KEYS = config("GEMINI_API_KEYS", default="", cast=Csv())
+GEMINI_ENDPOINT = config("GEMINI_ENDPOINT", default="https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent")
+
+# HTTP client settings
+GEMINI_CONNECT_TIMEOUT = config("GEMINI_CONNECT_TIMEOUT", default=5.0, cast=float)
+GEMINI_READ_TIMEOUT = config("GEMINI_READ_TIMEOUT", default=120.0, cast=float)
+GEMINI_POOL_SIZE = config("GEMINI_POOL_SIZE", default=10, cast=int)
+GEMINI_MAX_RETRIES = config("GEMINI_MAX_RETRIES", default=3, cast=int)
+GEMINI_BACKOFF_FACTOR = config("GEMINI_BACKOFF_FACTOR", default=0.5, cast=float)
+GEMINI_BACKOFF_MAX = config("GEMINI_BACKOFF_MAX", default=30.0, cast=float)
+# 429 is not retried by the HTTP client: the scheduler below handles it (another key, fewer requests in flight)
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+# Connection cap of the asyncio client (one pool per event loop)
+GEMINI_ASYNC_MAX_CONNECTIONS = config("GEMINI_ASYNC_MAX_CONNECTIONS", default=100, cast=int)
+
+# Client-side quota scheduling, per API key (see parser/rate_limit.py). 0 disables a limit.
+GEMINI_REQUESTS_PER_MINUTE = config("GEMINI_REQUESTS_PER_MINUTE", default=0, cast=int)
+GEMINI_TOKENS_PER_MINUTE = config("GEMINI_TOKENS_PER_MINUTE", default=0, cast=int)
+GEMINI_QUOTA_HEADROOM = config("GEMINI_QUOTA_HEADROOM", default=0.95, cast=float)
+GEMINI_INITIAL_CONCURRENCY = config("GEMINI_INITIAL_CONCURRENCY", default=10, cast=int)
+GEMINI_MIN_CONCURRENCY = config("GEMINI_MIN_CONCURRENCY", default=1, cast=int)
+GEMINI_MAX_CONCURRENCY = config("GEMINI_MAX_CONCURRENCY", default=100, cast=int)
+# 429 responses tolerated per request before giving up with GeminiRateLimitError
+GEMINI_THROTTLE_RETRIES = config("GEMINI_THROTTLE_RETRIES", default=8, cast=int)
+
+# Optional image pre-processing before upload (see parser/preprocessing.py)
+GEMINI_PREPROCESS_IMAGES = config("GEMINI_PREPROCESS_IMAGES", default=False, cast=bool)
+GEMINI_IMAGE_MAX_DIMENSION = config("GEMINI_IMAGE_MAX_DIMENSION", default=2048, cast=int)
+GEMINI_IMAGE_FORMAT = config("GEMINI_IMAGE_FORMAT", default="JPEG")  # JPEG, WEBP or PNG
+GEMINI_IMAGE_QUALITY = config("GEMINI_IMAGE_QUALITY", default=85, cast=int)
+GEMINI_IMAGE_GRAYSCALE = config("GEMINI_IMAGE_GRAYSCALE", default=False, cast=bool)
+
+# Optional page-level splitting of long PDFs (needs pypdf) and multi-frame TIFFs (see parser/splitting.py)
+GEMINI_SPLIT_DOCUMENTS = config("GEMINI_SPLIT_DOCUMENTS", default=False, cast=bool)
+GEMINI_SPLIT_MIN_PAGES = config("GEMINI_SPLIT_MIN_PAGES", default=8, cast=int)  # shorter documents are sent whole
+GEMINI_SPLIT_PAGES_PER_CHUNK = config("GEMINI_SPLIT_PAGES_PER_CHUNK", default=4, cast=int)
+GEMINI_SPLIT_CONCURRENCY = config("GEMINI_SPLIT_CONCURRENCY", default=4, cast=int)  # chunks of one document in flight
+# How chunk results are combined, e.g. "line_items:concat,total:last,pages:sum" (rules: first, last, concat,
+# sum, merge). Unlisted fields: objects merged, lists concatenated, first non-empty scalar.
+GEMINI_SPLIT_MERGE_RULES = parse_merge_rules(config("GEMINI_SPLIT_MERGE_RULES", default=""))
+
+_session = None
+_session_lock = threading.Lock()
+
+class _Retry(Retry):
+    # urllib3 retries any 429 carrying Retry-After, whatever status_forcelist says
+    RETRY_AFTER_STATUS_CODES = frozenset({503})
+
+def build_session():
+    # Exponential backoff with jitter on 5xx; a Retry-After header from the API takes precedence
+    retry = _Retry(
+        total=GEMINI_MAX_RETRIES,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset({"POST"}),
+        backoff_factor=GEMINI_BACKOFF_FACTOR,
+        backoff_max=GEMINI_BACKOFF_MAX,
+        backoff_jitter=GEMINI_BACKOFF_FACTOR,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GEMINI_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session():
+    # One keep-alive connection pool shared by every thread of the process
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+# httpx clients are bound to the event loop that created them
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    import httpx  # only the async path needs it; keeps it out of startup
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(GEMINI_READ_TIMEOUT, connect=GEMINI_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=GEMINI_ASYNC_MAX_CONNECTIONS,
+                                max_keepalive_connections=GEMINI_ASYNC_MAX_CONNECTIONS),
+        )
+    return client
+
+async def close_async_client():
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+def _is_json(text):
+    try:
+        json.loads(text)
+        return True
+    except ValueError:
+        return False
+
+# Read size for streaming files into the request body; a multiple of 3 so the
+# base64 of consecutive chunks can be concatenated without padding in between
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+
+SUPPORTED_MIME_TYPES = [
+    "application/pdf",
+    "image/png",
+    "image/jpeg",
+    "image/gif",
+    "image/bmp",
+    "image/tiff",
+    "image/webp"
+]
+
+def _file_size(file_obj):
+    length = getattr(file_obj, 'length', None)  # GridFS files know their size
+    if isinstance(length, int):
+        return length
+    try:
+        return os.fstat(file_obj.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        pass
+    try:
+        # In-memory files (BytesIO, pre-processed images)
+        position = file_obj.tell()
+        size = file_obj.seek(0, 2)
+        file_obj.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def _iter_base64(file_obj, timings):
+    file_obj.seek(0)
+    pending = b''
+    while True:
+        started = time.perf_counter()
+        chunk = file_obj.read(ENCODE_CHUNK_SIZE)
+        timings['gridfs_read'] += time.perf_counter() - started
+        if not chunk:
+            break
+        started = time.perf_counter()
+        pending += chunk
+        cut = len(pending) - len(pending) % 3
+        if cut:
+            encoded = base64.b64encode(pending[:cut])
+            pending = pending[cut:]
+            timings['encode'] += time.perf_counter() - started
+            yield encoded
+    if pending:
+        yield base64.b64encode(pending)
+
+# generateContent JSON body that base64-encodes inline files chunk by chunk.
+# `parts` holds text strings and (file_obj, size, mime_type) tuples. It can be
+# iterated more than once (each pass rewinds the files), so urllib3 can replay
+# it when a request is retried.
+class StreamingPayload:
+    def __init__(self, parts):
+        self.parts = parts
+        self.timings = {'gridfs_read': 0.0, 'encode': 0.0}  # of the last pass
+
+    def __bool__(self):
+        # requests replaces falsy bodies with {}; an unknown length must not empty the payload
+        return True
+
+    def __len__(self):
+        # 0 makes requests fall back to chunked transfer encoding
+        total = 0
+        for prefix, part, suffix in self._segments():
+            if not isinstance(part, tuple):
+                total += len(prefix) + len(suffix)
+            elif part[1] is None:
+                return 0
+            else:
+                total += len(prefix) + 4 * ((part[1] + 2) // 3) + len(suffix)
+        return total + len(b'{"contents":[{"parts":[') + len(b']}]}')
+
+    def _segments(self):
+        for index, part in enumerate(self.parts):
+            separator = ',' if index else ''
+            if isinstance(part, tuple):
+                prefix = f'{separator}{{"inline_data":{{"mime_type":{json.dumps(part[2])},"data":"'
+                yield prefix.encode('utf-8'), part, b'"}}'
+            else:
+                yield f'{separator}{{"text":{json.dumps(part)}}}'.encode('utf-8'), part, b''
+
+    def __iter__(self):
+        self.timings = {'gridfs_read': 0.0, 'encode': 0.0}
+        yield b'{"contents":[{"parts":['
+        for prefix, part, suffix in self._segments():
+            yield prefix
+            if isinstance(part, tuple):
+                yield from _iter_base64(part[0], self.timings)
+            yield suffix
+        yield b']}]}'
+
+def post_payload(payload, api_key=None):
+    return get_session().post(
+        f"{GEMINI_ENDPOINT}?key={api_key or GEMINI_API_KEY}",
+        data=payload,
+        headers={"Content-Type": "application/json"},
+        timeout=(GEMINI_CONNECT_TIMEOUT, GEMINI_READ_TIMEOUT)
+    )
+
+def _retry_delay(attempt, retry_after=None):
+    # Same policy as the urllib3 Retry of the sync session: Retry-After wins, else exponential backoff with jitter
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), GEMINI_BACKOFF_MAX)
+        except ValueError:
+            pass
+    delay = GEMINI_BACKOFF_FACTOR * 2 ** attempt + random.uniform(0, GEMINI_BACKOFF_FACTOR)
+    return min(delay, GEMINI_BACKOFF_MAX)
+
+async def apost_payload(payload, api_key=None):
+    import httpx
+
+    headers = {"Content-Type": "application/json"}
+    length = len(payload)
+    if length:
+        headers["Content-Length"] = str(length)
+    client = get_async_client()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            # A fresh pass over the payload per attempt; file reads and encoding run in a thread
+            response = await client.post(f"{GEMINI_ENDPOINT}?key={api_key or GEMINI_API_KEY}",
+                                         content=iterate_in_thread(payload), headers=headers)
+        except httpx.TransportError:
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        if response.status_code not in RETRY_STATUS_CODES or attempt == GEMINI_MAX_RETRIES:
+            return response
+        await asyncio.sleep(_retry_delay(attempt, response.headers.get("Retry-After")))
+
+class GeminiRateLimitError(Exception):
+    # Still throttled after GEMINI_THROTTLE_RETRIES attempts. Raised instead of
+    # returning "{}" so a quota problem never turns into silently empty rows.
+    pass
+
+class _KeySlot:
+    def __init__(self, index, api_key, requests_per_minute, tokens_per_minute, headroom, period,
+                 initial_concurrency, min_concurrency, max_concurrency):
+        self.label = f"key_{index}"  # for logs and metrics; never the key itself
+        self.api_key = api_key
+        self.requests = TokenBucket(requests_per_minute, period, headroom) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, period, headroom) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, min_concurrency, max_concurrency)
+        self.blocked_until = 0.0  # time.monotonic() deadline from a 429
+
+    def ready_in(self, estimated_tokens, now):
+        wait = max(self.blocked_until - now, 0.0)
+        if self.requests:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.wait_time(estimated_tokens))
+        # Prefer keys with free concurrency slots among equally ready ones
+        return wait, self.concurrency.in_flight / max(self.concurrency.limit, 1)
+
+class KeyLease:
+    def __init__(self, scheduler, slot, estimated_tokens, seed_tokens):
+        self.scheduler = scheduler
+        self.slot = slot
+        self.estimated_tokens = estimated_tokens
+        self.seed_tokens = seed_tokens
+
+    @property
+    def api_key(self):
+        return self.slot.api_key
+
+    def release(self, status=None, prompt_tokens=None, retry_after=None):
+        self.scheduler._release(self, status, prompt_tokens, retry_after)
+
+class GeminiScheduler:
+    # Spreads requests over the API keys and keeps each key under its requests/min and
+    # tokens/min quota. Token costs are seeded by estimate_prompt_tokens (mime type and
+    # page count), scaled by the observed/estimated ratio learned from usageMetadata, and
+    # corrected after each response.
+    # Concurrency per key adapts with AIMD: it shrinks on 429 and grows back on success.
+    def __init__(self, api_keys, requests_per_minute=0, tokens_per_minute=0, headroom=0.95, period=60.0,
+                 initial_concurrency=10, min_concurrency=1, max_concurrency=100):
+        if not api_keys:
+            raise ValueError("At least one Gemini API key is required (GEMINI_API_KEY or GEMINI_API_KEYS)")
+        self.slots = [_KeySlot(index, api_key, requests_per_minute, tokens_per_minute, headroom, period,
+                               initial_concurrency, min_concurrency, max_concurrency)
+                      for index, api_key in enumerate(api_keys)]
+        self._token_ratio = 1.0  # promptTokenCount / seed estimate, moving average
+        # Without a tokens/min quota the estimate is never used, so it isn't computed (it reads PDFs)
+        self.budgets_tokens = any(slot.tokens for slot in self.slots)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def estimate_tokens(self, seed_tokens):
+        return max(int(seed_tokens * self._token_ratio), 1)
+
+    def _reserve(self, seed_tokens):
+        estimated = self.estimate_tokens(seed_tokens)
+        with self._lock:
+            now = time.monotonic()
+            # Round-robin start so ties rotate over the keys
+            order = self.slots[self._next:] + self.slots[:self._next]
+            self._next = (self._next + 1) % len(self.slots)
+            slot = min(order, key=lambda candidate: candidate.ready_in(estimated, now))
+            wait = max(slot.blocked_until - now, 0.0)
+            if slot.requests:
+                wait = max(wait, slot.requests.reserve(1))
+            if slot.tokens:
+                wait = max(wait, slot.tokens.reserve(estimated))
+        return KeyLease(self, slot, estimated, seed_tokens), wait
+
+    def acquire(self, seed_tokens):
+        started = time.perf_counter()
+        lease, wait = self._reserve(seed_tokens)
+        if wait:
+            time.sleep(wait)
+        lease.slot.concurrency.acquire()
+        GEMINI_SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - started)
+        return lease
+
+    async def acquire_async(self, seed_tokens):
+        started = time.perf_counter()
+        lease, wait = self._reserve(seed_tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        await lease.slot.concurrency.acquire_async()
+        GEMINI_SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - started)
+        return lease
+
+    def _release(self, lease, status, prompt_tokens, retry_after):
+        slot = lease.slot
+        slot.concurrency.release()
+        if status == 429:
+            GEMINI_THROTTLED.inc(key=slot.label)
+            slot.concurrency.on_throttle()
+            if retry_after:
+                with self._lock:
+                    slot.blocked_until = max(slot.blocked_until, time.monotonic() + retry_after)
+        elif status == 200:
+            slot.concurrency.on_success()
+            if prompt_tokens:
+                if slot.tokens:
+                    slot.tokens.adjust(prompt_tokens - lease.estimated_tokens)
+                if lease.seed_tokens:
+                    with self._lock:
+                        observed = prompt_tokens / lease.seed_tokens
+                        self._token_ratio += 0.2 * (observed - self._token_ratio)
+        GEMINI_CONCURRENCY_LIMIT.set(slot.concurrency.limit, key=slot.label)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def build_scheduler(quota_share=1.0):
+    # quota_share < 1 when several processes send requests with the same keys
+    return GeminiScheduler(
+        list(GEMINI_API_KEYS) or [GEMINI_API_KEY],
+        requests_per_minute=GEMINI_REQUESTS_PER_MINUTE * quota_share,
+        tokens_per_minute=GEMINI_TOKENS_PER_MINUTE * quota_share,
+        headroom=GEMINI_QUOTA_HEADROOM,
+        initial_concurrency=GEMINI_INITIAL_CONCURRENCY,
+        min_concurrency=GEMINI_MIN_CONCURRENCY,
+        max_concurrency=GEMINI_MAX_CONCURRENCY,
+    )
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = build_scheduler()
+    return _scheduler
+
+def _reset_after_fork():
+    # A forked worker must not reuse the parent's sockets, or locks another thread may have held
+    global _session, _session_lock, _scheduler, _scheduler_lock
+    _session, _session_lock = None, threading.Lock()
+    _scheduler, _scheduler_lock = None, threading.Lock()
+    _async_clients.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def maybe_preprocess(file_obj, mime_type, size):
+    if not GEMINI_PREPROCESS_IMAGES or not mime_type.startswith("image/"):
+        return file_obj, mime_type, size
+    processed = preprocess_image(
+        file_obj,
+        max_dimension=GEMINI_IMAGE_MAX_DIMENSION,
+        output_format=GEMINI_IMAGE_FORMAT,
+        quality=GEMINI_IMAGE_QUALITY,
+        grayscale=GEMINI_IMAGE_GRAYSCALE,
+        original_bytes=size,
+    )
+    if processed is None:
+        return file_obj, mime_type, size
+    STAGE_SECONDS.observe(processed.seconds, stage='preprocess')
+    PREPROCESS_SAVED_BYTES.inc(processed.saved_bytes)
+    logger.info("Pre-processed image", extra={'event': 'preprocess', **processed.as_dict()})
+    return processed.file, processed.mime_type, processed.processed_bytes
 
+DEFAULT_PROMPT = "Extract all invoice fields (invoice number, total, date, etc.) in JSON."
+
+PACKED_PROMPT = (
+    "{prompt}\n\n"
+    "The request contains {count} separate documents, each preceded by its label. "
+    "Extract every document on its own and return a single JSON object whose keys are "
+    "exactly these labels: {labels}. The value for each label is the JSON extracted from that document."
+)
+
+def _mime_type_for(file_name, content_type=None):
+    # content_type: sniffed from the content when the file was stored (GridFS), preferred to the name
+    if content_type in SUPPORTED_MIME_TYPES:
+        return content_type
+    mime_type, _ = mimetypes.guess_type(str(file_name))
+    if not mime_type:
+        mime_type = "application/octet-stream"
     # Only allow supported mime types for Gemini API
-    SUPPORTED_MIME_TYPES = [
-        "application/pdf",
-        "image/png",
-        "image/jpeg",
-        "image/gif",
-        "image/bmp",
-        "image/tiff"
-    ]
     if mime_type not in SUPPORTED_MIME_TYPES:
         raise ValueError(f"Unsupported file type for Gemini API: {mime_type}. Supported types: {', '.join(SUPPORTED_MIME_TYPES)}")
+    return mime_type
 
-    print(f"[Gemini] File fetched and encoded. Mime type: {mime_type}")
+def _file_name_of(file_obj):
+    return getattr(file_obj, 'name', None) or 'file'  # fallback to a generic name
 
-    if prompt is None:
-        prompt = "Extract all invoice fields (invoice number, total, date, etc.) in JSON."
-
-    payload = {
-        "contents": [
-            {
-                "parts": [
-                    {
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": file_content
-                        }
-                    },
-                    {
-                        "text": prompt
-                    }
-                ]
-            }
-        ]
-    }
-
-    print(f"[Gemini] Sending request to Gemini API...")
-    response = requests.post(
-        f"{GEMINI_ENDPOINT}?key={GEMINI_API_KEY}",
-        json=payload
-    )
-    print(f"[Gemini] Response status: {response.status_code}")
-    print(f"[Gemini] Raw response: {response.text}")
-    if response.status_code == 200:
+def _content_type_of(file_obj):
+    return getattr(file_obj, 'content_type', None)
+
+def _inline_part(file_obj, mime_type):
+    # Pre-processing runs after the cache lookup so hits skip it; the cache key uses the original bytes
+    file_obj, mime_type, size = maybe_preprocess(file_obj, mime_type, _file_size(file_obj))
+    return (file_obj, size, mime_type)
+
+def _record_usage(body):
+    usage = body.get("usageMetadata") or {}
+    for key, token_type in (("promptTokenCount", "prompt"), ("candidatesTokenCount", "candidates"),
+                            ("totalTokenCount", "total")):
+        if usage.get(key):
+            GEMINI_TOKENS.inc(usage[key], type=token_type)
+    return usage
+
+# Gemini bills a fixed number of prompt tokens per image and per PDF page, whatever the file size
+IMAGE_TOKENS = 258
+PDF_PAGE_TOKENS = 258
+
+def estimate_prompt_tokens(parts):
+    # Seed of the scheduler's token reservation: text by length, files by mime type and page count
+    tokens = 0
+    for part in parts:
+        if not isinstance(part, tuple):
+            tokens += len(part) // 4 + 1
+        elif part[2] == "application/pdf":
+            tokens += PDF_PAGE_TOKENS * (count_pdf_pages(part[0]) or 1)
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+def _prepare_payload(parts, scheduler):
+    payload = StreamingPayload(parts)
+    payload_bytes = len(payload)
+    if payload_bytes:
+        PAYLOAD_BYTES.observe(payload_bytes)
+    return payload, payload_bytes, estimate_prompt_tokens(parts) if scheduler.budgets_tokens else 0
+
+def _observe_request(payload, started):
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage='api_call')
+    for stage, seconds in payload.timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+def _handle_response(response, payload_bytes, started):
+    # Works for requests and httpx responses alike; returns (cleaned model text or None on failure, usage)
+    GEMINI_RESPONSES.inc(status=response.status_code)
+    log_context = {'status': response.status_code, 'payload_bytes': payload_bytes,
+                   'api_seconds': round(time.perf_counter() - started, 4)}
+
+    if response.status_code != 200:
+        EXTRACTION_ERRORS.inc(reason=f'http_{response.status_code}')
+        logger.warning("Error from Gemini API", extra={'event': 'gemini_error', **log_context,
+                                                       'body': response.text[:LOG_TEXT_LIMIT]})
+        return None, {}
+
+    with STAGE_SECONDS.time(stage='parse'):
         try:
-            result = response.json()["candidates"][0]["content"]["parts"][0]["text"]
-            print(f"[Gemini] Extracted JSON text: {result}")
-            # Remove triple backticks and optional 'json' label
-            cleaned = re.sub(r'^```json\s*|^```\s*|```$', '', result.strip(), flags=re.MULTILINE)
-            cleaned = cleaned.strip()
-            print(f"[Gemini] Cleaned JSON text: {cleaned}")
-            return cleaned
+            body = response.json()
+            usage = _record_usage(body)
+            result = body["candidates"][0]["content"]["parts"][0]["text"]
         except Exception as e:
-            print(f"[Gemini] Error parsing response: {e}")
-            return "{}"  # Fallback if structure is unexpected
-    else:
-        print(f"[Gemini] Error from Gemini API: {response.text}")
-        return "{}"  # Fallback
\ No newline at end of file
+            EXTRACTION_ERRORS.inc(reason='unexpected_response')
+            logger.warning("Error parsing Gemini response", extra={'event': 'gemini_parse_error', **log_context,
+                                                                   'error': str(e)})
+            return None, {}
+        # Remove triple backticks and optional 'json' label
+        cleaned = re.sub(r'^```json\s*|^```\s*|```$', '', result.strip(), flags=re.MULTILINE)
+        cleaned = cleaned.strip()
+    logger.info("Gemini extraction completed", extra={'event': 'gemini_response', **log_context,
+                                                      'prompt_tokens': usage.get('promptTokenCount'),
+                                                      'output_tokens': usage.get('candidatesTokenCount')})
+    logger.debug("Gemini extracted text", extra={'event': 'gemini_text', 'text': cleaned[:LOG_TEXT_LIMIT]})
+    return cleaned, usage
+
+def _throttled(lease, response, attempt):
+    GEMINI_RESPONSES.inc(status=response.status_code)
+    delay = _retry_delay(attempt, response.headers.get("Retry-After"))
+    lease.release(response.status_code, retry_after=delay)
+    logger.info("Throttled by Gemini API", extra={'event': 'gemini_throttled', 'key': lease.slot.label,
+                                                  'attempt': attempt + 1, 'retry_in': round(delay, 3)})
+
+def _give_up(attempts):
+    EXTRACTION_ERRORS.inc(reason='rate_limited')
+    return GeminiRateLimitError(f"Gemini API still rate limited after {attempts} attempts")
+
+def _request_extraction(parts):
+    # Sends one generateContent request; returns the cleaned model text, or None on failure.
+    # Raises GeminiRateLimitError when every attempt was answered with 429.
+    scheduler = get_scheduler()
+    payload, payload_bytes, seed_tokens = _prepare_payload(parts, scheduler)
+    for attempt in range(GEMINI_THROTTLE_RETRIES + 1):
+        lease = scheduler.acquire(seed_tokens)
+        started = time.perf_counter()
+        try:
+            response = post_payload(payload, lease.api_key)
+        except requests.RequestException as e:
+            lease.release()
+            EXTRACTION_ERRORS.inc(reason='connection')
+            logger.error("Gemini request failed", extra={'event': 'gemini_request_failed', 'error': str(e)})
+            raise
+        except BaseException:
+            lease.release()
+            raise
+        finally:
+            _observe_request(payload, started)
+        if response.status_code == 429:
+            _throttled(lease, response, attempt)
+            continue
+        cleaned, usage = _handle_response(response, payload_bytes, started)
+        lease.release(response.status_code, usage.get("promptTokenCount"))
+        return cleaned
+    raise _give_up(GEMINI_THROTTLE_RETRIES + 1)
+
+async def _arequest_extraction(parts):
+    import httpx
+
+    scheduler = get_scheduler()
+    # Counting PDF pages reads the files
+    payload, payload_bytes, seed_tokens = await asyncio.to_thread(_prepare_payload, parts, scheduler)
+    for attempt in range(GEMINI_THROTTLE_RETRIES + 1):
+        lease = await scheduler.acquire_async(seed_tokens)
+        started = time.perf_counter()
+        try:
+            response = await apost_payload(payload, lease.api_key)
+        except httpx.HTTPError as e:
+            lease.release()
+            EXTRACTION_ERRORS.inc(reason='connection')
+            logger.error("Gemini request failed", extra={'event': 'gemini_request_failed', 'error': str(e)})
+            raise
+        except BaseException:
+            lease.release()  # cancelled
+            raise
+        finally:
+            _observe_request(payload, started)
+        if response.status_code == 429:
+            _throttled(lease, response, attempt)
+            continue
+        cleaned, usage = _handle_response(response, payload_bytes, started)
+        lease.release(response.status_code, usage.get("promptTokenCount"))
+        return cleaned
+    raise _give_up(GEMINI_THROTTLE_RETRIES + 1)
+
+def _hash_file(file_obj):
+    with STAGE_SECONDS.time(stage='hash'):
+        return file_sha256(file_obj)
+
+def extract_data_from_file(file_or_path, prompt=None, use_cache=True, file_hash=None):
+    # file_hash: sha256 of the content when already known (stored documents), skips re-reading it for the cache
+    logger.debug("Extracting file", extra={'event': 'extract_file', 'file': str(file_or_path)})
+
+    # Determine if file_or_path is a file-like object or a path
+    if hasattr(file_or_path, 'read'):
+        # It's a file-like object (GridFSProxy)
+        return _extract_from_file_obj(file_or_path, _file_name_of(file_or_path), prompt, use_cache, file_hash)
+    # It's a file path
+    with open(file_or_path, "rb") as f:
+        return _extract_from_file_obj(f, file_or_path, prompt, use_cache, file_hash)
+
+def _extract_from_file_obj(file_obj, file_name, prompt, use_cache, file_hash=None):
+    mime_type = _mime_type_for(file_name, _content_type_of(file_obj))
+    if prompt is None:
+        prompt = DEFAULT_PROMPT
+
+    if not use_cache:
+        file_hash = None
+    elif file_hash is None:
+        file_hash = _hash_file(file_obj)
+    if file_hash:
+        cached = get_cached_result(file_hash, prompt, GEMINI_ENDPOINT)
+        if cached is not None:
+            logger.info("Extraction cache hit", extra={'event': 'cache_hit', 'file_hash': file_hash})
+            return cached
+
+    cleaned = _extract_split(file_obj, mime_type, prompt) if GEMINI_SPLIT_DOCUMENTS else None
+    if cleaned is None:
+        # The file is read and encoded while the request body is being sent
+        logger.debug("Streaming file to Gemini API", extra={'event': 'gemini_request', 'mime_type': mime_type})
+        cleaned = _request_extraction([_inline_part(file_obj, mime_type), prompt])
+    if cleaned is None:
+        return "{}"  # Fallback
+    if file_hash and _is_json(cleaned):
+        store_result(file_hash, prompt, GEMINI_ENDPOINT, cleaned)
+    return cleaned
+
+async def extract_data_from_file_async(file_or_path, prompt=None, use_cache=True, file_hash=None):
+    # Same contract as extract_data_from_file. Hashing, cache lookups and pre-processing
+    # block, so they run in worker threads; the request itself waits on the event loop.
+    if not hasattr(file_or_path, 'read'):
+        with open(file_or_path, "rb") as f:
+            return await _aextract_from_file_obj(f, file_or_path, prompt, use_cache, file_hash)
+    return await _aextract_from_file_obj(file_or_path, _file_name_of(file_or_path), prompt, use_cache, file_hash)
+
+async def _aextract_from_file_obj(file_obj, file_name, prompt, use_cache, file_hash=None):
+    mime_type = _mime_type_for(file_name, _content_type_of(file_obj))
+    if prompt is None:
+        prompt = DEFAULT_PROMPT
+
+    if not use_cache:
+        file_hash = None
+    elif file_hash is None:
+        file_hash = await asyncio.to_thread(_hash_file, file_obj)
+    if file_hash:
+        cached = await asyncio.to_thread(get_cached_result, file_hash, prompt, GEMINI_ENDPOINT)
+        if cached is not None:
+            logger.info("Extraction cache hit", extra={'event': 'cache_hit', 'file_hash': file_hash})
+            return cached
+
+    cleaned = await _aextract_split(file_obj, mime_type, prompt) if GEMINI_SPLIT_DOCUMENTS else None
+    if cleaned is None:
+        part = await asyncio.to_thread(_inline_part, file_obj, mime_type)
+        cleaned = await _arequest_extraction([part, prompt])
+    if cleaned is None:
+        return "{}"  # Fallback
+    if file_hash and _is_json(cleaned):
+        await asyncio.to_thread(store_result, file_hash, prompt, GEMINI_ENDPOINT, cleaned)
+    return cleaned
+
+CHUNK_PROMPT = (
+    "{prompt}\n\n"
+    "This request contains pages {first}-{last} of a {total}-page document; the other pages are sent "
+    "separately. Extract only what appears on these pages, using the same JSON structure as for the whole "
+    "document, and leave out fields that do not appear on them."
+)
+
+def _split(file_obj, mime_type):
+    with STAGE_SECONDS.time(stage='split'):
+        return split_document(file_obj, mime_type, GEMINI_SPLIT_PAGES_PER_CHUNK, GEMINI_SPLIT_MIN_PAGES)
+
+def _next_chunk(chunks):
+    # Cuts the next chunk; None once they are all cut
+    with STAGE_SECONDS.time(stage='split'):
+        return next(chunks, None)
+
+def _extract_chunk(chunk, prompt, total):
+    return _request_extraction(_chunk_parts(chunk, prompt, total))
+
+def _chunk_parts(chunk, prompt, total):
+    parts = [_inline_part(part, mime_type) for part, mime_type in chunk.parts]
+    parts.append(CHUNK_PROMPT.format(prompt=prompt, first=chunk.first_page, last=chunk.last_page, total=total))
+    return parts
+
+def _merge_chunks(results, total):
+    # The merged JSON text, or None when a chunk failed or the chunks can't be combined
+    parsed = []
+    for cleaned in results:
+        try:
+            parsed.append(json.loads(cleaned))
+        except (TypeError, ValueError):
+            break
+    with STAGE_SECONDS.time(stage='merge'):
+        merged = merge_results(parsed, GEMINI_SPLIT_MERGE_RULES) if len(parsed) == len(results) else None
+    if merged is None:
+        EXTRACTION_ERRORS.inc(reason='split_merge')
+        logger.warning("Chunk results could not be merged; extracting the document whole",
+                       extra={'event': 'split_fallback', 'pages': total, 'chunks': len(results)})
+        return None
+    logger.info("Merged chunk results", extra={'event': 'split_merged', 'pages': total, 'chunks': len(results)})
+    return json.dumps(merged, ensure_ascii=False)
+
+def _extract_split(file_obj, mime_type, prompt):
+    # Extracts a long document chunk by chunk, GEMINI_SPLIT_CONCURRENCY chunks at a time.
+    # Returns None when it is not split, or when a chunk failed (the caller then sends it whole).
+    split = _split(file_obj, mime_type)
+    if split is None:
+        return None
+    chunks, total = split
+    logger.debug("Streaming document chunks to Gemini API", extra={'event': 'gemini_request', 'pages': total})
+    limit = max(GEMINI_SPLIT_CONCURRENCY, 1)
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=limit) as executor:
+            # A chunk is cut once a slot is free, so at most `limit` are in memory
+            for chunk in iter(lambda: _next_chunk(chunks), None):
+                futures.append(executor.submit(_extract_chunk, chunk, prompt, total))
+                running = [future for future in futures if not future.done()]
+                if len(running) >= limit:
+                    wait(running, return_when=FIRST_COMPLETED)
+    except SplitError:
+        return None
+    finally:
+        chunks.close()
+    return _merge_chunks([future.result() for future in futures], total)
+
+async def _aextract_split(file_obj, mime_type, prompt):
+    split = await asyncio.to_thread(_split, file_obj, mime_type)
+    if split is None:
+        return None
+    chunks, total = split
+    semaphore = asyncio.Semaphore(max(GEMINI_SPLIT_CONCURRENCY, 1))
+
+    async def run_chunk(chunk):
+        try:
+            parts = await asyncio.to_thread(_chunk_parts, chunk, prompt, total)
+            return await _arequest_extraction(parts)
+        finally:
+            semaphore.release()
+
+    tasks = []
+    try:
+        while True:
+            # A chunk is cut once a slot is free, so at most GEMINI_SPLIT_CONCURRENCY are in memory
+            await semaphore.acquire()
+            chunk = await asyncio.to_thread(_next_chunk, chunks)
+            if chunk is None:
+                break
+            tasks.append(asyncio.create_task(run_chunk(chunk)))
+        results = await asyncio.gather(*tasks)
+    except BaseException as e:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if isinstance(e, SplitError):
+            return None  # sent whole by the caller
+        raise
+    finally:
+        await asyncio.to_thread(chunks.close)
+    return _merge_chunks(results, total)
+
+def _split_packed_result(cleaned, labels):
+    try:
+        data = json.loads(cleaned)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict) or any(label not in data for label in labels):
+        return None
+    return [data[label] for label in labels]
+
+def extract_data_from_files(file_objs, prompt=None, use_cache=True, file_hashes=None):
+    # Packs several documents into one request as separate inline_data parts and splits the
+    # keyed response back into one JSON string per document, in input order.
+    # Returns None when the response can not be split; callers then fall back to one request per file.
+    if prompt is None:
+        prompt = DEFAULT_PROMPT
+    results = [None] * len(file_objs)
+    hashes = [None] * len(file_objs)
+    pending = []
+    for index, file_obj in enumerate(file_objs):
+        if use_cache:
+            hashes[index] = (file_hashes and file_hashes[index]) or _hash_file(file_obj)
+            cached = get_cached_result(hashes[index], prompt, GEMINI_ENDPOINT)
+            if cached is not None:
+                results[index] = cached
+                continue
+        pending.append(index)
+    if not pending:
+        return results
+
+    labels = [f"doc_{n}" for n in range(1, len(pending) + 1)]
+    parts = []
+    for label, index in zip(labels, pending):
+        file_obj = file_objs[index]
+        parts.append(f"Document {label}:")
+        parts.append(_inline_part(file_obj, _mime_type_for(_file_name_of(file_obj), _content_type_of(file_obj))))
+    parts.append(PACKED_PROMPT.format(prompt=prompt, count=len(labels), labels=", ".join(labels)))
+
+    logger.debug("Streaming packed documents to Gemini API", extra={'event': 'gemini_request', 'documents': len(pending)})
+    cleaned = _request_extraction(parts)
+    split = _split_packed_result(cleaned, labels) if cleaned is not None else None
+    if split is None:
+        EXTRACTION_ERRORS.inc(reason='pack_split')
+        logger.warning("Packed response could not be split per document",
+                       extra={'event': 'pack_split_failed', 'documents': len(pending)})
+        return None
+    for index, data in zip(pending, split):
+        results[index] = json.dumps(data, ensure_ascii=False)
+        if hashes[index]:
+            store_result(hashes[index], prompt, GEMINI_ENDPOINT, results[index])
+    return results
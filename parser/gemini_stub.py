@@ -0,0 +1,244 @@
+import base64
+import binascii
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# =========================
+# Local stand-in for the Gemini generateContent API
+# =========================
+# Used by the benchmarks and for exercising the HTTP client (timeouts, retries,
+# keep-alive) without touching the real API. Point GEMINI_ENDPOINT at `server.url`.
+# Optional per-key quotas (requests and prompt tokens per sliding `quota_period`,
+# concurrent requests) answer 429 RESOURCE_EXHAUSTED like the real API.
+# Prompt tokens are billed like Gemini: a fixed count per image and per PDF page
+# (pages found in the decoded file), text by length.
+
+_PDF_PAGE = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+    def setup(self):
+        super().setup()
+        self.server.stub._record_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self._read_body()
+        status, headers, payload = self.server.stub._respond(self.path, body)
+        self._send_json(status, payload, headers)
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default listen backlog of 5 drops connections under concurrent load
+
+    def handle_error(self, request, client_address):
+        # A client that timed out and hung up is expected (read timeout tests); anything else is reported
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class GeminiStubServer:
+    def __init__(self, latency=0.0, latency_jitter=0.0, latency_distribution='fixed', error_rate=0.0,
+                 error_status=503, retry_after=None, response_fields=5, response_text=None,
+                 seed=0, host='127.0.0.1', port=0, requests_per_minute=None, tokens_per_minute=None,
+                 max_concurrent=None, quota_period=60.0, latency_per_mb=0.0, tokens_per_image=258,
+                 tokens_per_page=258):
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb  # added per MB of request body, as larger documents take longer
+        self.latency_jitter = latency_jitter
+        self.latency_distribution = latency_distribution  # 'fixed', 'uniform' or 'lognormal'
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.response_fields = response_fields
+        self.response_text = response_text
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrent = max_concurrent
+        self.quota_period = quota_period
+        self.tokens_per_image = tokens_per_image
+        self.tokens_per_page = tokens_per_page  # of a PDF
+        self.request_count = 0
+        self.throttled_count = 0
+        self._usage = defaultdict(deque)  # key -> (accepted_at, prompt_tokens) within quota_period
+        self._in_flight = defaultdict(int)
+        self.connection_count = 0
+        self.request_log = []
+        self._scripted = deque()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = _StubHTTPServer((host, port), _StubHandler)
+        self._httpd.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1beta/models/stub:generateContent"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def queue_responses(self, *statuses):
+        # Force the status of the next requests, e.g. queue_responses(429, 503) before a 200
+        with self._lock:
+            self._scripted.extend(statuses)
+
+    def _record_connection(self):
+        with self._lock:
+            self.connection_count += 1
+
+    def _sample_latency(self):
+        with self._lock:
+            if self.latency_distribution == 'uniform':
+                value = self._random.uniform(self.latency - self.latency_jitter, self.latency + self.latency_jitter)
+            elif self.latency_distribution == 'lognormal' and self.latency > 0:
+                value = self._random.lognormvariate(0, self.latency_jitter) * self.latency
+            else:
+                value = self.latency
+        return max(value, 0.0)
+
+    def _next_status(self):
+        with self._lock:
+            self.request_count += 1
+            if self._scripted:
+                return self._scripted.popleft()
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self.error_status
+            return 200
+
+    def _admit(self, key, tokens):
+        # Returns None when the request fits the key's quotas, else the Retry-After in seconds
+        with self._lock:
+            now = time.monotonic()
+            usage = self._usage[key]
+            while usage and usage[0][0] <= now - self.quota_period:
+                usage.popleft()
+            retry_after = None
+            if self.max_concurrent is not None and self._in_flight[key] >= self.max_concurrent:
+                retry_after = 1
+            if self.requests_per_minute is not None and len(usage) >= self.requests_per_minute:
+                retry_after = max(retry_after or 0, usage[0][0] + self.quota_period - now)
+            if self.tokens_per_minute is not None:
+                used = sum(count for _, count in usage)
+                if used + tokens > self.tokens_per_minute:
+                    # Wait until enough earlier requests have left the window
+                    freed, wait = self.tokens_per_minute - used - tokens, 0.0
+                    for accepted_at, count in usage:
+                        freed += count
+                        wait = accepted_at + self.quota_period - now
+                        if freed >= 0:
+                            break
+                    retry_after = max(retry_after or 0, wait)
+            if retry_after is not None:
+                self.request_count += 1
+                self.throttled_count += 1
+                return max(int(math.ceil(retry_after)), 1)
+            usage.append((now, tokens))
+            self._in_flight[key] += 1
+            return None
+
+    def prompt_tokens(self, body):
+        try:
+            parts = [part for content in json.loads(body)['contents'] for part in content['parts']]
+        except (ValueError, KeyError, TypeError):
+            return max(len(body) // 4, 1)
+        tokens = 0
+        for part in parts:
+            inline = part.get('inline_data') or {}
+            if 'text' in part:
+                tokens += len(part['text']) // 4
+            elif inline.get('mime_type') == 'application/pdf':
+                try:
+                    pages = len(_PDF_PAGE.findall(base64.b64decode(inline.get('data', ''))))
+                except (binascii.Error, ValueError):
+                    pages = 0
+                tokens += self.tokens_per_page * max(pages, 1)
+            elif inline:
+                tokens += self.tokens_per_image
+        return max(tokens, 1)
+
+    def _respond(self, path, body):
+        received_at = time.time()
+        key = parse_qs(urlsplit(path).query).get('key', [''])[0]
+        prompt_tokens = self.prompt_tokens(body)
+        retry_after = self._admit(key, prompt_tokens)
+        if retry_after is not None:
+            with self._lock:
+                self.request_log.append({'path': path, 'key': key, 'status': 429, 'bytes': len(body),
+                                         'received_at': received_at})
+            return 429, {'Retry-After': retry_after}, {'error': {
+                'code': 429, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}}
+        try:
+            status = self._next_status()
+            time.sleep(self._sample_latency() + self.latency_per_mb * len(body) / 1e6)
+        finally:
+            with self._lock:
+                self._in_flight[key] -= 1
+        with self._lock:
+            self.request_log.append({'path': path, 'key': key, 'status': status, 'bytes': len(body),
+                                     'received_at': received_at})
+        if status != 200:
+            headers = {'Retry-After': self.retry_after} if self.retry_after is not None else {}
+            return status, headers, {'error': {'code': status, 'message': 'Stubbed error', 'status': 'UNAVAILABLE'}}
+        return 200, {}, self._success_payload(prompt_tokens)
+
+    def _success_payload(self, prompt_tokens):
+        text = self.response_text
+        if text is None:
+            fields = {f'field_{i}': f'value_{i}' for i in range(self.response_fields)}
+            text = "```json\n" + json.dumps(fields) + "\n```"
+        return {
+            'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP'}],
+            'usageMetadata': {
+                'promptTokenCount': prompt_tokens,
+                'candidatesTokenCount': max(len(text) // 4, 1),
+                'totalTokenCount': prompt_tokens + max(len(text) // 4, 1),
+            },
+        }
@@ -0,0 +1,208 @@
+import asyncio
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from mongoengine.errors import SaveConditionError
+
+from .gemini_parser import close_async_client
+from .models import DocumentBatch, UserDocument
+from .views import process_documents_with_gemini, process_documents_with_gemini_async, store_batch_results
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# MongoDB-backed batch queue
+# =========================
+# Batches are enqueued by saving them with status='pending'. Workers claim
+# them with an atomic find-and-modify so two workers never pick the same one.
+# A claimed batch carries a lease (claim_token + heartbeat_at): when its worker
+# dies the heartbeat goes stale and another worker re-claims it. Each document
+# is checkpointed as soon as it is extracted, so a re-claimed or resumed batch
+# only sends the unfinished documents to Gemini again.
+
+def _stale_cutoff(now, stale_after=None):
+    if stale_after is None:
+        stale_after = settings.BATCH_STALE_AFTER
+    return now - datetime.timedelta(seconds=stale_after)
+
+def claim_next_batch(stale_after=None):
+    now = datetime.datetime.utcnow()
+    cutoff = _stale_cutoff(now, stale_after)
+    claimable = {'$or': [
+        {'status': 'pending'},
+        {'status': 'processing', 'heartbeat_at': {'$lt': cutoff},
+         'attempts': {'$lt': settings.BATCH_MAX_ATTEMPTS}},
+        # Claimed before heartbeats existed
+        {'status': 'processing', 'heartbeat_at': {'$exists': False}, 'started_at': {'$lt': cutoff}},
+    ]}
+    return DocumentBatch.objects(__raw__=claimable).order_by('created_at').modify(
+        set__status='processing',
+        set__started_at=now,
+        set__heartbeat_at=now,
+        set__claim_token=uuid.uuid4().hex,
+        inc__attempts=1,
+        new=True,
+    )
+
+def fail_exhausted_batches(stale_after=None):
+    # Batches whose worker died on every attempt (e.g. killed for memory) are not retried forever
+    now = datetime.datetime.utcnow()
+    return DocumentBatch.objects(
+        status='processing',
+        heartbeat_at__lt=_stale_cutoff(now, stale_after),
+        attempts__gte=settings.BATCH_MAX_ATTEMPTS,
+    ).update(
+        set__status='failed',
+        set__error='Worker stopped responding; resume the batch to retry the unfinished documents.',
+        set__finished_at=now,
+    )
+
+def resume_batch(batch_id):
+    # Re-queues a failed (or stale) batch; documents checkpointed earlier are not extracted again.
+    # Returns the updated batch, or None when it is not resumable. The progress of the earlier
+    # attempts is dropped; run_batch rebuilds it from the checkpoints.
+    now = datetime.datetime.utcnow()
+    resumable = {'$or': [
+        {'status': 'failed'},
+        {'status': 'processing', 'heartbeat_at': {'$lt': _stale_cutoff(now)}},
+    ]}
+    return DocumentBatch.objects(id=batch_id, __raw__=resumable).modify(
+        set__status='pending',
+        set__attempts=0,
+        unset__error=True,
+        unset__finished_at=True,
+        unset__claim_token=True,
+        set__progress=[],
+        new=True,
+    )
+
+class Heartbeat:
+    # Renews the lease from a background thread while the batch is processed;
+    # a single document can take longer than BATCH_STALE_AFTER
+    def __init__(self, batch, interval=None):
+        self.batch = batch
+        self.interval = settings.BATCH_HEARTBEAT_INTERVAL if interval is None else interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'heartbeat-{batch.id}', daemon=True)
+
+    def beat(self):
+        updated = DocumentBatch.objects(id=self.batch.id, claim_token=self.batch.claim_token).update_one(
+            set__heartbeat_at=datetime.datetime.utcnow())
+        if not updated and not self.lost:
+            self.lost = True
+            logger.warning("Batch lease lost to another worker",
+                           extra={'event': 'batch_lease_lost', 'batch_id': str(self.batch.id)})
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.beat()
+            except Exception:
+                logger.exception("Heartbeat failed", extra={'event': 'heartbeat_failed', 'batch_id': str(self.batch.id)})
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+def checkpoint_recorder(batch, documents):
+    # Saves each document's result as soon as it is extracted and appends a progress
+    # entry for the batch_events SSE view. Empty rows are not checkpointed (a failed
+    # extraction also comes back empty), so resuming retries them; genuinely empty
+    # documents are then answered by the extraction cache.
+    positions = {doc.id: position for position, doc in enumerate(batch.documents)}
+
+    def record(index, row):
+        doc = documents[index]
+        now = datetime.datetime.utcnow()
+        if row:
+            UserDocument.objects(id=doc.id).update_one(
+                set__is_processed=True, set__extracted_data=row, set__processed_at=now)
+        DocumentBatch.objects(id=batch.id).update_one(
+            inc__processed_count=1 if row else 0,
+            set__heartbeat_at=now,
+            push__progress={
+                'index': positions[doc.id],
+                'file_name': doc.file_name,
+                'outcome': 'extracted' if row else 'empty',
+                'finished_at': now,
+            },
+        )
+    return record
+
+async def _extract_async(documents, batch, on_progress):
+    try:
+        return await process_documents_with_gemini_async(documents, batch.custom_fields, batch.strict_mode,
+                                                         on_progress=on_progress)
+    finally:
+        await close_async_client()
+
+def _checkpointed_progress(batch):
+    # One progress entry per document extracted by an earlier attempt, so a retried
+    # batch never reports more documents than it has
+    return [{'index': position, 'file_name': doc.file_name, 'outcome': 'extracted',
+             'finished_at': doc.processed_at}
+            for position, doc in enumerate(batch.documents) if doc.is_processed]
+
+def run_batch(batch, use_async=False):
+    with Heartbeat(batch):
+        try:
+            pending = [doc for doc in batch.documents if not doc.is_processed]
+            batch.update(set__processed_count=len(batch.documents) - len(pending),
+                         set__progress=_checkpointed_progress(batch))
+            if len(pending) < len(batch.documents):
+                logger.info("Resuming batch from checkpoints", extra={
+                    'event': 'batch_resumed', 'batch_id': str(batch.id),
+                    'checkpointed': len(batch.documents) - len(pending), 'pending': len(pending)})
+            on_progress = checkpoint_recorder(batch, pending)
+            if not pending:
+                rows = []
+            elif use_async:
+                rows = asyncio.run(_extract_async(pending, batch, on_progress))
+            else:
+                rows = process_documents_with_gemini(pending, batch.custom_fields, batch.strict_mode,
+                                                     on_progress=on_progress)
+            extracted = {doc.id: row for doc, row in zip(pending, rows)}
+            all_data = [(doc.extracted_data or {}) if doc.is_processed else extracted[doc.id]
+                        for doc in batch.documents]
+            store_batch_results(batch, all_data)
+            batch.status = 'completed'
+        except Exception as e:
+            logger.exception("Batch failed", extra={'event': 'batch_failed', 'batch_id': str(batch.id)})
+            batch.status = 'failed'
+            batch.error = str(e)
+    batch.finished_at = datetime.datetime.utcnow()
+    try:
+        # Only the worker holding the lease may finish the batch
+        batch.save(save_condition={'claim_token': batch.claim_token})
+    except SaveConditionError:
+        logger.warning("Batch was re-claimed by another worker, dropping this result",
+                       extra={'event': 'batch_lease_lost', 'batch_id': str(batch.id)})
+    return batch
+
+def run_worker(poll_interval=2.0, once=False, use_async=False):
+    processed = 0
+    while True:
+        fail_exhausted_batches()
+        batch = claim_next_batch()
+        if batch is None:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        logger.info("Processing batch", extra={'event': 'batch_started', 'batch_id': str(batch.id),
+                                               'documents': len(batch.documents), 'attempt': batch.attempts})
+        started = time.perf_counter()
+        run_batch(batch, use_async=use_async)
+        logger.info("Batch finished", extra={'event': 'batch_finished', 'batch_id': str(batch.id),
+                                             'status': batch.status,
+                                             'seconds': round(time.perf_counter() - started, 3)})
+        processed += 1
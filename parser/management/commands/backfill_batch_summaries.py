@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from parser.models import DocumentBatch
+
+
+class Command(BaseCommand):
+    help = "Fill the denormalized summary fields (document_count, file_names, result_size) of older batches."
+
+    def handle(self, *args, **options):
+        updated = 0
+        for batch in DocumentBatch.objects(document_count__in=[0, None]).no_cache():
+            documents = [doc for doc in batch.documents if hasattr(doc, 'file_name')]
+            result_size = batch.result_file.length if batch.result_file else None
+            batch.update(
+                set__document_count=len(documents),
+                set__file_names=[doc.file_name or '' for doc in documents],
+                set__result_size=result_size,
+            )
+            updated += 1
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} batch(es)."))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from parser.blob_store import adopt_blob
+from parser.extraction_cache import file_sha256
+from parser.models import UserDocument
+
+
+class Command(BaseCommand):
+    help = ("Move documents uploaded before content-addressed storage onto shared blobs, "
+            "deleting the GridFS copies of duplicate files.")
+
+    def handle(self, *args, **options):
+        migrated = freed = freed_bytes = 0
+        for doc in UserDocument.objects(file_hash__in=[None, '']).no_cache():
+            if not doc.file:
+                continue
+            file_hash = file_sha256(doc.file)
+            size = doc.file.length or 0
+            blob, adopted = adopt_blob(file_hash, doc.file, size)
+            # Raw update: a GridFSProxy can not be passed to update() as a query value
+            UserDocument.objects(id=doc.id).update_one(
+                __raw__={'$set': {'file': blob.file.grid_id, 'file_hash': file_hash}})
+            if not adopted:
+                doc.file.delete()
+                freed += 1
+                freed_bytes += size
+            migrated += 1
+        self.stdout.write(self.style.SUCCESS(
+            f"Migrated {migrated} document(s); removed {freed} duplicate file(s), {freed_bytes} bytes."))
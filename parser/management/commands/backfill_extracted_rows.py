@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from parser.models import DocumentBatch, ExtractedRow
+from parser.normalize import normalize_record
+from parser.views import flatten_record, iter_batch_rows, store_extracted_rows
+
+
+class Command(BaseCommand):
+    help = ("Store the rows of batches completed before the extracted_rows collection existed, "
+            "and the typed values of rows stored before they were normalized.")
+
+    def handle(self, *args, **options):
+        updated = 0
+        for batch in DocumentBatch.objects(status='completed').no_dereference().no_cache():
+            if ExtractedRow.objects(batch=batch.id).only('id').first():
+                continue
+            store_extracted_rows(batch, iter_batch_rows(batch))
+            updated += 1
+        normalized = 0
+        for row in ExtractedRow.objects(__raw__={'values': {'$exists': False}}).only('id', 'data').no_cache():
+            row.update(set__values=normalize_record(flatten_record(row.data)))
+            normalized += 1
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored rows for {updated} batch(es); normalized {normalized} older row(s)."))
@@ -0,0 +1,231 @@
+import json
+import time
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from parser import gemini_parser, jobs, views
+from parser.benchmarks import Stopwatch, environment_info, latency_summary, peak_rss_mb, synthetic_documents
+from parser.gemini_stub import GeminiStubServer
+from parser.models import CustomUser, DocumentBatch, UserDocument
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the extraction pipeline against a local Gemini stub server: "
+            "process_documents_with_gemini, result file generation and the upload/download views.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=50, help="Synthetic documents per run.")
+        parser.add_argument('--pdf-ratio', type=float, default=0.5, help="Share of PDFs (rest are PNG receipts).")
+        parser.add_argument('--max-pages', type=int, default=3, help="Pages of the longest synthetic PDF.")
+        parser.add_argument('--split', action='store_true',
+                            help="Extract long PDFs page range by page range (GEMINI_SPLIT_DOCUMENTS, needs pypdf).")
+        parser.add_argument('--concurrency', type=int, default=None, help="Defaults to GEMINI_CONCURRENCY.")
+        parser.add_argument('--latency', type=float, default=0.5, help="Stub latency in seconds (median for lognormal).")
+        parser.add_argument('--latency-jitter', type=float, default=0.25)
+        parser.add_argument('--latency-distribution', choices=('fixed', 'uniform', 'lognormal'), default='lognormal')
+        parser.add_argument('--latency-per-mb', type=float, default=0.0,
+                            help="Stub latency added per MB of request body, in seconds.")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Share of stub responses that are errors.")
+        parser.add_argument('--error-status', type=int, default=503)
+        parser.add_argument('--response-fields', type=int, default=10, help="Fields in each stub extraction.")
+        parser.add_argument('--api-keys', type=int, default=1, help="Fake API keys rotated by the scheduler.")
+        parser.add_argument('--quota-rpm', type=int, default=None, help="Stub quota: requests per period and key.")
+        parser.add_argument('--quota-tpm', type=int, default=None, help="Stub quota: prompt tokens per period and key.")
+        parser.add_argument('--quota-concurrency', type=int, default=None, help="Stub quota: requests in flight per key.")
+        parser.add_argument('--quota-period', type=float, default=60.0, help="Stub quota window in seconds.")
+        parser.add_argument('--no-client-limits', action='store_true',
+                            help="Do not give the scheduler the stub quotas (AIMD and 429 handling only).")
+        parser.add_argument('--result-rows', type=int, default=10000, help="Rows for the result file benchmark.")
+        parser.add_argument('--format', default='csv', help="Result format for result file and views benchmarks.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skip-views', action='store_true', help="Skip the upload/worker/download benchmark.")
+        parser.add_argument('--output', help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        report = {
+            'benchmark': 'pipeline',
+            'environment': environment_info(),
+            'options': {k: v for k, v in options.items() if k not in ('verbosity', 'settings', 'pythonpath',
+                                                                      'traceback', 'no_color', 'force_color',
+                                                                      'skip_checks')},
+        }
+        documents = synthetic_documents(options['documents'], seed=options['seed'], pdf_ratio=options['pdf_ratio'],
+                                        max_pages=options['max_pages'])
+        report['input'] = {
+            'documents': len(documents),
+            'total_bytes': sum(len(data) for _, data in documents),
+        }
+
+        stub = GeminiStubServer(
+            latency=options['latency'],
+            latency_jitter=options['latency_jitter'],
+            latency_distribution=options['latency_distribution'],
+            latency_per_mb=options['latency_per_mb'],
+            error_rate=options['error_rate'],
+            error_status=options['error_status'],
+            response_fields=options['response_fields'],
+            seed=options['seed'],
+            requests_per_minute=options['quota_rpm'],
+            tokens_per_minute=options['quota_tpm'],
+            max_concurrent=options['quota_concurrency'],
+            quota_period=options['quota_period'],
+        )
+        client_limits = not options['no_client_limits']
+        scheduler = gemini_parser.GeminiScheduler(
+            [f'bench-key-{index}' for index in range(max(options['api_keys'], 1))],
+            requests_per_minute=(options['quota_rpm'] or 0) if client_limits else 0,
+            tokens_per_minute=(options['quota_tpm'] or 0) if client_limits else 0,
+            period=options['quota_period'],
+        )
+        created_docs, created_batches, created_users = [], [], []
+        original_endpoint, original_scheduler = gemini_parser.GEMINI_ENDPOINT, gemini_parser._scheduler
+        original_split = gemini_parser.GEMINI_SPLIT_DOCUMENTS
+        # Every run must reach the stub, so the extraction cache is bypassed
+        with stub, override_settings(GEMINI_CACHE_ENABLED=False):
+            gemini_parser.GEMINI_ENDPOINT, gemini_parser._scheduler = stub.url, scheduler
+            gemini_parser.GEMINI_SPLIT_DOCUMENTS = options['split']
+            try:
+                for file_name, data in documents:
+                    doc = UserDocument()
+                    doc.file.put(data, filename=file_name)
+                    doc.save()
+                    created_docs.append(doc)
+                report['extraction'], rows = self.bench_extraction(created_docs, options['concurrency'])
+                report['result_file'] = self.bench_result_file(rows, options['result_rows'], options['format'],
+                                                               created_batches)
+                if not options['skip_views']:
+                    report['views'] = self.bench_views(documents, options['format'], created_docs,
+                                                       created_batches, created_users)
+            finally:
+                gemini_parser.GEMINI_ENDPOINT, gemini_parser._scheduler = original_endpoint, original_scheduler
+                gemini_parser.GEMINI_SPLIT_DOCUMENTS = original_split
+                self.cleanup(created_docs, created_batches, created_users)
+        report['stub'] = {'requests': stub.request_count, 'connections': stub.connection_count,
+                          'throttled': stub.throttled_count}
+        report['scheduler'] = {'concurrency_limits': [slot.concurrency.limit for slot in scheduler.slots]}
+        report['peak_rss_mb'] = round(peak_rss_mb(), 1)
+
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+
+    def bench_extraction(self, docs, concurrency):
+        stopwatch = Stopwatch()
+        original = views.extract_document_data
+        views.extract_document_data = stopwatch.wrap(original)
+        try:
+            started = time.perf_counter()
+            rows = views.process_documents_with_gemini(docs, ['invoice_number', 'total', 'date'], False,
+                                                       concurrency=concurrency, pack=False)
+            wall = time.perf_counter() - started
+        finally:
+            views.extract_document_data = original
+        return {
+            'wall_seconds': wall,
+            'docs_per_second': len(docs) / wall if wall else None,
+            'empty_rows': sum(1 for row in rows if not row),
+            'document_latency': latency_summary(stopwatch.samples),
+        }, rows
+
+    def bench_result_file(self, rows, row_count, result_format, created_batches):
+        template = [row for row in rows if row] or [{'field_0': 'value_0'}]
+        all_data = [dict(template[i % len(template)], row=i) for i in range(row_count)]
+
+        started = time.perf_counter()
+        _, content = views.generate_result_file('bench', all_data, result_format)
+        in_memory = time.perf_counter() - started
+
+        batch = DocumentBatch(user='bench', result_format=result_format)
+        started = time.perf_counter()
+        _, size = views.write_result_file(batch.result_file, f'bench.{result_format}',
+                                          views.iter_result_chunks(all_data, result_format))
+        streamed = time.perf_counter() - started
+        created_batches.append(batch)
+        return {
+            'rows': row_count,
+            'format': result_format,
+            'bytes': size,
+            'generate_seconds': in_memory,
+            'gridfs_write_seconds': streamed,
+            'rows_per_second': row_count / streamed if streamed else None,
+        }
+
+    def bench_views(self, documents, result_format, created_docs, created_batches, created_users):
+        password = uuid.uuid4().hex
+        user = CustomUser(username=f'bench-{uuid.uuid4().hex[:12]}', email=f'{uuid.uuid4().hex[:12]}@bench.invalid',
+                          password_hash=make_password(password))
+        user.save()
+        created_users.append(user)
+        client = Client()
+        client.post('/login/', {'email': user.email, 'password': password})
+
+        files = [SimpleUploadedFile(name, data) for name, data in documents]
+        started = time.perf_counter()
+        response = client.post('/parser/', {
+            'documents': files,
+            'custom_fields[]': ['invoice_number', 'total', 'date'],
+            'result_format': result_format,
+        })
+        upload_seconds = time.perf_counter() - started
+        if response.status_code != 302:
+            raise RuntimeError(f"Upload failed with status {response.status_code}")
+        batch_id = response['Location'].rstrip('/').split('/')[-1]
+        batch = DocumentBatch.objects(id=batch_id).modify(set__status='processing', new=True)
+        created_batches.append(batch)
+        created_docs.extend(batch.documents)
+
+        started = time.perf_counter()
+        jobs.run_batch(batch)
+        worker_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        response = client.get(f'/parser/download/{batch_id}/{result_format}/')
+        downloaded = sum(len(chunk) for chunk in response.streaming_content)
+        download_seconds = time.perf_counter() - started
+        return {
+            'upload_seconds': upload_seconds,
+            'worker_seconds': worker_seconds,
+            'worker_docs_per_second': len(documents) / worker_seconds if worker_seconds else None,
+            'download_seconds': download_seconds,
+            'download_bytes': downloaded,
+            'batch_status': batch.status,
+        }
+
+    def cleanup(self, docs, batches, users):
+        for doc in docs:
+            if doc.pk:
+                doc.delete()  # also deletes or releases its GridFS file
+        for batch in batches:
+            for field in (batch.result_file, batch.rows_file):
+                if field:
+                    field.delete()
+            if batch.pk:
+                batch.delete()
+        for user in users:
+            user.delete()
+
+    def print_report(self, report):
+        extraction = report['extraction']
+        latency = extraction['document_latency']
+        self.stdout.write(f"Documents:       {report['input']['documents']} ({report['input']['total_bytes']} bytes)")
+        self.stdout.write(f"Extraction:      {extraction['docs_per_second']:.2f} docs/s, "
+                          f"wall {extraction['wall_seconds']:.2f}s, empty rows {extraction['empty_rows']}")
+        if latency['count']:
+            self.stdout.write(f"Doc latency:     p50 {latency['p50'] * 1000:.0f} ms, p95 {latency['p95'] * 1000:.0f} ms, "
+                              f"p99 {latency['p99'] * 1000:.0f} ms")
+        result = report['result_file']
+        self.stdout.write(f"Result file:     {result['rows']} {result['format']} rows, "
+                          f"{result['rows_per_second']:.0f} rows/s into GridFS ({result['bytes']} bytes)")
+        if 'views' in report:
+            v = report['views']
+            self.stdout.write(f"Views:           upload {v['upload_seconds']:.2f}s, worker {v['worker_seconds']:.2f}s "
+                              f"({v['worker_docs_per_second']:.2f} docs/s), download {v['download_seconds']:.3f}s")
+        self.stdout.write(f"Stub:            {report['stub']['requests']} requests over "
+                          f"{report['stub']['connections']} connections, {report['stub']['throttled']} throttled (429)")
+        self.stdout.write(f"Peak RSS:        {report['peak_rss_mb']} MB")
@@ -0,0 +1,97 @@
+import json
+import random
+import time
+
+from django.contrib.sessions.backends.signed_cookies import SessionStore as CookieSessionStore
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from parser import session_backend
+from parser.benchmarks import environment_info, latency_summary
+from parser.models import UserSession
+
+
+class Command(BaseCommand):
+    help = ("Benchmark session lookups: MongoDB session engine with and without its in-process cache, "
+            "against signed cookies.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=200, help="Sessions created for the run.")
+        parser.add_argument('--lookups', type=int, default=5000, help="Session loads per scenario.")
+        parser.add_argument('--cache-entries', type=int, default=None,
+                            help="Cache size; defaults to SESSION_CACHE_MAX_ENTRIES. Smaller than --sessions "
+                                 "shows the cost of evictions.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        report = {
+            'benchmark': 'sessions',
+            'environment': environment_info(),
+            'options': {key: options[key] for key in ('sessions', 'lookups', 'cache_entries', 'seed')},
+        }
+        keys = []
+        try:
+            create = []
+            for index in range(options['sessions']):
+                store = session_backend.SessionStore()
+                store['user_id'] = f'bench-{index}'
+                store['username'] = f'bench user {index}'
+                started = time.perf_counter()
+                store.create()
+                create.append(time.perf_counter() - started)
+                keys.append(store.session_key)
+            report['create'] = latency_summary(create)
+            picks = [rng.choice(keys) for _ in range(options['lookups'])]
+
+            report['database'] = self.bench_loads(picks, cache_ttl=0, cache_entries=0)
+            cache_entries = options['cache_entries']
+            report['cached'] = self.bench_loads(picks, cache_ttl=3600, cache_entries=cache_entries)
+
+            cookies = []
+            for index in range(options['sessions']):
+                store = CookieSessionStore()
+                store['user_id'] = f'bench-{index}'
+                store.save()
+                cookies.append(store.session_key)
+            report['signed_cookies'] = self.bench_loads([rng.choice(cookies) for _ in picks],
+                                                        store_class=CookieSessionStore)
+        finally:
+            UserSession.objects(session_key__in=keys).delete()
+            session_backend._cache = None
+
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+
+    def bench_loads(self, keys, store_class=session_backend.SessionStore, cache_ttl=None, cache_entries=None):
+        # One new store per lookup, as SessionMiddleware creates one per request
+        overrides = {}
+        if cache_ttl is not None:
+            overrides['SESSION_CACHE_TTL'] = cache_ttl
+        if cache_entries is not None:
+            overrides['SESSION_CACHE_MAX_ENTRIES'] = cache_entries
+        with override_settings(**overrides):
+            session_backend._cache = None
+            samples, misses = [], 0
+            for key in keys:
+                started = time.perf_counter()
+                user_id = store_class(key).get('user_id')
+                samples.append(time.perf_counter() - started)
+                misses += user_id is None
+            session_backend._cache = None
+        summary = latency_summary(samples)
+        summary['lookups_per_second'] = len(samples) / sum(samples) if samples else None
+        summary['misses'] = misses
+        return summary
+
+    def print_report(self, report):
+        create = report['create']
+        self.stdout.write(f"Create:          {create['count']} sessions, p50 {create['p50'] * 1e3:.2f} ms")
+        for name in ('database', 'cached', 'signed_cookies'):
+            latency = report[name]
+            self.stdout.write(f"{name + ':':<17}p50 {latency['p50'] * 1e6:.0f} us, p99 {latency['p99'] * 1e6:.0f} us, "
+                              f"{latency['lookups_per_second']:.0f} lookups/s, {latency['misses']} misses")
@@ -0,0 +1,166 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from parser.benchmarks import environment_info, latency_summary
+
+# Runs in a fresh interpreter for every sample: a cold start can't be measured in this process,
+# where Django and every module are already loaded.
+PROBE = r'''
+import json, os, sys, time
+started = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'visionparse_admin.settings')
+import django
+from django.conf import settings
+settings.INSTALLED_APPS  # reads the settings module
+settings_loaded = time.perf_counter()
+django.setup()
+setup_done = time.perf_counter()
+from visionparse_admin.wsgi import application
+application_loaded = time.perf_counter()
+wait = json.loads(sys.argv[2])
+warm_up = None
+if wait:
+    from parser import startup
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        state = startup._state.get(os.getpid())
+        if state is None or state['finished'] is not None:
+            break
+        time.sleep(0.01)
+    state = startup._state.get(os.getpid())
+    warm_up = state and {'finished': state['finished'] is not None, 'error': state['error'], 'steps': state['steps']}
+from django.test import Client
+from django.test.utils import setup_test_environment
+setup_test_environment()
+client = Client()
+requests = {}
+for path in json.loads(sys.argv[1]):
+    timings, statuses = [], []
+    for _ in range(2):
+        request_started = time.perf_counter()
+        response = client.get(path)
+        if getattr(response, 'streaming', False):
+            b''.join(response.streaming_content)
+        timings.append(time.perf_counter() - request_started)
+        statuses.append(response.status_code)
+    requests[path] = {'first': timings[0], 'second': timings[1], 'status': statuses[0]}
+from mongoengine import connection
+heavy = ('openpyxl', 'PIL.Image', 'httpx', 'reportlab.pdfgen.canvas', 'pymongo')
+print(json.dumps({
+    'settings_seconds': settings_loaded - started,
+    'setup_seconds': setup_done - settings_loaded,
+    'application_seconds': application_loaded - setup_done,
+    'ready_seconds': application_loaded - started,
+    'requests': requests,
+    'warm_up': warm_up,
+    'loaded_modules': len(sys.modules),
+    'heavy_modules_loaded': [name for name in heavy if name in sys.modules],
+    'mongo_connected': bool(connection._connections),
+}))
+'''
+
+
+def parse_importtime(stderr, top):
+    # `-X importtime` lines: "import time: self [us] | cumulative | imported package"
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative_us, name = line.split(':', 1)[1].split('|')
+        if name.startswith('  '):
+            continue  # imported by another module; counted in its parent's cumulative time
+        modules.append((name.strip(), int(cumulative_us)))
+    modules.sort(key=lambda item: item[1], reverse=True)
+    return [{'module': name, 'cumulative_ms': round(us / 1000, 1)} for name, us in modules[:top]]
+
+
+class Command(BaseCommand):
+    help = ("Benchmark cold start: for fresh interpreters, time settings, django.setup(), loading the WSGI "
+            "application and the first and second request to a few pages.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters started.")
+        parser.add_argument('--paths', default='/,/hello-world/,/login/,/healthz/',
+                            help="Comma-separated paths requested twice in each run.")
+        parser.add_argument('--warm-up', action='store_true',
+                            help="Run with WARM_UP_ON_START and wait for the warm-up before the requests.")
+        parser.add_argument('--warm-up-timeout', type=float, default=30.0)
+        parser.add_argument('--importtime', type=int, default=0, metavar='N',
+                            help="Also report the N slowest imports (python -X importtime) of the first run.")
+        parser.add_argument('--output', help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        paths = [path.strip() for path in options['paths'].split(',') if path.strip()]
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'visionparse_admin.settings'),
+                   WARM_UP_ON_START='True' if options['warm_up'] else 'False')
+        wait = options['warm_up_timeout'] if options['warm_up'] else 0
+        report = {
+            'benchmark': 'startup',
+            'environment': environment_info(),
+            'options': {'runs': options['runs'], 'paths': paths, 'warm_up': options['warm_up']},
+        }
+
+        runs = []
+        for index in range(max(options['runs'], 1)):
+            command = [sys.executable]
+            if index == 0 and options['importtime']:
+                command += ['-X', 'importtime']
+            command += ['-c', PROBE, json.dumps(paths), json.dumps(wait)]
+            started = time.perf_counter()
+            result = subprocess.run(command, cwd=settings.BASE_DIR, env=env, capture_output=True, text=True)
+            wall = time.perf_counter() - started
+            if result.returncode != 0:
+                raise CommandError(f"Probe failed:\n{result.stderr[-2000:]}")
+            run = json.loads(result.stdout.strip().splitlines()[-1])
+            run['process_seconds'] = wall
+            runs.append(run)
+            if index == 0 and options['importtime']:
+                report['slowest_imports'] = parse_importtime(result.stderr, options['importtime'])
+
+        report['runs'] = runs
+        report['summary'] = {
+            key: latency_summary([run[key] for run in runs])
+            for key in ('process_seconds', 'ready_seconds', 'setup_seconds', 'application_seconds')
+        }
+        report['summary']['requests'] = {
+            path: {
+                'first': latency_summary([run['requests'][path]['first'] for run in runs]),
+                'second': latency_summary([run['requests'][path]['second'] for run in runs]),
+            }
+            for path in paths
+        }
+
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+
+    def print_report(self, report):
+        summary = report['summary']
+        last = report['runs'][-1]
+        self.stdout.write(f"Runs:            {len(report['runs'])}, warm-up {'on' if report['options']['warm_up'] else 'off'}")
+        self.stdout.write(f"Process:         p50 {summary['process_seconds']['p50'] * 1000:.0f} ms "
+                          f"(interpreter start to exit)")
+        self.stdout.write(f"Ready:           p50 {summary['ready_seconds']['p50'] * 1000:.0f} ms "
+                          f"(setup {summary['setup_seconds']['p50'] * 1000:.0f} ms, "
+                          f"application {summary['application_seconds']['p50'] * 1000:.0f} ms)")
+        for path, timings in summary['requests'].items():
+            self.stdout.write(f"GET {path:<13} first p50 {timings['first']['p50'] * 1000:.1f} ms, "
+                              f"second p50 {timings['second']['p50'] * 1000:.1f} ms "
+                              f"(status {last['requests'][path]['status']})")
+        self.stdout.write(f"Modules:         {last['loaded_modules']} loaded, heavy: "
+                          f"{', '.join(last['heavy_modules_loaded']) or 'none'}; "
+                          f"MongoDB client {'created' if last['mongo_connected'] else 'not created'}")
+        if last['warm_up']:
+            steps = ', '.join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in last['warm_up']['steps'].items())
+            self.stdout.write(f"Warm-up:         {steps}" + (f" ({last['warm_up']['error']})"
+                                                            if last['warm_up']['error'] else ''))
+        for entry in report.get('slowest_imports', []):
+            self.stdout.write(f"  import {entry['module']:<40} {entry['cumulative_ms']:>8.1f} ms")
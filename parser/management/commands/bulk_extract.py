@@ -0,0 +1,95 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from parser.bulk import CsvOutput, NdjsonOutput, is_done, iter_input_files, load_manifest, run_bulk_extraction
+from parser.views import ALLOWED_FILE_TYPES, build_gemini_prompt
+
+OUTPUTS = {'ndjson': NdjsonOutput, 'csv': CsvOutput}
+
+
+class Command(BaseCommand):
+    help = ("Extract a directory or glob of scanned documents offline, appending one row per file to an "
+            "NDJSON or CSV file. Re-running with the same output skips files that were already extracted.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('inputs', nargs='+', help="Directories or glob patterns (quote them).")
+        parser.add_argument('--output', '-o', required=True, help="File the rows are appended to.")
+        parser.add_argument('--format', choices=tuple(OUTPUTS), default=None,
+                            help="Output format; defaults to the output file extension, else ndjson.")
+        parser.add_argument('--manifest', default=None,
+                            help="Progress manifest (NDJSON); defaults to <output>.manifest.")
+        parser.add_argument('--recursive', '-r', action='store_true',
+                            help="Descend into subdirectories (and let ** match them in globs).")
+        parser.add_argument('--fields', default='',
+                            help="Comma-separated fields to extract, as in the upload form's custom fields.")
+        parser.add_argument('--strict', action='store_true', help="Extract only --fields, as strict mode does.")
+        parser.add_argument('--executor', choices=('process', 'thread'), default='process',
+                            help="Worker processes (base64/JSON work on several cores) or threads in this process.")
+        parser.add_argument('--concurrency', '-j', type=int, default=None,
+                            help="Files extracted at once. Defaults to GEMINI_CONCURRENCY.")
+        parser.add_argument('--no-cache', action='store_true', help="Do not use the extraction cache.")
+        parser.add_argument('--progress-interval', type=float, default=5.0, help="Seconds between progress lines.")
+
+    def handle(self, *args, **options):
+        output_path = options['output']
+        result_format = options['format'] or os.path.splitext(output_path)[1].lstrip('.').lower()
+        if result_format not in OUTPUTS:
+            result_format = 'ndjson'
+        manifest_path = options['manifest'] or f'{output_path}.manifest'
+        custom_fields = [field.strip() for field in options['fields'].split(',') if field.strip()]
+        if options['strict'] and not custom_fields:
+            raise CommandError("--strict needs --fields.")
+        workers = max(options['concurrency'] or settings.GEMINI_CONCURRENCY, 1)
+
+        manifest = load_manifest(manifest_path)
+        paths, skipped = [], 0
+        for path in iter_input_files(options['inputs'], ALLOWED_FILE_TYPES, options['recursive']):
+            if is_done(manifest, path):
+                skipped += 1
+            else:
+                paths.append(path)
+        if not paths:
+            self.stdout.write(self.style.SUCCESS(f"Nothing to do ({skipped} file(s) already extracted)."))
+            return
+        self.stdout.write(f"Extracting {len(paths)} file(s) with {workers} {options['executor']} worker(s); "
+                          f"{skipped} already done.")
+
+        # Same prompt as a web batch with these options, so backfilled rows match uploaded ones
+        prompt = build_gemini_prompt(custom_fields, options['strict'])
+        output = CsvOutput(output_path, custom_fields) if result_format == 'csv' else NdjsonOutput(output_path)
+        stats = {'done': 0, 'empty': 0, 'failed': 0, 'bytes': 0}
+        started = last_report = time.perf_counter()
+        last_done = 0
+
+        def on_result(result):
+            nonlocal last_report, last_done
+            stats[result['status']] += 1
+            stats['bytes'] += os.path.getsize(result['path'])
+            if result['error']:
+                self.stderr.write(f"{result['path']}: {result['error']}")
+            now = time.perf_counter()
+            if now - last_report >= options['progress_interval']:
+                finished = stats['done'] + stats['empty'] + stats['failed']
+                rate = (finished - last_done) / (now - last_report)
+                overall = finished / (now - started)
+                eta = (len(paths) - finished) / overall if overall else 0
+                self.stdout.write(f"{finished}/{len(paths)} files, {stats['empty']} empty, {stats['failed']} failed | "
+                                  f"{rate:.1f} files/s now, {overall:.1f} files/s overall, "
+                                  f"{stats['bytes'] / (now - started) / 1e6:.2f} MB/s | ETA {eta:.0f}s")
+                last_report, last_done = now, finished
+
+        try:
+            run_bulk_extraction(paths, prompt, output, manifest_path, executor=options['executor'],
+                                workers=workers, use_cache=not options['no_cache'], on_result=on_result)
+        except KeyboardInterrupt:
+            self.stderr.write("Interrupted; run the same command again to continue.")
+        finally:
+            output.close()
+        elapsed = time.perf_counter() - started
+        finished = stats['done'] + stats['empty'] + stats['failed']
+        self.stdout.write(self.style.SUCCESS(
+            f"Extracted {stats['done']} file(s), {stats['empty']} empty, {stats['failed']} failed, in {elapsed:.1f}s "
+            f"({finished / elapsed if elapsed else 0:.1f} files/s). Rows: {output_path}, manifest: {manifest_path}"))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from parser.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = "Run the batch extraction worker: picks up pending DocumentBatch records and processes them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help="Seconds to wait between polls when the queue is empty.")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain the pending queue and exit instead of polling forever.")
+        parser.add_argument('--async', dest='use_async', action='store_true',
+                            help="Extract with the asyncio client: up to GEMINI_ASYNC_CONCURRENCY requests "
+                                 "in flight on one event loop instead of GEMINI_CONCURRENCY threads.")
+
+    def handle(self, *args, **options):
+        processed = run_worker(poll_interval=options['poll_interval'], once=options['once'],
+                               use_async=options['use_async'])
+        if options['once']:
+            self.stdout.write(self.style.SUCCESS(f"Processed {processed} batch(es)."))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from parser.jobs import resume_batch
+from parser.models import DocumentBatch
+
+
+class Command(BaseCommand):
+    help = ("Re-queue failed or stalled batches. Documents extracted before the failure are kept "
+            "and only the unfinished ones are sent to Gemini again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('batch_ids', nargs='*', help="Batches to resume.")
+        parser.add_argument('--all-failed', action='store_true', help="Resume every failed batch.")
+
+    def handle(self, *args, **options):
+        batch_ids = list(options['batch_ids'])
+        if options['all_failed']:
+            batch_ids += [str(batch.id) for batch in DocumentBatch.objects(status='failed').only('id')]
+        if not batch_ids:
+            raise CommandError("Pass batch ids or --all-failed.")
+        resumed = 0
+        for batch_id in batch_ids:
+            if resume_batch(batch_id) is None:
+                self.stderr.write(f"{batch_id}: not found, or not failed/stalled")
+            else:
+                resumed += 1
+        self.stdout.write(self.style.SUCCESS(f"Resumed {resumed} batch(es)."))
@@ -0,0 +1,176 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# =========================
+# In-process metrics for the extraction pipeline
+# =========================
+# Minimal counters and histograms rendered in the Prometheus text format by the
+# /parser/metrics/ endpoint. Values are per process: with several gunicorn
+# workers each one reports its own numbers, so scrape every worker.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            yield f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}  # labelvalues -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state[-1] if state else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        for labelvalues, state in items:
+            for bound, bucket_count in zip(self.buckets, state):
+                labels = _format_labels(self.labelnames, labelvalues, ('le', _format_value(bound)))
+                yield f'{self.name}_bucket{labels} {bucket_count}'
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f'{self.name}_sum{labels} {_format_value(state[-2])}'
+            yield f'{self.name}_count{labels} {state[-1]}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Stages: hash, gridfs_read, preprocess, split, encode, api_call, parse, merge, result_write.
+# api_call covers the whole HTTP round trip, including uploading the streamed body.
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'visionparse_stage_seconds', 'Latency of extraction pipeline stages.', ['stage']))
+PAYLOAD_BYTES = REGISTRY.register(Histogram(
+    'visionparse_gemini_payload_bytes', 'Size of generateContent request bodies.', buckets=BYTES_BUCKETS))
+RESULT_BYTES = REGISTRY.register(Histogram(
+    'visionparse_result_file_bytes', 'Size of stored batch result files.', ['format'], buckets=BYTES_BUCKETS))
+GEMINI_TOKENS = REGISTRY.register(Counter(
+    'visionparse_gemini_tokens_total', 'Tokens reported in usageMetadata.', ['type']))
+GEMINI_RESPONSES = REGISTRY.register(Counter(
+    'visionparse_gemini_responses_total', 'Gemini API responses by HTTP status.', ['status']))
+EXTRACTION_ERRORS = REGISTRY.register(Counter(
+    'visionparse_extraction_errors_total', 'Failed document extractions by reason.', ['reason']))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'visionparse_extraction_cache_lookups_total', 'Extraction cache lookups.', ['result']))
+PREPROCESS_SAVED_BYTES = REGISTRY.register(Counter(
+    'visionparse_preprocess_saved_bytes_total', 'Bytes removed from uploads by image pre-processing.'))
+DOCUMENTS_EXTRACTED = REGISTRY.register(Counter(
+    'visionparse_documents_extracted_total', 'Documents run through extraction.', ['outcome']))
+GEMINI_THROTTLED = REGISTRY.register(Counter(
+    'visionparse_gemini_throttled_total', 'Requests rejected with 429 by the Gemini API.', ['key']))
+GEMINI_SCHEDULER_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'visionparse_gemini_scheduler_wait_seconds', 'Time requests waited for rate limits and concurrency slots.'))
+GEMINI_CONCURRENCY_LIMIT = REGISTRY.register(Gauge(
+    'visionparse_gemini_concurrency_limit', 'Current adaptive concurrency limit per API key.', ['key']))
+BLOB_UPLOADS = REGISTRY.register(Counter(
+    'visionparse_blob_uploads_total', 'Uploaded files by blob store outcome (stored or deduplicated).', ['result']))
+BLOB_DEDUPLICATED_BYTES = REGISTRY.register(Counter(
+    'visionparse_blob_deduplicated_bytes_total', 'Upload bytes not written to GridFS because the content was already stored.'))
+WARM_UP_SECONDS = REGISTRY.register(Gauge(
+    'visionparse_warm_up_seconds', 'Duration of each warm-up step when this worker started.', ['step']))
+SESSION_LOOKUPS = REGISTRY.register(Counter(
+    'visionparse_session_lookups_total', 'Session loads by source (cache, database or miss).', ['result']))
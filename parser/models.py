@@ -2,34 +2,114 @@
 # from django.contrib.auth.models import User
 # from django.db import models
 # from djongo import models as djongo_models
-from mongoengine import Document as MongoDocument, StringField, DateTimeField, BooleanField, FileField, ListField, ReferenceField, EmailField
+from mongoengine import Document as MongoDocument, StringField, DateTimeField, BooleanField, FileField, ListField, ReferenceField, EmailField, IntField, DictField, DynamicField
 import datetime
 
+class FileBlob(MongoDocument):
+    # Content-addressed GridFS file shared by every UserDocument with the same bytes
+    sha256 = StringField(required=True, unique=True)
+    file = FileField()
+    size = IntField(default=0)
+    ref_count = IntField(default=0)
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+    last_referenced_at = DateTimeField(default=datetime.datetime.utcnow)
+
+    meta = {'collection': 'file_blobs'}
+
 class UserDocument(MongoDocument):
-    file = FileField(required=True)
+    file = FileField(required=True)  # the FileBlob's GridFS file when file_hash is set
     file_name = StringField(max_length=255)
     file_type = StringField(max_length=10)
+    file_hash = StringField()  # sha256 of the content; empty for documents stored before blobs
     uploaded_at = DateTimeField(default=datetime.datetime.utcnow)
     is_processed = BooleanField(default=False)
+    # Checkpoint written by the worker as soon as this document's extraction succeeds
+    extracted_data = DynamicField()
+    processed_at = DateTimeField()
 
-    meta = {'collection': 'user_documents'}
+    meta = {
+        'collection': 'user_documents',
+        'indexes': ['file_hash'],
+    }
 
     def clean(self):
-        if self.file:
+        # A shared blob keeps the name of its first upload, so an explicit file_name wins
+        if self.file and not self.file_name:
             self.file_name = getattr(self.file, 'name', '') or ''
-            self.file_type = self.file_name.split('.')[-1].lower() if self.file_name else ''
+        self.file_type = self.file_name.split('.')[-1].lower() if self.file_name else ''
+
+    def delete(self, *args, **kwargs):
+        if not self.file_hash:
+            return super().delete(*args, **kwargs)  # owns its GridFS file
+        from .blob_store import release_blob  # blob_store imports this module
+
+        # Deleting through the queryset leaves the shared GridFS file alone
+        UserDocument.objects(id=self.id).delete()
+        release_blob(self.file_hash)
 
 class DocumentBatch(MongoDocument):
     documents = ListField(ReferenceField(UserDocument))
     result_file = FileField()
+    rows_file = FileField()  # canonical extracted rows (NDJSON); other download formats are derived from it
     custom_fields = ListField(StringField())
     strict_mode = BooleanField(default=False)
-    result_format = StringField(choices=('csv', 'json'))
+    result_format = StringField(choices=('csv', 'json', 'ndjson', 'xlsx'))
+    result_compressed = BooleanField(default=False)  # result_file is stored gzipped
     status = StringField(choices=('pending', 'processing', 'completed', 'failed'), default='pending')
     created_at = DateTimeField(default=datetime.datetime.utcnow)
+    started_at = DateTimeField()
+    finished_at = DateTimeField()
+    error = StringField()
     user = StringField(required=True)  # user_id from CustomUser
+    # Denormalized summary so batch lists never dereference `documents`
+    document_count = IntField(default=0)
+    file_names = ListField(StringField())
+    result_size = IntField()
+    # Per-document progress written by the worker as each extraction finishes (streamed by batch_events)
+    processed_count = IntField(default=0)
+    progress = ListField(DictField())
+    # Lease of the worker processing the batch; a stale heartbeat lets another worker re-claim it
+    claim_token = StringField()
+    heartbeat_at = DateTimeField()
+    attempts = IntField(default=0)
+
+    meta = {
+        'collection': 'document_batches',
+        'indexes': [
+            ('status', 'created_at'),  # worker queue: oldest pending first
+            ('status', 'heartbeat_at'),  # stale processing batches
+            ('user', '-created_at', '-id'),  # per-user history, newest first (cursor pagination)
+        ],
+    }
+
+    # Fields needed to render a batch in a list; keeps `documents` out of the projection
+    SUMMARY_FIELDS = ('id', 'status', 'result_format', 'result_file', 'result_compressed', 'created_at',
+                      'started_at', 'finished_at', 'error', 'document_count', 'file_names', 'result_size',
+                      'processed_count')
+
+class ExtractedRow(MongoDocument):
+    # One extracted row per batch document, queried page by page by the batch_rows API
+    batch = ReferenceField(DocumentBatch, required=True)
+    user = StringField(required=True)  # user_id from CustomUser, copied from the batch
+    document = ReferenceField(UserDocument)
+    index = IntField(required=True)  # position of the document in the batch
+    file_name = StringField()
+    data = DictField()
+    # Typed values of the flattened fields: {key, text, number, currency, date} (see normalize.py)
+    values = ListField(DictField())
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
 
-    meta = {'collection': 'document_batches'}
+    meta = {
+        'collection': 'extracted_rows',
+        'indexes': [
+            {'fields': ('batch', 'index'), 'unique': True},  # rows of a batch in document order
+            ('user', '-created_at'),
+            'document',
+            # Cross-batch aggregation: a user's rows that have a numeric / dated field
+            ('user', 'values.key', 'values.number'),
+            ('user', 'values.key', 'values.date'),
+        ],
+    }
 
 class CustomUser(MongoDocument):
     username = StringField(required=True, unique=True, max_length=150)
@@ -38,3 +118,46 @@ class CustomUser(MongoDocument):
     created_at = DateTimeField(default=datetime.datetime.utcnow)
 
     meta = {'collection': 'custom_users'}
+
+class UserSession(MongoDocument):
+    # Server-side session (SESSION_ENGINE = 'parser.session_backend')
+    session_key = StringField(primary_key=True)
+    session_data = StringField()  # signed by SessionBase.encode
+    expire_date = DateTimeField(required=True)
+
+    meta = {
+        'collection': 'sessions',
+        'indexes': [
+            {'fields': ['expire_date'], 'expireAfterSeconds': 0},  # MongoDB TTL monitor drops expired sessions
+        ],
+    }
+
+class ExtractionCacheEntry(MongoDocument):
+    key = StringField(required=True, unique=True)  # sha256 of (file hash, prompt, endpoint)
+    file_hash = StringField(required=True)
+    prompt = StringField()
+    endpoint = StringField()
+    result = StringField()
+    size = IntField(default=0)  # UTF-8 bytes of result, counted against GEMINI_CACHE_MAX_BYTES
+    hits = IntField(default=0)
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+    last_used_at = DateTimeField(default=datetime.datetime.utcnow)
+    expires_at = DateTimeField()
+
+    meta = {
+        'collection': 'extraction_cache',
+        'indexes': [
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},  # MongoDB TTL monitor drops expired entries
+            'last_used_at',
+        ],
+    }
+
+class ExtractionCacheStats(MongoDocument):
+    name = StringField(primary_key=True)
+    hits = IntField(default=0)
+    misses = IntField(default=0)
+    stores = IntField(default=0)
+    evictions = IntField(default=0)
+    bytes = IntField(default=0)  # running total of ExtractionCacheEntry.size
+
+    meta = {'collection': 'extraction_cache_stats'}
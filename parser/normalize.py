@@ -0,0 +1,126 @@
+import datetime
+import re
+
+from django.conf import settings
+
+# =========================
+# Typed values of extracted fields
+# =========================
+# Gemini returns every value as whatever JSON it chose: "$1,234.50", "1.234,50 EUR",
+# "March 5, 2024", 12. When rows are stored, each flattened field is also
+# recorded as an entry {key, text, number, currency, date} in ExtractedRow.values
+# (attribute pattern), so one compound index covers every field and aggregation
+# pipelines can sum, group and bucket values across batches.
+
+MAX_TEXT_LENGTH = 256
+
+CURRENCY_SYMBOLS = {
+    '$': 'USD', 'US$': 'USD', '€': 'EUR', '£': 'GBP', '¥': 'JPY', '₹': 'INR', 'Rs': 'INR', 'Rs.': 'INR',
+    '₩': 'KRW', '₽': 'RUB', 'R$': 'BRL', 'A$': 'AUD', 'C$': 'CAD', 'CHF': 'CHF', 'Fr.': 'CHF',
+}
+CURRENCY_CODES = {
+    'AED', 'AUD', 'BRL', 'CAD', 'CHF', 'CNY', 'DKK', 'EUR', 'GBP', 'HKD', 'INR', 'JPY', 'KRW', 'MXN',
+    'NOK', 'NZD', 'PLN', 'RUB', 'SAR', 'SEK', 'SGD', 'USD', 'ZAR',
+}
+
+_CURRENCY = (r'(?P<{name}>' + '|'.join(re.escape(symbol) for symbol in sorted(CURRENCY_SYMBOLS, key=len, reverse=True))
+             + '|' + '|'.join(sorted(CURRENCY_CODES)) + ')')
+_AMOUNT_RE = re.compile(
+    r'^(?P<sign>[-+(])?\s*' + _CURRENCY.format(name='before') + r'?\s*(?P<minus>-)?\s*'
+    r'(?P<number>\d[\d,.\' ]*)\s*' + _CURRENCY.format(name='after') + r'?\s*\)?$',
+    re.IGNORECASE,
+)
+
+DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%d.%m.%Y', '%B %d, %Y', '%b %d, %Y', '%B %d %Y', '%b %d %Y',
+                '%d %B %Y', '%d %b %Y', '%d-%b-%Y', '%d %B, %Y')
+MONTH_FIRST_FORMATS = ('%m/%d/%Y', '%m-%d-%Y')
+DAY_FIRST_FORMATS = ('%d/%m/%Y', '%d-%m-%Y')
+
+def normalize_key(name):
+    # 'Invoice Total' and 'invoice_total' are the same field
+    return re.sub(r'[^0-9a-z.]+', '_', str(name).strip().lower()).strip('_')
+
+def _parse_number(digits):
+    digits = digits.replace(' ', '').replace("'", '')
+    if ',' in digits and '.' in digits:
+        # The separator that comes last is the decimal one
+        decimal = ',' if digits.rfind(',') > digits.rfind('.') else '.'
+        thousands = '.' if decimal == ',' else ','
+        digits = digits.replace(thousands, '').replace(decimal, '.')
+    elif ',' in digits:
+        groups = digits.split(',')
+        if len(groups) > 2 or all(len(group) == 3 for group in groups[1:]):
+            digits = digits.replace(',', '')  # 1,234 / 1,234,567
+        else:
+            digits = digits.replace(',', '.')  # 12,50
+    elif digits.count('.') > 1:
+        digits = digits.replace('.', '')  # 1.234.567
+    return float(digits)
+
+def parse_amount(text):
+    # Returns (number, currency code or None), or None when text is not an amount
+    match = _AMOUNT_RE.match(text.strip())
+    if not match or (match['sign'] == '(') != text.strip().endswith(')'):
+        return None
+    try:
+        number = _parse_number(match['number'])
+    except ValueError:
+        return None
+    if match['sign'] in ('-', '(') or match['minus']:
+        number = -number
+    symbol = match['before'] or match['after']
+    currency = None
+    if symbol:
+        currency = CURRENCY_SYMBOLS.get(symbol) or CURRENCY_SYMBOLS.get(symbol.capitalize()) or symbol.upper()
+    return number, currency
+
+def parse_date(text, day_first=None):
+    text = text.strip()
+    if day_first is None:
+        day_first = settings.NORMALIZE_DAY_FIRST
+    if text[4:5] == '-':  # fromisoformat would also read bare digits such as 20240305
+        try:
+            value = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+            return value.replace(tzinfo=None) - (value.utcoffset() or datetime.timedelta())
+        except ValueError:
+            pass
+    formats = DATE_FORMATS + (DAY_FIRST_FORMATS if day_first else MONTH_FIRST_FORMATS)
+    for date_format in formats:
+        try:
+            return datetime.datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    return None
+
+def normalize_value(key, value):
+    # One ExtractedRow.values entry, or None for values that carry nothing to aggregate
+    if value is None or value == '':
+        return None
+    entry = {'key': key}
+    if isinstance(value, bool):
+        entry['text'] = 'true' if value else 'false'
+    elif isinstance(value, (int, float)):
+        entry['number'] = float(value)
+    else:
+        text = ' '.join(str(value).split())
+        entry['text'] = text[:MAX_TEXT_LENGTH]
+        # Dates first: 05.03.2024 would otherwise read as a number with thousands separators
+        date = parse_date(text)
+        if date is not None:
+            entry['date'] = date
+            return entry
+        amount = parse_amount(text)
+        if amount is not None:
+            entry['number'], currency = amount
+            if currency:
+                entry['currency'] = currency
+    return entry
+
+def normalize_record(flat):
+    # flat: a flattened row ({'vendor.name': 'A', 'total': '$12.50'})
+    entries = []
+    for name, value in flat.items():
+        entry = normalize_value(normalize_key(name), value)
+        if entry is not None:
+            entries.append(entry)
+    return entries
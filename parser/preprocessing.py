@@ -0,0 +1,99 @@
+import logging
+import time
+from io import BytesIO
+
+
+# =========================
+# Image pre-processing before upload to Gemini
+# =========================
+# Phone photos and high-DPI scans are much larger than the model needs. Images
+# are rotated upright from their EXIF orientation, downscaled, optionally turned
+# grayscale and re-encoded; re-encoding also drops EXIF/ICC metadata.
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+    'PNG': 'image/png',
+}
+
+class PreprocessedImage:
+    def __init__(self, file, mime_type, original_bytes, processed_bytes, original_size, processed_size, seconds):
+        self.file = file
+        self.mime_type = mime_type
+        self.original_bytes = original_bytes
+        self.processed_bytes = processed_bytes
+        self.original_size = original_size
+        self.processed_size = processed_size
+        self.seconds = seconds
+
+    @property
+    def saved_bytes(self):
+        return self.original_bytes - self.processed_bytes
+
+    def as_dict(self):
+        return {
+            'mime_type': self.mime_type,
+            'original_bytes': self.original_bytes,
+            'processed_bytes': self.processed_bytes,
+            'saved_bytes': self.saved_bytes,
+            'original_size': self.original_size,
+            'processed_size': self.processed_size,
+            'seconds': round(self.seconds, 4),
+        }
+
+def preprocess_image(file_obj, max_dimension=2048, output_format='JPEG', quality=85, grayscale=False, original_bytes=None):
+    # Returns a PreprocessedImage, or None when the original should be sent unchanged
+    # (not an image, multi-frame, or re-encoding would not make it smaller).
+    output_format = output_format.upper()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported pre-processing format: {output_format}. Supported: {', '.join(OUTPUT_FORMATS)}")
+
+    from PIL import Image, ImageOps  # imported on first use; Pillow is slow to import
+
+    started = time.perf_counter()
+    file_obj.seek(0)
+    try:
+        image = Image.open(file_obj)
+        if getattr(image, 'n_frames', 1) > 1:
+            return None  # multi-page TIFF/GIF: keep every frame
+        original_size = image.size
+        if max_dimension:
+            # Let the JPEG decoder downscale by a power of two while decoding
+            image.draft('RGB', (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+        if max_dimension and max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if grayscale:
+            image = image.convert('L')
+        elif output_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = BytesIO()
+        save_options = {'optimize': True}
+        if output_format in ('JPEG', 'WEBP'):
+            save_options['quality'] = quality
+        image.save(out, format=output_format, **save_options)
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning("Skipping pre-processing, could not decode image", extra={'event': 'preprocess_skipped', 'error': str(e)})
+        return None
+    finally:
+        file_obj.seek(0)
+
+    if original_bytes is None:
+        file_obj.seek(0, 2)
+        original_bytes = file_obj.tell()
+        file_obj.seek(0)
+    processed_bytes = out.tell()
+    if processed_bytes >= original_bytes:
+        return None
+    out.seek(0)
+    return PreprocessedImage(
+        file=out,
+        mime_type=OUTPUT_FORMATS[output_format],
+        original_bytes=original_bytes,
+        processed_bytes=processed_bytes,
+        original_size=original_size,
+        processed_size=image.size,
+        seconds=time.perf_counter() - started,
+    )
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+# =========================
+# Client-side rate limiting primitives
+# =========================
+# TokenBucket paces requests and tokens against a per-period quota.
+# AdaptiveConcurrency caps requests in flight and adapts the cap with AIMD:
+# additive increase on success, multiplicative decrease on 429. Both are
+# shared by worker threads and asyncio code, so they lock with threading
+# primitives and never block the event loop themselves.
+
+class TokenBucket:
+    # `limit` units per `period` seconds. Only `headroom` of the limit is refilled
+    # steadily and the rest is the burst capacity, so no `period`-long window ever
+    # sees more than `limit` units (quotas are enforced over a sliding minute).
+    def __init__(self, limit, period=60.0, headroom=0.95):
+        self.limit = limit
+        self.period = period
+        self.rate = limit * headroom / period  # units per second
+        self.capacity = max(limit * (1 - headroom), 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount=1):
+        # Takes `amount` now and returns how long the caller must wait before using it.
+        # The balance may go negative, which makes later callers queue behind this one.
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= amount
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def wait_time(self, amount=1):
+        with self._lock:
+            self._refill(time.monotonic())
+            missing = amount - self._tokens
+            return 0.0 if missing <= 0 else missing / self.rate
+
+    def adjust(self, amount):
+        # Corrects an earlier reservation once the real cost is known (negative gives tokens back)
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+
+class _Waiter:
+    __slots__ = ('notify',)
+
+    def __init__(self, notify):
+        self.notify = notify
+
+
+class AdaptiveConcurrency:
+    def __init__(self, initial, minimum=1, maximum=100, increase=1.0, decrease=0.5, cooldown=1.0, probe=0.1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown  # 429s within this many seconds of a decrease count once
+        self.probe = probe  # share of `increase` used at or above the limit that last caused a 429
+        self._ceiling = None
+        self._limit = float(min(max(initial, minimum), maximum))
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _try_acquire(self):
+        if self._in_flight < int(self._limit):
+            self._in_flight += 1
+            return True
+        return False
+
+    def _wake(self):
+        # Hands free slots directly to waiters in arrival order
+        while self._waiters and self._in_flight < int(self._limit):
+            self._in_flight += 1
+            self._waiters.popleft().notify()
+
+    def acquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            event = threading.Event()
+            self._waiters.append(_Waiter(event.set))
+        event.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = _Waiter(notify)
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            self.release()  # a slot was handed over just as we were cancelled
+            raise
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._wake()
+
+    def on_success(self):
+        with self._lock:
+            # About +increase per limit's worth of successful requests; slower once
+            # back at the limit that was throttled last, so it is probed gently
+            step = self.increase / max(self._limit, 1.0)
+            if self._ceiling is not None and self._limit >= self._ceiling:
+                step *= self.probe
+            self._limit = min(self.maximum, self._limit + step)
+            self._wake()
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._ceiling = self._limit * 0.9 if self._ceiling is None else min(self._limit, self._ceiling)
+            self._limit = max(float(self.minimum), self._limit * self.decrease)
@@ -0,0 +1,154 @@
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError, SessionBase, UpdateError
+from mongoengine.errors import NotUniqueError
+
+from .metrics import SESSION_LOOKUPS
+from .models import UserSession
+
+# =========================
+# MongoDB session engine
+# =========================
+# SESSION_ENGINE = 'parser.session_backend'. Sessions live in the `sessions`
+# collection, where a TTL index on expire_date drops them once expired
+# (clear_expired is not needed). Every page checks request.session['user_id'],
+# so loads go through a per-process LRU of the encoded session data: a session
+# read within SESSION_CACHE_TTL seconds is served without a database round trip.
+# Writes and deletes made by this process update the cache right away; one made
+# by another worker (logout, say) is seen here at most SESSION_CACHE_TTL later.
+# SESSION_CACHE_TTL = 0 turns the cache off.
+
+class SessionCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # session_key -> (session_data, expire_date, cached_until)
+        self._lock = threading.Lock()
+
+    def get(self, session_key):
+        # (session_data, expire_date), or None when absent, stale or expired
+        with self._lock:
+            entry = self._entries.get(session_key)
+            if entry is None:
+                return None
+            session_data, expire_date, cached_until = entry
+            if cached_until < time.monotonic() or expire_date <= datetime.datetime.utcnow():
+                del self._entries[session_key]
+                return None
+            self._entries.move_to_end(session_key)
+            return session_data, expire_date
+
+    def set(self, session_key, session_data, expire_date):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[session_key] = (session_data, expire_date, time.monotonic() + self.ttl)
+            self._entries.move_to_end(session_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, session_key):
+        with self._lock:
+            self._entries.pop(session_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SessionCache(settings.SESSION_CACHE_MAX_ENTRIES, settings.SESSION_CACHE_TTL)
+    return _cache
+
+def _reset_after_fork():
+    global _cache, _cache_lock
+    _cache, _cache_lock = None, threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+class SessionStore(SessionBase):
+    def _expire_date(self):
+        # Naive UTC, as MongoDB returns dates; the TTL index compares against it
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=self.get_expiry_age())
+
+    def load(self):
+        cache = get_cache()
+        cached = cache.get(self.session_key) if self.session_key else None
+        if cached is not None:
+            SESSION_LOOKUPS.inc(result='cache')
+            return self.decode(cached[0])
+        session = None
+        if self.session_key:
+            # The TTL monitor only runs once a minute, so expired sessions are filtered here too
+            session = UserSession.objects(session_key=self.session_key,
+                                          expire_date__gt=datetime.datetime.utcnow()).first()
+        if session is None:
+            SESSION_LOOKUPS.inc(result='miss')
+            self._session_key = None
+            return {}
+        SESSION_LOOKUPS.inc(result='database')
+        cache.set(session.session_key, session.session_data, session.expire_date)
+        return self.decode(session.session_data)
+
+    def exists(self, session_key):
+        if not session_key:
+            return False
+        if get_cache().get(session_key) is not None:
+            return True
+        return UserSession.objects(session_key=session_key).only('session_key').first() is not None
+
+    def create(self):
+        while True:
+            self._session_key = self._get_new_session_key()
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue  # key collision: try another
+            self.modified = True
+            return
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        session_data = self.encode(self._get_session(no_load=must_create))
+        expire_date = self._expire_date()
+        if must_create:
+            try:
+                UserSession(session_key=self.session_key, session_data=session_data,
+                            expire_date=expire_date).save(force_insert=True)
+            except NotUniqueError:
+                raise CreateError
+        elif not UserSession.objects(session_key=self.session_key).update_one(
+                set__session_data=session_data, set__expire_date=expire_date):
+            # Deleted meanwhile (logout in another tab); SessionMiddleware reports it
+            get_cache().discard(self.session_key)
+            raise UpdateError
+        get_cache().set(self.session_key, session_data, expire_date)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        get_cache().discard(session_key)
+        UserSession.objects(session_key=session_key).delete()
+
+    @classmethod
+    def clear_expired(cls):
+        # For `manage.py clearsessions`; the TTL index normally gets there first
+        UserSession.objects(expire_date__lt=datetime.datetime.utcnow()).delete()
@@ -0,0 +1,238 @@
+import logging
+import re
+from io import BytesIO
+
+from .normalize import normalize_key, parse_amount
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# Page-level splitting of long documents
+# =========================
+# A 40-page statement sent as one inline_data part is the slowest request of
+# its batch and can exceed the request size limit. With GEMINI_SPLIT_DOCUMENTS,
+# PDFs and multi-frame TIFFs of at least GEMINI_SPLIT_MIN_PAGES pages are cut
+# into chunks of GEMINI_SPLIT_PAGES_PER_CHUNK pages. gemini_parser extracts the
+# chunks concurrently, cutting each one as a request slot frees up, and
+# merge_results folds the per-chunk JSON into one row.
+# PDF splitting uses pypdf (in requirements.txt); should it be missing, PDFs are sent whole.
+# TIFF frames are re-encoded as PNG (Gemini only reads the first frame of a TIFF),
+# one image part per page.
+
+MERGE_RULES = ('first', 'last', 'concat', 'sum', 'merge')
+
+class Chunk:
+    def __init__(self, parts, first_page, last_page):
+        self.parts = parts  # [(file_obj, mime_type)], in page order
+        self.first_page = first_page  # 1-based, inclusive
+        self.last_page = last_page
+
+class SplitError(Exception):
+    # A chunk could not be cut after splitting started; the document is then sent whole
+    pass
+
+def _page_ranges(total, pages_per_chunk):
+    pages_per_chunk = max(pages_per_chunk, 1)
+    return [(start, min(start + pages_per_chunk, total)) for start in range(0, total, pages_per_chunk)]
+
+def _pdf_chunks(file_obj, reader, ranges):
+    from pypdf import PdfWriter
+    from pypdf.errors import PyPdfError
+
+    try:
+        for start, end in ranges:
+            writer = PdfWriter()
+            for page in reader.pages[start:end]:
+                writer.add_page(page)
+            out = BytesIO()
+            writer.write(out)
+            out.seek(0)
+            yield Chunk([(out, 'application/pdf')], start + 1, end)
+    except (PyPdfError, ValueError, KeyError) as e:
+        logger.warning("Could not split PDF", extra={'event': 'split_failed', 'error': str(e)})
+        raise SplitError(str(e)) from e
+    finally:
+        file_obj.seek(0)
+
+def _split_pdf(file_obj, pages_per_chunk, min_pages):
+    try:
+        from pypdf import PdfReader
+        from pypdf.errors import PyPdfError
+    except ImportError:
+        logger.warning("pypdf is not installed; PDFs are not split", extra={'event': 'split_unavailable'})
+        return None
+    file_obj.seek(0)
+    try:
+        reader = PdfReader(file_obj)
+        if reader.is_encrypted and not reader.decrypt(''):
+            return None  # needs a password: Gemini gets the file as uploaded
+        total = len(reader.pages)
+    except (PyPdfError, ValueError, KeyError) as e:
+        logger.warning("Could not split PDF", extra={'event': 'split_failed', 'error': str(e)})
+        return None
+    finally:
+        file_obj.seek(0)
+    if total < max(min_pages, 2):
+        return None
+    return _pdf_chunks(file_obj, reader, _page_ranges(total, pages_per_chunk)), total
+
+def _tiff_chunks(file_obj, image, ranges):
+    try:
+        for start, end in ranges:
+            parts = []
+            for frame in range(start, end):
+                image.seek(frame)
+                page = image if image.mode in ('1', 'L', 'RGB', 'RGBA') else image.convert('RGB')
+                out = BytesIO()
+                page.save(out, format='PNG')
+                out.seek(0)
+                parts.append((out, 'image/png'))
+            yield Chunk(parts, start + 1, end)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not split TIFF", extra={'event': 'split_failed', 'error': str(e)})
+        raise SplitError(str(e)) from e
+    finally:
+        file_obj.seek(0)
+
+def _split_tiff(file_obj, pages_per_chunk, min_pages):
+    from PIL import Image
+
+    file_obj.seek(0)
+    try:
+        image = Image.open(file_obj)
+        total = getattr(image, 'n_frames', 1)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not split TIFF", extra={'event': 'split_failed', 'error': str(e)})
+        file_obj.seek(0)
+        return None
+    if total < max(min_pages, 2):
+        file_obj.seek(0)
+        return None
+    return _tiff_chunks(file_obj, image, _page_ranges(total, pages_per_chunk)), total
+
+# Page objects of a PDF; pages inside compressed object streams are not visible to it
+_PDF_PAGE = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+_SCAN_CHUNK_SIZE = 1 << 20
+
+def _scan_pdf_pages(file_obj):
+    count, tail = 0, b''
+    while True:
+        chunk = file_obj.read(_SCAN_CHUNK_SIZE)
+        data = tail + chunk
+        for match in _PDF_PAGE.finditer(data):
+            # Counted in the first buffer where it ends before the buffer does (the next
+            # bytes decide /Page from /Pages), or in the last one
+            if match.end() >= len(tail) and (match.end() < len(data) or not chunk):
+                count += 1
+        if not chunk:
+            return count
+        tail = data[-32:]
+
+def count_pdf_pages(file_obj):
+    # Page count of a PDF (pypdf when installed, else a scan for page objects); None when unknown
+    file_obj.seek(0)
+    try:
+        try:
+            from pypdf import PdfReader
+            from pypdf.errors import PyPdfError
+        except ImportError:
+            return _scan_pdf_pages(file_obj) or None
+        try:
+            return len(PdfReader(file_obj).pages) or None
+        except (PyPdfError, ValueError, KeyError):
+            return None
+    finally:
+        file_obj.seek(0)
+
+def split_document(file_obj, mime_type, pages_per_chunk, min_pages):
+    # (Chunk iterator, total pages), or None when the document is sent whole (short, unsupported,
+    # unreadable). Only the page count is read up front: each chunk is cut when the iterator
+    # is advanced, so a long document is never held in memory as chunks all at once. The
+    # iterator raises SplitError when a chunk can't be cut; close it when not exhausted.
+    if mime_type == 'application/pdf':
+        return _split_pdf(file_obj, pages_per_chunk, min_pages)
+    if mime_type == 'image/tiff':
+        return _split_tiff(file_obj, pages_per_chunk, min_pages)
+    return None
+
+def parse_merge_rules(spec):
+    # "line_items:concat, total:last" -> {'line_items': 'concat', 'total': 'last'}; keys may be dotted paths
+    rules = {}
+    for item in spec.split(',') if isinstance(spec, str) else spec:
+        if not item.strip():
+            continue
+        key, _, rule = item.rpartition(':')
+        rule = rule.strip().lower()
+        if not key.strip() or rule not in MERGE_RULES:
+            raise ValueError(f"Invalid merge rule {item.strip()!r}: expected <field>:<{'|'.join(MERGE_RULES)}>")
+        rules[normalize_key(key)] = rule
+    return rules
+
+def _is_empty(value):
+    return value is None or value == '' or value == [] or value == {}
+
+def _sum(values):
+    total, integral, counted = 0, True, 0
+    for value in values:
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, str):
+            amount = parse_amount(value)
+            if amount is None:
+                continue
+            value = amount[0]
+        if not isinstance(value, (int, float)):
+            continue
+        integral = integral and float(value).is_integer()
+        total += value
+        counted += 1
+    if not counted:
+        return values[0]  # nothing numeric to add up
+    return int(total) if integral else round(total, 10)
+
+def _merge_value(values, rule, rules, path):
+    if rule is None:
+        # Defaults: objects are merged field by field, lists concatenated, scalars taken from the first chunk
+        if all(isinstance(value, dict) for value in values):
+            rule = 'merge'
+        elif any(isinstance(value, list) for value in values):
+            rule = 'concat'
+        else:
+            rule = 'first'
+    if rule == 'merge' and all(isinstance(value, dict) for value in values):
+        return _merge_objects(values, rules, path)
+    if rule == 'concat':
+        merged = []
+        for value in values:
+            merged.extend(value if isinstance(value, list) else [value])
+        return merged
+    if rule == 'sum':
+        return _sum(values)
+    if rule == 'last':
+        return values[-1]
+    return values[0]
+
+def _merge_objects(objects, rules, path=''):
+    keys = []
+    for obj in objects:
+        keys.extend(key for key in obj if key not in keys)
+    merged = {}
+    for key in keys:
+        values = [obj[key] for obj in objects if not _is_empty(obj.get(key))]
+        if not values:
+            # Present but empty everywhere: keep the field, as a whole-document extraction would
+            merged[key] = next(obj[key] for obj in objects if key in obj)
+            continue
+        field = f'{path}{key}'
+        merged[key] = _merge_value(values, rules.get(normalize_key(field)), rules, f'{field}.')
+    return merged
+
+def merge_results(results, rules=None):
+    # results: the parsed JSON of each chunk, in page order. Returns the merged row, or
+    # None when the chunks can't be combined (a chunk answered with a scalar, say).
+    rules = rules or {}
+    if all(isinstance(result, dict) for result in results):
+        return _merge_objects(results, rules)
+    if all(isinstance(result, list) for result in results):
+        return [item for result in results for item in result]
+    return None
@@ -0,0 +1,145 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+
+from .metrics import WARM_UP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# Worker warm-up and readiness
+# =========================
+# Nothing expensive happens at import any more: the MongoDB client, the Gemini
+# HTTP session and the heavy libraries are created on first use. A fresh worker
+# would then pay for all of it on its first requests, so wsgi.py/asgi.py start
+# warm_up() in a background thread as the application loads (WARM_UP_ON_START).
+# A process forked from one that started it (gunicorn --preload) starts its own,
+# since connections are not inherited (see parser/db.py). /readyz/ answers 503
+# until this process's warm-up is done and while the database does not answer.
+
+# Libraries only loaded on first use (XLSX results, image pre-processing, async extraction)
+DEFERRED_IMPORTS = ('openpyxl', 'PIL.Image', 'httpx')
+TEMPLATES = ('core/home.html', 'parser/upload.html', 'parser/batch_result.html', 'registration/register.html')
+
+_state = {}  # pid -> {'started', 'finished', 'error', 'steps'}
+_lock = threading.Lock()
+_ping_executor = None
+_ping_future = None
+
+def _ensure_indexes():
+    # mongoengine creates a model's indexes on its first query; do it before traffic arrives
+    from mongoengine.base.common import _document_registry
+
+    for document in list(_document_registry.values()):
+        if not document._meta.get('abstract') and getattr(document, '_get_collection', None):
+            document._get_collection()
+
+def _load_urls():
+    from django.urls import get_resolver
+
+    get_resolver().reverse_dict  # imports every view module and compiles the patterns
+
+def _load_templates():
+    from django.template.loader import get_template
+
+    for name in TEMPLATES:
+        get_template(name)
+
+def _http_clients():
+    from .gemini_parser import get_scheduler, get_session
+
+    get_session()
+    get_scheduler()
+
+def _imports():
+    for module in DEFERRED_IMPORTS:
+        importlib.import_module(module)
+
+def _database():
+    from .db import ping
+
+    ping()
+
+STEPS = (
+    ('urls', _load_urls),
+    ('templates', _load_templates),
+    ('imports', _imports),
+    ('http_clients', _http_clients),
+    ('database', _database),
+    ('indexes', _ensure_indexes),
+)
+
+def warm_up():
+    # Runs every step once in this process; a failing step is logged and the rest still run
+    state = _state.setdefault(os.getpid(), {'started': time.time(), 'finished': None, 'error': None, 'steps': {}})
+    for name, step in STEPS:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            state['error'] = f'{name}: {type(e).__name__}: {e}'
+            logger.warning("Warm-up step failed", extra={'event': 'warm_up_failed', 'step': name, 'error': str(e)})
+        elapsed = time.perf_counter() - started
+        state['steps'][name] = round(elapsed, 4)
+        WARM_UP_SECONDS.set(elapsed, step=name)
+    state['finished'] = time.time()
+    logger.info("Warm-up finished", extra={'event': 'warm_up', 'pid': os.getpid(), 'steps': state['steps']})
+    return state
+
+def start_warm_up():
+    # Starts warm_up() in a daemon thread, at most once per process
+    pid = os.getpid()
+    with _lock:
+        if pid in _state:
+            return
+        _state[pid] = {'started': time.time(), 'finished': None, 'error': None, 'steps': {}}
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+def _restart_after_fork():
+    global _lock, _ping_executor, _ping_future
+    _lock = threading.Lock()
+    _ping_executor = _ping_future = None
+    if _state:  # warm-up was requested in the parent
+        start_warm_up()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+def _ping_database(timeout):
+    # A ping that outlives the timeout keeps running; later probes wait on it instead of piling up threads
+    global _ping_executor, _ping_future
+    from .db import ping
+
+    with _lock:
+        if _ping_executor is None:
+            _ping_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='readiness')
+        if _ping_future is None or _ping_future.done():
+            _ping_future = _ping_executor.submit(ping)
+        future = _ping_future
+    try:
+        future.result(timeout=timeout)
+    except TimeoutError:
+        return f'database did not answer within {timeout}s'
+    except Exception as e:
+        return f'database: {type(e).__name__}: {e}'
+    return None
+
+def readiness():
+    # (ready, details) for /readyz/
+    state = _state.get(os.getpid())
+    details = {'pid': os.getpid()}
+    if state is not None:
+        details['warm_up'] = {'finished': state['finished'] is not None, 'error': state['error'],
+                              'steps': state['steps']}
+        if state['finished'] is None:
+            details['error'] = 'warming up'
+            return False, details
+    error = _ping_database(settings.READINESS_TIMEOUT)
+    if error:
+        details['error'] = error
+    return error is None, details
@@ -1,3 +1,928 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import re
+import tarfile
+import threading
+import time
+import zipfile
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import requests
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from mongoengine import connection
+from PIL import Image
+
+try:
+    import mongomock
+    import mongomock.gridfs
+except ImportError:  # the database tests are skipped
+    mongomock = None
+
+from parser import db, extraction_cache, gemini_parser, jobs, rate_limit, session_backend, views
+from parser.archives import ARCHIVE_ERRORS, iter_archive_members
+from parser.benchmarks import synthetic_invoice_pdf, synthetic_receipt_image
+from parser.gemini_stub import GeminiStubServer
+from parser.models import (CustomUser, DocumentBatch, ExtractedRow, ExtractionCacheEntry, ExtractionCacheStats, FileBlob,
+                           UserDocument, UserSession)
+from parser.normalize import parse_amount, parse_date
+from parser.rate_limit import AdaptiveConcurrency, TokenBucket
+from parser.splitting import Chunk, SplitError, count_pdf_pages, merge_results, parse_merge_rules, split_document
+from parser.views import _group_key, build_aggregation_pipeline
+
+
+def _payload():
+    # A one-part request body, as extract_data_from_file would send without a file
+    return gemini_parser.StreamingPayload(["Extract the invoice fields."])
+
+
+class FakeClock:
+    # Stands in for the time module: sleeping advances the clock instead of waiting
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def patch(self, test_case, *modules):
+        for module in modules:
+            patcher = mock.patch.object(module, 'time', self)
+            patcher.start()
+            test_case.addCleanup(patcher.stop)
+        return self
+
+
+@skipUnless(mongomock, "mongomock is not installed")
+class MongoTestCase(SimpleTestCase):
+    # Runs against an in-memory mongomock database instead of MONGO_URI; each test starts empty
+    database = 'visionparse_test'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        mongomock.gridfs.enable_gridfs_integration()
+        connection.disconnect()
+        connection.connect(cls.database, host='mongodb://localhost', mongo_client_class=mongomock.MongoClient)
+
+    @classmethod
+    def tearDownClass(cls):
+        connection.disconnect()
+        db._registered = False
+        db.register()
+        super().tearDownClass()
+
+    def tearDown(self):
+        connection.get_connection().drop_database(self.database)
+        super().tearDown()
+
+    def gridfs_files(self):
+        return connection.get_db()['fs.files'].count_documents({})
+
+
+class ViewTestCase(MongoTestCase):
+    # A signed-in test client; sessions go through parser.session_backend on the same database
+
+    def setUp(self):
+        super().setUp()
+        session_backend.get_cache().clear()
+        request_logger = logging.getLogger('django.request')  # 4xx responses are expected here
+        self.addCleanup(request_logger.setLevel, request_logger.level)
+        request_logger.setLevel(logging.ERROR)
+        self.user = self.create_user('alice')
+        self.client = self.client_class(enforce_csrf_checks=True)
+        self.sign_in(self.client, self.user)
+
+    def create_user(self, username):
+        return CustomUser(username=username, email=f'{username}@example.com',
+                          password_hash=make_password('secret')).save()
+
+    def sign_in(self, client, user):
+        session = client.session
+        session['user_id'] = str(user.id)
+        session.save()
+
+
+def start_stub(test_case, **options):
+    # Points gemini_parser at a local stub server for the duration of the test
+    stub = GeminiStubServer(**options).start()
+    test_case.addCleanup(stub.stop)
+    for name, value in (('GEMINI_ENDPOINT', stub.url), ('_session', None),
+                        ('_scheduler', gemini_parser.GeminiScheduler(['test-key']))):
+        patcher = mock.patch.object(gemini_parser, name, value)
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+    return stub
+
+
+class GeminiClientTests(SimpleTestCase):
+    # The HTTP client against the local stub server: no Gemini API, no MongoDB
+
+    def start_stub(self, **options):
+        return start_stub(self, **options)
+
+    def use_scheduler(self, *api_keys, **options):
+        scheduler = gemini_parser.GeminiScheduler(list(api_keys), **options)
+        patcher = mock.patch.object(gemini_parser, '_scheduler', scheduler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return scheduler
+
+    def test_connections_are_reused(self):
+        stub = self.start_stub()
+        for _ in range(5):
+            self.assertEqual(gemini_parser.post_payload(_payload(), 'test-key').status_code, 200)
+        self.assertEqual(stub.request_count, 5)
+        self.assertLess(stub.connection_count, stub.request_count)
+
+    def test_read_timeout(self):
+        self.start_stub(latency=2.0)
+        with mock.patch.object(gemini_parser, 'GEMINI_READ_TIMEOUT', 0.2), \
+                mock.patch.object(gemini_parser, 'GEMINI_MAX_RETRIES', 0):
+            started = time.perf_counter()
+            with self.assertRaises(requests.RequestException):
+                gemini_parser.post_payload(_payload(), 'test-key')
+        self.assertLess(time.perf_counter() - started, 1.5)
+
+    def test_503_is_retried_after_retry_after(self):
+        stub = self.start_stub(retry_after=1)
+        stub.queue_responses(503)
+        started = time.perf_counter()
+        response = gemini_parser.post_payload(_payload(), 'test-key')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(stub.request_count, 2)
+        self.assertGreaterEqual(time.perf_counter() - started, 1.0)
+
+    def test_429_is_left_to_the_scheduler(self):
+        stub = self.start_stub(retry_after=1)
+        stub.queue_responses(429)
+        # urllib3 would honour Retry-After on a 429; the session must hand it back at once
+        started = time.perf_counter()
+        response = gemini_parser.post_payload(_payload(), 'test-key')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(stub.request_count, 1)
+        self.assertLess(time.perf_counter() - started, 1.0)
+
+        # The scheduler backs off (Retry-After) and sends the request again
+        stub.retry_after = 0
+        stub.queue_responses(429)
+        slot = gemini_parser._scheduler.slots[0]
+        limit = slot.concurrency.limit
+        self.assertIsNotNone(gemini_parser._request_extraction([(BytesIO(b'%PDF-1.4'), 8, 'application/pdf'),
+                                                                "Extract the invoice fields."]))
+        self.assertEqual(stub.request_count, 3)
+        self.assertLess(slot.concurrency.limit, limit)
+
+    def test_rate_limit_error_after_throttle_retries(self):
+        stub = self.start_stub(retry_after=0)
+        stub.queue_responses(*[429] * 3)
+        with mock.patch.object(gemini_parser, 'GEMINI_THROTTLE_RETRIES', 2):
+            with self.assertRaises(gemini_parser.GeminiRateLimitError):
+                gemini_parser._request_extraction(["Extract the invoice fields."])
+        self.assertEqual(stub.request_count, 3)
+
+    def test_prompt_tokens_follow_pages_not_bytes(self):
+        stub = self.start_stub()
+        rng = random.Random(0)
+        pdf, image = synthetic_invoice_pdf(rng, 1, pages=3), synthetic_receipt_image(rng, 2)
+        parts = [(BytesIO(pdf), len(pdf), 'application/pdf'), (BytesIO(image), len(image), 'image/png')]
+        self.assertEqual(gemini_parser.estimate_prompt_tokens(parts),
+                         3 * gemini_parser.PDF_PAGE_TOKENS + gemini_parser.IMAGE_TOKENS)
+        self.assertEqual(stub.prompt_tokens(b''.join(gemini_parser.StreamingPayload(parts))),
+                         3 * stub.tokens_per_page + stub.tokens_per_image)
+
+    def test_tokens_are_only_estimated_with_a_token_quota(self):
+        self.start_stub()
+        pdf = synthetic_invoice_pdf(random.Random(0), 1, pages=3)
+        parts = [(BytesIO(pdf), len(pdf), 'application/pdf'), "Extract."]
+        with mock.patch.object(gemini_parser, 'count_pdf_pages', wraps=count_pdf_pages) as count:
+            gemini_parser._request_extraction(parts)
+            self.assertFalse(count.called)
+            self.use_scheduler('test-key', tokens_per_minute=100000)
+            gemini_parser._request_extraction(parts)
+            self.assertEqual(count.call_count, 1)
+
+    def assert_moves_to_next_key(self, stub, scheduler, clock, parts):
+        # key-a's quota was used up by the requests already sent; key-b still has room
+        sent = len(stub.request_log)
+        self.assertIsNotNone(gemini_parser._request_extraction(parts))
+        self.assertEqual([(entry['key'], entry['status']) for entry in stub.request_log[sent:]],
+                         [('key-a', 429), ('key-b', 200)])
+        key_a, key_b = scheduler.slots
+        self.assertEqual(key_a.concurrency.limit, 5)  # halved by the 429
+        self.assertEqual(key_b.concurrency.limit, 10)
+        self.assertGreater(key_a.blocked_until, clock.now)
+        self.assertEqual(clock.now, 1000.0)  # nobody waited for key-a's Retry-After
+
+    def test_stub_request_quota_429(self):
+        clock = FakeClock().patch(self, rate_limit, gemini_parser)
+        stub = self.start_stub(requests_per_minute=2)
+        scheduler = self.use_scheduler('key-a', 'key-b')
+        for _ in range(2):
+            self.assertEqual(gemini_parser.post_payload(_payload(), 'key-a').status_code, 200)
+        self.assert_moves_to_next_key(stub, scheduler, clock, ["Extract the invoice fields."])
+
+    def test_stub_token_quota_429(self):
+        clock = FakeClock().patch(self, rate_limit, gemini_parser)
+        stub = self.start_stub(tokens_per_minute=1000)
+        scheduler = self.use_scheduler('key-a', 'key-b')
+        pdf = synthetic_invoice_pdf(random.Random(0), 1, pages=3)  # 774 tokens: one fits per minute
+        parts = [(BytesIO(pdf), len(pdf), 'application/pdf'), "Extract."]
+        self.assertEqual(gemini_parser.post_payload(gemini_parser.StreamingPayload(parts), 'key-a').status_code, 200)
+        self.assert_moves_to_next_key(stub, scheduler, clock, parts)
+
+
+class RateLimitTests(SimpleTestCase):
+    # Scheduling primitives on a fake clock
+
+    def setUp(self):
+        self.clock = FakeClock().patch(self, rate_limit, gemini_parser)
+
+    def test_bucket_never_exceeds_its_limit(self):
+        bucket = TokenBucket(60, period=60.0, headroom=0.95)
+        sent = []
+        for _ in range(300):
+            self.clock.sleep(bucket.reserve(1))
+            sent.append(self.clock.now)
+        for index, started in enumerate(sent):
+            in_window = sum(1 for at in sent[index:] if at < started + 60.0)
+            self.assertLessEqual(in_window, 60)
+        # Paced at the refill rate once the burst is spent, not slower
+        self.assertLess(sent[-1] - sent[0], 300 / bucket.rate)
+
+    def test_concurrency_halves_on_429_and_grows_back(self):
+        concurrency = AdaptiveConcurrency(10, minimum=1, maximum=20)
+        concurrency.on_throttle()
+        self.assertEqual(concurrency.limit, 5)
+        concurrency.on_throttle()  # same burst of 429s, within the cooldown
+        self.assertEqual(concurrency.limit, 5)
+        for _ in range(30):
+            concurrency.on_success()
+        self.assertEqual(concurrency.limit, 9)
+        for _ in range(30):
+            concurrency.on_success()
+        self.assertEqual(concurrency.limit, 9)  # probing slowly above the limit that was throttled
+        self.clock.sleep(concurrency.cooldown)
+        concurrency.on_throttle()
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_blocked_key_is_skipped(self):
+        scheduler = gemini_parser.GeminiScheduler(['key-a', 'key-b'])
+        lease = scheduler.acquire(100)
+        self.assertEqual(lease.api_key, 'key-a')
+        lease.release(429, retry_after=30)
+        for _ in range(3):
+            lease = scheduler.acquire(100)
+            self.assertEqual(lease.api_key, 'key-b')
+            lease.release(200, prompt_tokens=100)
+        self.assertEqual(self.clock.now, 1000.0)  # nobody waited for key-a
+        self.clock.sleep(30)
+        self.assertEqual({scheduler.acquire(100).api_key for _ in range(2)}, {'key-a', 'key-b'})
+
+    def test_token_estimate_learns_from_usage(self):
+        scheduler = gemini_parser.GeminiScheduler(['key-a'], tokens_per_minute=100000)
+        self.assertEqual(scheduler.estimate_tokens(1000), 1000)
+        for _ in range(20):
+            scheduler.acquire(1000).release(200, prompt_tokens=1500)
+        self.assertAlmostEqual(scheduler.estimate_tokens(1000), 1500, delta=20)
+
+
+def _named(data, name):
+    archive = BytesIO(data)
+    archive.name = name
+    return archive
+
+def _read_members(archive):
+    # Like _iter_upload_blobs: a member that fails to read is skipped
+    members = []
+    for name, stream in iter_archive_members(archive, ('pdf', 'png')):
+        try:
+            members.append((name, stream.read()))
+        except ARCHIVE_ERRORS:
+            continue
+    return members
+
+
+class ArchiveTests(SimpleTestCase):
+
+    def test_reads_zip_members_of_allowed_types(self):
+        data = BytesIO()
+        with zipfile.ZipFile(data, 'w') as zf:
+            zf.writestr('docs/a.pdf', b'%PDF-1.4 a')
+            zf.writestr('notes.txt', b'skipped')
+        self.assertEqual(_read_members(_named(data.getvalue(), 'upload.zip')), [('a.pdf', b'%PDF-1.4 a')])
+
+    def test_corrupt_zip_is_skipped(self):
+        self.assertEqual(_read_members(_named(b'PK\x03\x04 not really a zip', 'broken.zip')), [])
+
+    def test_encrypted_zip_member_is_skipped(self):
+        data = BytesIO()
+        with zipfile.ZipFile(data, 'w') as zf:
+            zf.writestr('a.pdf', b'%PDF-1.4 a')
+            zf.writestr('b.pdf', b'%PDF-1.4 b')
+        # Mark the first member encrypted, in the local header and in the central directory
+        raw = bytearray(data.getvalue())
+        raw[6] |= 0x1
+        central = raw.index(b'PK\x01\x02')
+        raw[central + 8] |= 0x1
+        self.assertEqual(_read_members(_named(bytes(raw), 'upload.zip')), [('b.pdf', b'%PDF-1.4 b')])
+
+    def test_truncated_tar_keeps_members_read_so_far(self):
+        data = BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as tf:
+            for name, size in (('a.pdf', 1000), ('b.pdf', 200000)):
+                info = tarfile.TarInfo(name)
+                info.size = size
+                tf.addfile(info, io.BytesIO(bytes(random.Random(name).getrandbits(8) for _ in range(size))))
+        members = _read_members(_named(data.getvalue()[:len(data.getvalue()) // 2], 'upload.tar.gz'))
+        self.assertEqual([name for name, _ in members], ['a.pdf'])
+
+
+class NormalizeTests(SimpleTestCase):
+
+    def test_parse_amount(self):
+        for text, expected in (
+                ('1234', (1234.0, None)),
+                ('$1,234.50', (1234.5, 'USD')),
+                ('1.234,50 EUR', (1234.5, 'EUR')),
+                ('12,50 €', (12.5, 'EUR')),
+                ('1,234,567', (1234567.0, None)),
+                ('1.234.567', (1234567.0, None)),
+                ("CHF 1'234.00", (1234.0, 'CHF')),
+                ('-£5', (-5.0, 'GBP')),
+                ('($40.00)', (-40.0, 'USD')),
+                ('usd 3', (3.0, 'USD'))):
+            with self.subTest(text=text):
+                self.assertEqual(parse_amount(text), expected)
+        for text in ('', 'INV-0001', '($40.00', '12 apples', '1.2.3,4,5'):
+            with self.subTest(text=text):
+                self.assertIsNone(parse_amount(text))
+
+    def test_parse_date(self):
+        self.assertEqual(parse_date('2024-03-05'), datetime.datetime(2024, 3, 5))
+        self.assertEqual(parse_date('2024-03-05T10:00:00+02:00'), datetime.datetime(2024, 3, 5, 8))
+        self.assertEqual(parse_date('March 5, 2024'), datetime.datetime(2024, 3, 5))
+        self.assertEqual(parse_date('05.03.2024'), datetime.datetime(2024, 3, 5))
+        self.assertEqual(parse_date('03/05/2024', day_first=False), datetime.datetime(2024, 3, 5))
+        self.assertEqual(parse_date('05/03/2024', day_first=True), datetime.datetime(2024, 3, 5))
+        self.assertIsNone(parse_date('20240305'))
+        self.assertIsNone(parse_date('2024-13-45'))
+        self.assertIsNone(parse_date('not a date'))
+
+
+class AggregationPipelineTests(SimpleTestCase):
+
+    def test_group_fields_are_aliased(self):
+        pipeline = build_aggregation_pipeline('user-1', 'total', ['vendor.name', 'currency'], period='month',
+                                              date_field='invoice_date')
+        match, project, group = pipeline[0]['$match'], pipeline[1]['$project'], pipeline[2]['$group']
+        self.assertEqual(match['user'], 'user-1')
+        self.assertEqual(list(group['_id']), ['period', 'g0', 'g1', 'currency'])
+        self.assertEqual(group['_id']['g0'], {'$ifNull': ['$g0.text', '$g0.number']})
+        self.assertEqual(project['g0']['$arrayElemAt'][0]['$filter']['cond'], {'$eq': ['$$this.key', 'vendor.name']})
+        self.assertEqual(project['period_date']['$arrayElemAt'][0]['$filter']['cond'],
+                         {'$eq': ['$$this.key', 'invoice_date']})
+        self.assertTrue(all('.' not in key for key in group['_id']))
+        self.assertEqual(pipeline[-2:], [{'$sort': {'_id': 1}}, {'$limit': mock.ANY}])
+
+    def test_filters(self):
+        date_from, date_to = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 2, 1)
+        match = build_aggregation_pipeline('user-1', 'total', date_from=date_from, date_to=date_to,
+                                           batch_ids=['b1'])[0]['$match']
+        self.assertEqual(match['batch'], {'$in': ['b1']})
+        self.assertEqual(match['$and'], [{'values': {'$elemMatch': {
+            'key': 'date', 'date': {'$gte': date_from, '$lt': date_to}}}}])
+        self.assertNotIn('$and', build_aggregation_pipeline('user-1', 'total')[0]['$match'])
+
+    def test_group_key_maps_aliases_back(self):
+        self.assertEqual(_group_key({'period': '2024-03', 'g0': 'ACME', 'currency': 'EUR'},
+                                    ['vendor.name', 'category'], 'month'),
+                         {'period': '2024-03', 'vendor.name': 'ACME', 'category': None, 'currency': 'EUR'})
+        self.assertEqual(_group_key({}, [], None), {'currency': None})
+
+
+class SplittingTests(SimpleTestCase):
+
+    def test_parse_merge_rules(self):
+        self.assertEqual(parse_merge_rules('Line Items:concat, total:LAST,, vendor.vat:first'),
+                         {'line_items': 'concat', 'total': 'last', 'vendor.vat': 'first'})
+        self.assertEqual(parse_merge_rules(['pages:sum']), {'pages': 'sum'})
+        self.assertEqual(parse_merge_rules(''), {})
+        for spec in ('total', 'total:average', ':sum'):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                parse_merge_rules(spec)
+
+    def test_merge_defaults(self):
+        merged = merge_results([
+            {'invoice': 'A1', 'total': '', 'line_items': [{'n': 1}], 'vendor': {'name': 'X', 'vat': None}},
+            {'invoice': 'A1?', 'total': '$10.50', 'line_items': [{'n': 2}], 'vendor': {'vat': 'DE1'}, 'notes': []},
+        ])
+        self.assertEqual(merged, {'invoice': 'A1', 'total': '$10.50', 'line_items': [{'n': 1}, {'n': 2}],
+                                  'vendor': {'name': 'X', 'vat': 'DE1'}, 'notes': []})
+
+    def test_merge_rules(self):
+        results = [{'pages': 4, 'total': '1', 'subtotal': '$1.25', 'vendor': {'vat': 'A', 'names': ['x']}},
+                   {'pages': '4', 'total': '2', 'subtotal': '$2', 'vendor': {'vat': 'B', 'names': 'y'}}]
+        merged = merge_results(results, parse_merge_rules('pages:sum,total:last,subtotal:sum,vendor.vat:last'))
+        self.assertEqual(merged, {'pages': 8, 'total': '2', 'subtotal': 3.25, 'vendor': {'vat': 'B', 'names': ['x', 'y']}})
+        self.assertEqual(merge_results([{'total': 'n/a'}, {'total': '?'}], {'total': 'sum'}), {'total': 'n/a'})
+
+    def test_merge_lists_and_scalars(self):
+        self.assertEqual(merge_results([[{'n': 1}], [{'n': 2}]]), [{'n': 1}, {'n': 2}])
+        self.assertIsNone(merge_results([{'n': 1}, 'scalar']))
+
+    def test_tiff_chunks_are_cut_on_demand(self):
+        frames = [Image.new('L', (20, 30), 255 - index) for index in range(10)]
+        tiff = BytesIO()
+        frames[0].save(tiff, format='TIFF', save_all=True, append_images=frames[1:])
+        chunks, total = split_document(tiff, 'image/tiff', pages_per_chunk=4, min_pages=8)
+        self.assertEqual(total, 10)
+        first = next(chunks)
+        self.assertEqual((first.first_page, first.last_page, len(first.parts)), (1, 4, 4))
+        self.assertEqual([(chunk.first_page, chunk.last_page) for chunk in chunks], [(5, 8), (9, 10)])
+        self.assertEqual(tiff.tell(), 0)
+        self.assertIsNone(split_document(tiff, 'image/tiff', pages_per_chunk=4, min_pages=11))
+
+    def test_pdf_is_split_into_page_chunks(self):
+        pdf = BytesIO(synthetic_invoice_pdf(random.Random(0), 1, pages=10))
+        chunks, total = split_document(pdf, 'application/pdf', pages_per_chunk=4, min_pages=8)
+        self.assertEqual(total, 10)
+        chunks = list(chunks)
+        self.assertEqual([(chunk.first_page, chunk.last_page) for chunk in chunks], [(1, 4), (5, 8), (9, 10)])
+        self.assertEqual([count_pdf_pages(chunk.parts[0][0]) for chunk in chunks], [4, 4, 2])
+        self.assertEqual([chunk.parts[0][1] for chunk in chunks], ['application/pdf'] * 3)
+        self.assertIsNone(split_document(pdf, 'application/pdf', pages_per_chunk=4, min_pages=11))
+
+    def test_pdf_chunks_are_extracted_and_merged(self):
+        def extract(parts):
+            # Answers for the pages actually sent, as Gemini would
+            (chunk_file, _, mime_type), prompt = parts
+            pages = count_pdf_pages(chunk_file)
+            first = int(re.search(r'pages (\d+)-', prompt).group(1))
+            return json.dumps({'invoice': 'INV-1', 'pages': pages,
+                               'line_items': [f'page {page}' for page in range(first, first + pages)]})
+
+        pdf = BytesIO(synthetic_invoice_pdf(random.Random(0), 1, pages=10))
+        pdf.name = 'long.pdf'
+        with mock.patch.object(gemini_parser, 'GEMINI_SPLIT_DOCUMENTS', True), \
+                mock.patch.object(gemini_parser, 'GEMINI_SPLIT_MERGE_RULES', parse_merge_rules('pages:sum')), \
+                mock.patch.object(gemini_parser, '_request_extraction', side_effect=extract) as request:
+            result = json.loads(gemini_parser.extract_data_from_file(pdf, use_cache=False))
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(result, {'invoice': 'INV-1', 'pages': 10,
+                                  'line_items': [f'page {page}' for page in range(1, 11)]})
+
+
+class ConcurrentExtractionTests(SimpleTestCase):
+    # process_documents_with_gemini with a thread pool; extract_data_from_file is replaced
+
+    def test_documents_run_concurrently_and_keep_their_order(self):
+        documents = [SimpleNamespace(id=index, file=None, file_hash=f'h{index}') for index in range(4)]
+        # Every call waits for all four: run one at a time, the first would time out
+        barrier = threading.Barrier(len(documents), timeout=5)
+
+        def extract(file_obj, prompt=None, file_hash=None):
+            index = int(file_hash[1:])
+            barrier.wait()
+            time.sleep(0.01 * (len(documents) - index))  # finish in reverse order
+            if index == 2:
+                raise ValueError("unreadable response")
+            return json.dumps({'invoice_number': f'INV-{index}'})
+
+        with mock.patch.object(views, 'extract_data_from_file', extract), self.assertLogs('parser.views', 'WARNING'):
+            rows = views.process_documents_with_gemini(documents, [], False, concurrency=4, pack=False)
+        self.assertEqual(rows, [{'invoice_number': 'INV-0'}, {'invoice_number': 'INV-1'}, {},
+                                {'invoice_number': 'INV-3'}])
+
+
+class SplitExtractionTests(SimpleTestCase):
+    # The chunk scheduling of _extract_split and _aextract_split, without HTTP
+
+    def setUp(self):
+        self.cut = self.finished = self.most_held = 0
+        self.lock = threading.Lock()
+        for name, value in (('GEMINI_SPLIT_CONCURRENCY', 2), ('split_document', self.split_document),
+                            ('_extract_chunk', self.extract_chunk), ('_chunk_parts', lambda chunk, *args: chunk),
+                            ('_arequest_extraction', self.aextract)):
+            patcher = mock.patch.object(gemini_parser, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def split_document(self, file_obj, mime_type, pages_per_chunk, min_pages):
+        def chunks():
+            for page in range(1, 11):
+                if page == self.fail_at:
+                    raise SplitError("unreadable page")
+                with self.lock:
+                    self.cut += 1
+                    self.most_held = max(self.most_held, self.cut - self.finished)
+                yield Chunk([], page, page)
+        return chunks(), 10
+
+    def extract_chunk(self, chunk, prompt, total):
+        time.sleep(0.01)
+        with self.lock:
+            self.finished += 1
+        return json.dumps({'pages': [chunk.first_page]})
+
+    async def aextract(self, chunk):
+        await asyncio.sleep(0.01)
+        with self.lock:
+            self.finished += 1
+        return json.dumps({'pages': [chunk.first_page]})
+
+    def test_chunks_in_memory_are_bounded(self):
+        self.fail_at = None
+        for extract in (lambda: gemini_parser._extract_split(None, 'application/pdf', 'prompt'),
+                        lambda: asyncio.run(gemini_parser._aextract_split(None, 'application/pdf', 'prompt'))):
+            self.cut = self.finished = self.most_held = 0
+            self.assertEqual(json.loads(extract()), {'pages': list(range(1, 11))})
+            self.assertEqual(self.cut, 10)
+            self.assertLessEqual(self.most_held, 3)  # two in flight and the one being cut
+
+    def test_split_error_sends_the_document_whole(self):
+        self.fail_at = 5
+        self.assertIsNone(gemini_parser._extract_split(None, 'application/pdf', 'prompt'))
+        self.assertIsNone(asyncio.run(gemini_parser._aextract_split(None, 'application/pdf', 'prompt')))
+
+
+@override_settings(GEMINI_CACHE_ENABLED=True, GEMINI_CACHE_TTL=0)
+class ExtractionCacheTests(MongoTestCase):
+
+    def setUp(self):
+        extraction_cache._take_pending()
+        patcher = mock.patch.object(extraction_cache, '_resynced_at', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored(self):
+        return sorted(entry.file_hash for entry in ExtractionCacheEntry.objects)
+
+    @override_settings(GEMINI_CACHE_MAX_ENTRIES=0, GEMINI_CACHE_MAX_BYTES=5000)
+    def test_byte_cap_evicts_least_recently_used(self):
+        for index in range(5):
+            extraction_cache.store_result(f'h{index}', 'p', 'e', 'x' * 1000)
+        extraction_cache.store_result('h0', 'p', 'e', 'y' * 500)  # overwrite: counts the difference only
+        self.assertEqual(extraction_cache.cache_stats()['bytes'], 4500)
+        self.assertIsNotNone(extraction_cache.get_cached_result('h1', 'p', 'e'))
+        extraction_cache.store_result('big', 'p', 'e', 'z' * 2500)
+        self.assertEqual(self.stored(), ['big', 'h0', 'h1', 'h4'])  # h2 and h3 were used least recently
+        stats = extraction_cache.cache_stats()
+        self.assertEqual((stats['bytes'], stats['evictions']), (5000, 2))
+        self.assertEqual(stats['bytes'], extraction_cache._total_bytes())
+
+    @override_settings(GEMINI_CACHE_MAX_ENTRIES=2, GEMINI_CACHE_MAX_BYTES=0)
+    def test_entry_cap(self):
+        for index in range(4):
+            extraction_cache.store_result(f'h{index}', 'p', 'e', 'x')
+        self.assertEqual(self.stored(), ['h2', 'h3'])
+
+    def test_running_total_is_resynced(self):
+        extraction_cache.store_result('h0', 'p', 'e', 'x' * 100)
+        ExtractionCacheEntry.objects.delete()  # as the TTL monitor would
+        extraction_cache.store_result('h1', 'p', 'e', 'x' * 10)
+        self.assertEqual(extraction_cache.cache_stats()['bytes'], 110)
+        extraction_cache._resynced_at = None  # BYTES_RESYNC_INTERVAL later
+        extraction_cache.store_result('h2', 'p', 'e', 'x' * 10)
+        self.assertEqual(extraction_cache.cache_stats()['bytes'], 20)
+
+    def test_lookups_do_not_write_stats(self):
+        extraction_cache.store_result('h0', 'p', 'e', '{}')
+        with mock.patch.object(extraction_cache, 'STATS_FLUSH_INTERVAL', 3600):
+            for file_hash in ('h0', 'h0', 'missing'):
+                extraction_cache.get_cached_result(file_hash, 'p', 'e')
+            stats = ExtractionCacheStats.objects.get(name=extraction_cache.STATS_NAME)
+            self.assertEqual((stats.hits, stats.misses), (0, 0))
+            stats = extraction_cache.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (2, 1, 1))
+
+
+class UploadTests(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.get('/parser/')  # sets the CSRF cookie
+        self.token = self.client.cookies['csrftoken'].value
+
+    def post(self, count, token):
+        files = [SimpleUploadedFile(f'invoice{index}.pdf', synthetic_invoice_pdf(random.Random(index), index), 'application/pdf')
+                 for index in range(count)]
+        return self.client.post('/parser/', {'documents': files, 'result_format': 'csv'}, HTTP_X_CSRFTOKEN=token)
+
+    def test_upload_is_stored_in_gridfs(self):
+        response = self.post(2, self.token)
+        self.assertEqual(response.status_code, 302)
+        batch = DocumentBatch.objects.get()
+        self.assertEqual(batch.document_count, 2)
+        self.assertEqual(self.gridfs_files(), 2)
+
+    def test_csrf_failure_stores_nothing(self):
+        with self.assertLogs('django.security', 'WARNING'):
+            self.assertEqual(self.post(2, 'x' * 64).status_code, 403)
+        self.assertEqual(self.gridfs_files(), 0)
+
+    @override_settings(DATA_UPLOAD_MAX_NUMBER_FILES=2)
+    def test_too_many_files_leaves_nothing_stored(self):
+        with self.assertLogs('django.security', 'ERROR'), self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.post(3, self.token).status_code, 400)
+        self.assertEqual(self.gridfs_files(), 0)
+        self.assertEqual(DocumentBatch.objects.count(), 0)
+
+
+class BatchAccessTests(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.batch = DocumentBatch(user=str(self.user.id), status='completed', result_format='csv', document_count=1)
+        self.batch.result_file.put(b'file_name,total\na.pdf,10\n', content_type='text/csv')
+        self.batch.save()
+
+    def other_client(self):
+        client = self.client_class()
+        self.sign_in(client, self.create_user('mallory'))
+        return client
+
+    def test_result_page_is_owner_only(self):
+        url = f'/parser/result/{self.batch.id}/'
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.other_client().get(url).status_code, 404)
+        self.assertEqual(self.client_class().get(url).status_code, 302)  # to the login page
+        self.assertEqual(self.client.get('/parser/result/nothex/').status_code, 404)
+
+    def test_result_page_previews_the_start_of_the_result(self):
+        rows = ''.join(f'doc{index}.pdf,{index}\n' for index in range(1000))
+        self.batch.result_file.replace(gzip.compress(rows.encode()), content_type='text/csv')
+        self.batch.result_compressed = True
+        self.batch.save()
+        response = self.client.get(f'/parser/result/{self.batch.id}/')
+        self.assertEqual(len(response.context['result_preview']), views.RESULT_PREVIEW_BYTES)
+        self.assertTrue(rows.startswith(response.context['result_preview']))
+        self.assertContains(response, 'doc0.pdf,0')
+
+    def test_download_is_owner_only(self):
+        url = f'/parser/download/{self.batch.id}/csv/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'file_name,total\na.pdf,10\n')
+        self.assertEqual(self.other_client().get(url).status_code, 404)
+        self.assertEqual(self.client_class().get(url).status_code, 401)
+        self.assertEqual(self.client.get('/parser/download/nothex/csv/').status_code, 404)
+
+
+class DeleteDocumentTests(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        content = synthetic_invoice_pdf(random.Random(0), 1)
+        self.docs = views.save_user_documents([SimpleUploadedFile('a.pdf', content), SimpleUploadedFile('b.pdf', content)])
+        DocumentBatch(user=str(self.user.id), documents=self.docs, document_count=2).save()
+        self.client.get('/parser/')  # sets the CSRF cookie
+
+    def delete(self, doc_id, client=None):
+        client = client or self.client
+        return client.post(f'/parser/delete/{doc_id}/', HTTP_X_CSRFTOKEN=self.client.cookies['csrftoken'].value)
+
+    def test_shared_blob_is_deleted_with_its_last_document(self):
+        self.assertEqual(FileBlob.objects.get().ref_count, 2)
+        self.assertEqual(self.delete(self.docs[0].id).status_code, 200)
+        self.assertEqual(FileBlob.objects.get().ref_count, 1)
+        self.assertEqual(self.gridfs_files(), 1)
+        self.assertEqual(self.delete(self.docs[1].id).status_code, 200)
+        self.assertEqual(FileBlob.objects.count(), 0)
+        self.assertEqual(self.gridfs_files(), 0)
+        self.assertEqual(UserDocument.objects.count(), 0)
+
+    def test_only_the_owner_can_delete(self):
+        other = self.client_class()
+        self.sign_in(other, self.create_user('mallory'))
+        other.cookies['csrftoken'] = self.client.cookies['csrftoken'].value
+        self.assertEqual(self.delete(self.docs[0].id, other).status_code, 404)
+        self.assertEqual(self.delete(self.docs[0].id, self.client_class()).status_code, 401)
+        self.assertEqual(self.delete('nothex').status_code, 404)
+        self.assertEqual(UserDocument.objects.count(), 2)
+        self.assertEqual(FileBlob.objects.get().ref_count, 2)
+
+
+class ResumeBatchTests(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        uploads = [SimpleUploadedFile(f'invoice{index}.pdf', synthetic_invoice_pdf(random.Random(index), index))
+                   for index in range(3)]
+        documents = views.save_user_documents(uploads)
+        self.batch = DocumentBatch(user='u1', documents=documents, document_count=3, result_format='csv',
+                                   file_names=[doc.file_name for doc in documents])
+        self.batch.save()
+
+    def extract(self, documents, custom_fields, strict_mode, on_progress):
+        self.extracted.extend(doc.file_name for doc in documents)
+        rows = [{'total': doc.file_name} for doc in documents]
+        for index, row in enumerate(rows):
+            on_progress(index, row)
+        return rows
+
+    def test_resumes_from_checkpoint(self):
+        # The first attempt extracted invoice0.pdf and stored a result, then failed
+        first = self.batch.documents[0]
+        first.update(set__is_processed=True, set__extracted_data={'total': 'checkpointed'})
+        views.store_batch_results(self.batch, [{'total': 'checkpointed'}, {}, {}], compress=False)
+        self.batch.status = 'failed'
+        self.batch.save()
+        files = self.gridfs_files()
+
+        self.assertIsNotNone(jobs.resume_batch(self.batch.id))
+        self.extracted = []
+        with mock.patch.object(jobs, 'process_documents_with_gemini', self.extract):
+            batch = jobs.run_batch(jobs.claim_next_batch())
+        self.assertEqual(batch.status, 'completed')
+        self.assertEqual(self.extracted, ['invoice1.pdf', 'invoice2.pdf'])
+        batch.reload()
+        self.assertEqual((batch.processed_count, len(batch.progress)), (3, 3))
+        self.assertEqual([row.data['total'] for row in ExtractedRow.objects.order_by('index')],
+                         ['checkpointed', 'invoice1.pdf', 'invoice2.pdf'])
+        self.assertEqual(self.gridfs_files(), files)  # the first attempt's result files were replaced
+
+
+@override_settings(GEMINI_CACHE_ENABLED=False, GEMINI_PACK_MAX_DOCUMENTS=8)
+class PackingTests(MongoTestCase):
+    # process_documents_with_gemini with pack=True against the stub server
+
+    def setUp(self):
+        super().setUp()
+        uploads = [SimpleUploadedFile(f'invoice{index}.pdf', synthetic_invoice_pdf(random.Random(index), index))
+                   for index in range(3)]
+        self.documents = views.save_user_documents(uploads)
+
+    def test_packed_response_is_split_per_document(self):
+        packed = {f'doc_{n}': {'invoice_number': f'INV-{n}'} for n in range(1, 4)}
+        stub = start_stub(self, response_text="```json\n" + json.dumps(packed) + "\n```")
+        rows = views.process_documents_with_gemini(self.documents, [], False, concurrency=1, pack=True)
+        self.assertEqual([row['invoice_number'] for row in rows], ['INV-1', 'INV-2', 'INV-3'])
+        self.assertEqual(len(stub.request_log), 1)
+
+    def test_unsplittable_response_falls_back_to_one_request_per_document(self):
+        stub = start_stub(self, response_text='{"invoice_number": "INV-1"}')  # not keyed by label
+        progress = []
+        rows = views.process_documents_with_gemini(self.documents, [], False, concurrency=1, pack=True,
+                                                   on_progress=lambda index, row: progress.append(index))
+        self.assertEqual(rows, [{'invoice_number': 'INV-1'}] * 3)
+        self.assertEqual(len(stub.request_log), 4)  # the packed request, then one per document
+        self.assertEqual(progress, [0, 1, 2])
+
+
+class BatchRowsTests(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.batch = DocumentBatch(user=str(self.user.id), status='completed', document_count=10)
+        self.batch.save()
+        views.store_extracted_rows(self.batch, [{'vendor': 'Acme' if index % 2 else 'Globex', 'total': index}
+                                                for index in range(10)])
+
+    def get(self, **params):
+        response = self.client.get(f'/parser/api/batches/{self.batch.id}/rows/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_filter_is_applied_before_pagination(self):
+        pages = [self.get(vendor='Acme', total__gte='3', page_size=2, page=page) for page in (1, 2, 3)]
+        self.assertEqual([(page['total'], page['num_pages']) for page in pages], [(4, 2)] * 3)
+        self.assertEqual([[row['index'] for row in page['results']] for page in pages], [[3, 5], [7, 9], []])
+
+    def test_filter_with_projection(self):
+        page = self.get(vendor__ne='Acme', total__lt='5', fields='total')
+        self.assertEqual(page['total'], 3)
+        self.assertEqual([row['data'] for row in page['results']], [{'total': 0}, {'total': 2}, {'total': 4}])
+
+
+class BatchHistoryTests(ViewTestCase):
+
+    def test_cursor_pages_through_tied_created_at(self):
+        base = datetime.datetime(2026, 1, 1, 12, 0, 0)
+        batches = [DocumentBatch(user=str(self.user.id), created_at=base + datetime.timedelta(minutes=index // 3))
+                   for index in range(8)]
+        DocumentBatch.objects.insert(batches)
+        DocumentBatch(user='someone-else', created_at=base).save()
+        expected = [str(batch.id) for batch in sorted(batches, key=lambda batch: (batch.created_at, batch.id),
+                                                      reverse=True)]
+        seen, params = [], {'limit': 2}
+        while True:
+            page = self.client.get('/parser/api/batches/', params).json()
+            seen.extend(result['batch_id'] for result in page['results'])
+            if not page['next_cursor']:
+                break
+            params['cursor'] = page['next_cursor']
+        self.assertEqual(seen, expected)
+
+
+@override_settings(SESSION_CACHE_MAX_ENTRIES=2, SESSION_CACHE_TTL=60)
+class SessionBackendTests(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(session_backend, '_cache', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, **data):
+        session = session_backend.SessionStore()
+        session.update(data)
+        session.save()
+        return session.session_key
+
+    def load(self, session_key):
+        return session_backend.SessionStore(session_key).load()
+
+    def test_expired_session_is_not_loaded(self):
+        session_key = self.create(user_id='u1')
+        UserSession.objects(session_key=session_key).update_one(
+            set__expire_date=datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+        session_backend.get_cache().clear()
+        self.assertEqual(self.load(session_key), {})
+
+    def test_cache_entry_expires_with_the_session(self):
+        session = session_backend.SessionStore()
+        session.set_expiry(1)
+        session['user_id'] = 'u1'
+        session.save()
+        self.assertIsNotNone(session_backend.get_cache().get(session.session_key))
+        later = datetime.datetime.utcnow() + datetime.timedelta(seconds=2)
+        with mock.patch.object(session_backend.datetime, 'datetime', wraps=datetime.datetime) as clock:
+            clock.utcnow.return_value = later
+            self.assertIsNone(session_backend.get_cache().get(session.session_key))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        first, second = self.create(user_id='u1'), self.create(user_id='u2')
+        self.load(first)  # now the most recently used
+        self.create(user_id='u3')
+        cache = session_backend.get_cache()
+        self.assertIsNotNone(cache.get(first))
+        self.assertIsNone(cache.get(second))
+        self.assertEqual(self.load(second), {'user_id': 'u2'})  # read back from MongoDB
+
+    def test_save_and_delete_update_the_cache(self):
+        session_key = self.create(user_id='u1')
+        session = session_backend.SessionStore(session_key)
+        session['user_id'] = 'u2'
+        session.save()
+        with mock.patch.object(session_backend.UserSession, 'objects', side_effect=AssertionError('queried')):
+            self.assertEqual(self.load(session_key), {'user_id': 'u2'})  # from the cache
+        session.delete()
+        self.assertIsNone(session_backend.get_cache().get(session_key))
+        self.assertEqual(self.load(session_key), {})
+
+    @skipUnless(hasattr(os, 'fork'), "needs os.fork")
+    def test_forked_child_starts_with_an_empty_cache(self):
+        self.create(user_id='u1')
+        self.assertEqual(len(session_backend.get_cache()), 1)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if session_backend._cache is None else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(len(session_backend.get_cache()), 1)  # the parent keeps its cache
+
+
+class BatchQueueTests(ViewTestCase):
+
+    def queue(self, user=None, **fields):
+        batch = DocumentBatch(user=user or str(self.user.id), **fields)
+        batch.save()
+        return batch
+
+    def test_batch_is_claimed_once(self):
+        batch = self.queue()
+        claimed = jobs.claim_next_batch()
+        self.assertEqual((claimed.id, claimed.status, claimed.attempts), (batch.id, 'processing', 1))
+        self.assertIsNone(jobs.claim_next_batch())
+
+    def test_stale_batch_is_claimed_again(self):
+        batch = self.queue()
+        first = jobs.claim_next_batch()
+        DocumentBatch.objects(id=batch.id).update_one(
+            set__heartbeat_at=datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        second = jobs.claim_next_batch()
+        self.assertEqual((second.id, second.attempts), (batch.id, 2))
+        self.assertNotEqual(second.claim_token, first.claim_token)
+
+    def test_status_is_owner_only(self):
+        batch = self.queue(status='processing', document_count=2, processed_count=1)
+        response = self.client.get(f'/parser/status/{batch.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'processing')
+        self.assertEqual(self.client.get(f'/parser/status/{self.queue(user="someone-else").id}/').status_code, 404)
+        self.assertEqual(self.client.get('/parser/status/nothex/').status_code, 404)
+        self.assertEqual(self.client_class().get(f'/parser/status/{batch.id}/').status_code, 401)
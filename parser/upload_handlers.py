@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import os
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from .archives import is_archive
+from .blob_store import BLOB_DEDUPLICATED_BYTES, BLOB_UPLOADS, SNIFF_BYTES, adopt_blob, sniff_mime_type
+from .models import FileBlob
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# Uploads straight into GridFS
+# =========================
+# Django normally spools each upload to memory or a temp file, then
+# save_user_documents reads it again to hash it and again to copy it into
+# GridFS. GridFSUploadHandler writes the chunks into GridFS as the multipart
+# body is parsed, hashing them and sniffing the MIME type from the first bytes
+# in the same pass. save_user_documents then only registers the blob.
+# It is not in FILE_UPLOAD_HANDLERS: CsrfViewMiddleware reads request.POST
+# before any view runs, so a global handler would store the files of every
+# anonymous or forged multipart POST. upload_and_parse_documents installs it
+# once the session and the X-CSRFToken header are checked (see
+# install_upload_handler). Only parts of the `documents` field with an accepted
+# type are claimed; anything else is left to the default handlers. The handler
+# keeps every file it stored, so a body that fails to parse part-way (too many
+# files, too large, client gone) leaves nothing behind (see discard_stored).
+
+UPLOAD_FIELD = 'documents'
+
+class GridFSUploadedFile(UploadedFile):
+    # An upload already stored in GridFS; reads and seeks go to the GridFS file
+    def __init__(self, proxy, name, content_type, size, sha256, charset=None, content_type_extra=None):
+        super().__init__(proxy, name, content_type, size, charset, content_type_extra)
+        self.proxy = proxy
+        self.sha256 = sha256
+        self.handled = False  # adopted as a blob, or deleted
+
+    def to_blob(self):
+        # Registers the stored file as the blob for its content, or drops it when the content
+        # is stored already. Either way the caller now holds one reference to the returned blob.
+        blob, adopted = adopt_blob(self.sha256, self.proxy, self.size)
+        self.handled = True
+        if adopted:
+            BLOB_UPLOADS.inc(result='stored')
+        else:
+            self.proxy.delete()
+            BLOB_UPLOADS.inc(result='deduplicated')
+            BLOB_DEDUPLICATED_BYTES.inc(self.size)
+        return blob
+
+    def discard(self):
+        if not self.handled:
+            self.proxy.delete()
+            self.handled = True
+
+def discard_uploaded_files(files):
+    # For uploads that are not saved (invalid form, failed CSRF check, error while saving): they would
+    # otherwise stay in GridFS unreferenced. Files already adopted as blobs are left alone.
+    for uploaded_file in files:
+        if isinstance(uploaded_file, GridFSUploadedFile):
+            uploaded_file.discard()
+
+class GridFSUploadHandler(FileUploadHandler):
+    # GridFS chunk size, so each received chunk becomes one GridFS chunk (divisible by 4 as Django requires)
+    chunk_size = 255 * 1024
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.proxy = None
+        self.stored = []  # GridFSUploadedFile for each completed file
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        from .views import ALLOWED_FILE_TYPES  # views imports this module
+
+        self.proxy = None
+        extension = os.path.splitext(file_name)[1].lower().lstrip('.')
+        if field_name != UPLOAD_FIELD or (extension not in ALLOWED_FILE_TYPES and not is_archive(file_name)):
+            return  # not ours: the next handler takes it
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.proxy = FileBlob().file
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.proxy is None:
+            return raw_data
+        if self.size == 0:
+            # The GridFS file is created with the first chunk, once the type is known
+            self.proxy.new_file(filename=self.file_name,
+                                content_type=sniff_mime_type(raw_data[:SNIFF_BYTES], self.content_type))
+        self.sha256.update(raw_data)
+        self.size += len(raw_data)
+        self.proxy.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.proxy is None:
+            return None
+        if self.size == 0:
+            self.proxy.new_file(filename=self.file_name, content_type=self.content_type)
+        sha256 = self.sha256.hexdigest()
+        self.proxy.newfile.sha256 = sha256
+        self.proxy.close()
+        uploaded = GridFSUploadedFile(self.proxy, self.file_name, self.proxy.content_type, self.size, sha256,
+                                      self.charset, self.content_type_extra)
+        self.stored.append(uploaded)
+        self.proxy = None
+        return uploaded
+
+    def upload_interrupted(self):
+        # Client went away mid-upload: drop the partial GridFS file
+        if self.proxy is not None and self.proxy.newfile is not None:
+            self.proxy.close()
+            self.proxy.delete()
+            logger.info("Upload interrupted", extra={'event': 'upload_interrupted', 'file_name': self.file_name})
+        self.proxy = None
+
+    def discard_stored(self):
+        # Parsing the body failed: request.FILES is never built, so nothing else can reach these files
+        self.upload_interrupted()
+        discard_uploaded_files(self.stored)
+        self.stored = []
+
+def install_upload_handler(request):
+    # Must run before request.POST or request.FILES is first read
+    handler = GridFSUploadHandler(request)
+    request.upload_handlers.insert(0, handler)
+    return handler
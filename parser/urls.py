@@ -1,9 +1,16 @@
 from django.urls import path
-from .views import upload_and_parse_documents, batch_result, delete_document, download_batch_result, register_view, login_view, logout_view
+from .views import upload_and_parse_documents, batch_result, resume_batch_view, batch_status, batch_events, batch_history, batch_rows, aggregate_rows, metrics_view, delete_document, download_batch_result, register_view, login_view, logout_view
 
 urlpatterns = [
     path('', upload_and_parse_documents, name='upload_doc'),
     path('result/<str:batch_id>/', batch_result, name='batch_result'),
+    path('resume/<str:batch_id>/', resume_batch_view, name='resume_batch'),
+    path('status/<str:batch_id>/', batch_status, name='batch_status'),
+    path('events/<str:batch_id>/', batch_events, name='batch_events'),
+    path('api/batches/', batch_history, name='batch_history'),
+    path('api/batches/<str:batch_id>/rows/', batch_rows, name='batch_rows'),
+    path('api/aggregate/', aggregate_rows, name='aggregate_rows'),
+    path('metrics/', metrics_view, name='metrics'),
     path('delete/<str:doc_id>/', delete_document, name='delete_document'),
     path('download/<str:batch_id>/<str:format>/', download_batch_result, name='download_batch_result'),
 ]
@@ -3,32 +3,59 @@ from django.contrib.auth.forms import UserCreationForm
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.auth.hashers import make_password, check_password
-from django.http import JsonResponse, FileResponse
-from django.views.decorators.csrf import csrf_exempt
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from asgiref.sync import sync_to_async
+from django.middleware.csrf import CsrfViewMiddleware
 from django.core.files.base import ContentFile
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
 from django.utils.text import get_valid_filename
-from .models import UserDocument, DocumentBatch, CustomUser
+from .models import UserDocument, DocumentBatch, CustomUser, ExtractedRow
+from .blob_store import BlobTooLarge, release_blob, store_blob, store_blob_stream
+from .archives import ARCHIVE_ERRORS, is_archive, iter_archive_members
+from .upload_handlers import GridFSUploadedFile, discard_uploaded_files, install_upload_handler
+from .normalize import normalize_key, normalize_record, parse_date
+from .startup import readiness
 import os
+import re
+import asyncio
 import json
-from parser.gemini_parser import extract_data_from_file
-from io import BytesIO, StringIO
-import openpyxl
+import gzip
+import tempfile
+import textwrap
+from parser.gemini_parser import (extract_data_from_file, extract_data_from_files, extract_data_from_file_async,
+                                  GeminiRateLimitError)
+from parser.async_utils import iterate_in_thread
+from io import StringIO
 import csv
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 from bson import ObjectId
+from bson.errors import InvalidId
+import base64
+import datetime
 from functools import wraps
 from django.http import HttpResponseRedirect
+from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from .metrics import REGISTRY, STAGE_SECONDS, RESULT_BYTES, DOCUMENTS_EXTRACTED, EXTRACTION_ERRORS
+
+logger = logging.getLogger(__name__)
 
 # =========================
 # Helper Functions
 # =========================
 
-def validate_uploaded_files(uploaded_files, allowed_types):
+ALLOWED_FILE_TYPES = ['pdf', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff']
+
+def validate_uploaded_files(uploaded_files, allowed_types, allow_archives=False):
+    # Archives are checked member by member when they are saved (see save_user_documents)
     valid_files = []
     for uploaded_file in uploaded_files:
         file_extension = os.path.splitext(uploaded_file.name)[1].lower().replace('.', '')
-        if file_extension in allowed_types:
+        if file_extension in allowed_types or (allow_archives and is_archive(uploaded_file.name)):
             valid_files.append(uploaded_file)
     return valid_files
 
@@ -39,56 +66,524 @@ def build_gemini_prompt(custom_fields, strict):
     else:
         return f"Extract the following fields from this document: {fields_text}. You can also include any other useful data. Return as JSON."
 
-def save_user_documents(valid_files):
-    user_docs = []
+# UserDocuments inserted per insert_many call
+USER_DOCUMENTS_INSERT_CHUNK_SIZE = 500
+
+def _iter_upload_blobs(valid_files):
+    # (file name, FileBlob) for each uploaded file, and for each PDF/image inside uploaded archives
     for uploaded_file in valid_files:
         uploaded_file.name = get_valid_filename(uploaded_file.name)
-        user_doc = UserDocument()
-        user_doc.file.put(uploaded_file, filename=uploaded_file.name)
-        user_doc.save()
-        user_docs.append(user_doc)
+        if isinstance(uploaded_file, GridFSUploadedFile) and not is_archive(uploaded_file.name):
+            yield uploaded_file.name, uploaded_file.to_blob()  # hashed and stored while the request was read
+            continue
+        if not is_archive(uploaded_file.name):
+            yield uploaded_file.name, store_blob(uploaded_file, filename=uploaded_file.name,
+                                                 content_type=getattr(uploaded_file, 'content_type', None))
+            continue
+        members = 0
+        try:
+            for name, stream in iter_archive_members(uploaded_file, ALLOWED_FILE_TYPES, settings.ARCHIVE_MAX_MEMBERS):
+                try:
+                    blob = store_blob_stream(stream, filename=name, max_size=settings.ARCHIVE_MAX_MEMBER_SIZE)
+                except (BlobTooLarge, *ARCHIVE_ERRORS) as e:
+                    logger.warning("Skipping archive member", extra={'event': 'archive_member_skipped',
+                                   'archive': uploaded_file.name, 'error': str(e)})
+                    continue
+                members += 1
+                yield name, blob
+        finally:
+            if isinstance(uploaded_file, GridFSUploadedFile):
+                uploaded_file.discard()  # the archive itself is not kept
+        logger.info("Archive ingested", extra={'event': 'archive_ingested', 'archive': uploaded_file.name,
+                                               'documents': members})
+
+def save_user_documents(valid_files):
+    # Identical uploads share one GridFS file (see blob_store); each still gets its own UserDocument.
+    # Documents are inserted in chunks with insert_many instead of one save() each.
+    user_docs, pending = [], []
+
+    def flush():
+        UserDocument.objects.insert(pending, load_bulk=False)
+        user_docs.extend(pending)
+        pending.clear()
+
+    try:
+        for name, blob in _iter_upload_blobs(valid_files):
+            user_doc = UserDocument(file_name=name, file_hash=blob.sha256)
+            user_doc.file = blob.file
+            user_doc.validate()  # insert() skips validation, and clean() sets file_type
+            pending.append(user_doc)
+            if len(pending) >= USER_DOCUMENTS_INSERT_CHUNK_SIZE:
+                flush()
+        if pending:
+            flush()
+    except BaseException:
+        for user_doc in pending:
+            release_blob(user_doc.file_hash)  # referenced, never inserted
+        raise
+    finally:
+        # Uploads stored in GridFS that the loop did not adopt (it stopped on an error)
+        discard_uploaded_files(valid_files)
     return user_docs
 
-def generate_result_file(batch_id, all_data, result_format):
-    if result_format == 'csv':
-        csv_io = StringIO()
-        if all_data and isinstance(all_data[0], dict):
-            headers = list(all_data[0].keys())
-            writer = csv.writer(csv_io)
-            writer.writerow(headers)
-            for item in all_data:
-                row = []
-                for h in headers:
-                    v = item.get(h, "")
-                    if isinstance(v, (list, dict)):
-                        v = json.dumps(v, ensure_ascii=False)
-                    row.append(v)
-                writer.writerow(row)
-        else:
-            writer = csv.writer(csv_io)
-            writer.writerow(["No data extracted"])
-        return (f'result_{str(batch_id)}.csv', csv_io.getvalue().encode('utf-8'))
-    elif result_format == 'json':
-        json_io = StringIO()
-        json.dump(all_data, json_io, ensure_ascii=False, indent=2)
-        return (f'result_{str(batch_id)}.json', json_io.getvalue().encode('utf-8'))
+RESULT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+STREAM_CHUNK_SIZE = 256 * 1024
+
+class _Echo:
+    # Lets csv.writer return each formatted line instead of buffering it
+    def write(self, value):
+        return value
+
+def _as_record(item):
+    return item if isinstance(item, dict) else {'value': item}
+
+def collect_headers(rows):
+    # Union of keys across all rows, in first-seen order
+    headers = {}
+    for item in rows:
+        for key in _as_record(item):
+            headers.setdefault(key, None)
+    return list(headers)
+
+def iter_csv(rows):
+    headers = collect_headers(rows)
+    writer = csv.writer(_Echo())
+    if not headers:
+        yield writer.writerow(["No data extracted"])
+        return
+    yield writer.writerow(headers)
+    for item in rows:
+        item = _as_record(item)
+        row = []
+        for h in headers:
+            v = item.get(h, "")
+            if isinstance(v, (list, dict)):
+                v = json.dumps(v, ensure_ascii=False)
+            row.append(v)
+        yield writer.writerow(row)
+
+def iter_json(rows):
+    # Same layout as json.dump(rows, indent=2), one row at a time
+    first = True
+    for item in rows:
+        yield ('[\n' if first else ',\n') + textwrap.indent(json.dumps(item, ensure_ascii=False, indent=2), '  ')
+        first = False
+    yield '[]' if first else '\n]'
+
+def iter_ndjson(rows):
+    for item in rows:
+        yield json.dumps(item, ensure_ascii=False) + '\n'
+
+def _flatten_into(flat, path, value):
+    if isinstance(value, dict) and value:
+        for key, child in value.items():
+            _flatten_into(flat, f'{path}.{key}', child)
+    elif isinstance(value, list) and value:
+        for index, child in enumerate(value):
+            _flatten_into(flat, f'{path}.{index}', child)
     else:
+        flat[path] = '' if isinstance(value, (dict, list)) else value
+
+def flatten_record(item):
+    # {'vendor': {'name': 'A'}, 'items': [{'qty': 1}]} -> {'vendor.name': 'A', 'items.0.qty': 1}
+    flat = {}
+    for key, value in _as_record(item).items():
+        _flatten_into(flat, str(key), value)
+    return flat
+
+def _xlsx_cell(value, illegal_characters):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return illegal_characters.sub('', str(value))
+
+def iter_xlsx(rows):
+    # Write-only workbook: rows are serialized to a temp file as they are appended,
+    # so memory stays flat; the finished workbook is then streamed out in chunks.
+    # openpyxl takes ~0.1s to import, so it is only loaded for XLSX results.
+    import openpyxl
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+    headers = {}
+    for item in rows:
+        for key in flatten_record(item):
+            headers.setdefault(key, None)
+    headers = list(headers)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Results')
+    if headers:
+        sheet.append(headers)
+        for item in rows:
+            flat = flatten_record(item)
+            sheet.append([_xlsx_cell(flat.get(h), ILLEGAL_CHARACTERS_RE) for h in headers])
+    else:
+        sheet.append(["No data extracted"])
+    with tempfile.TemporaryFile() as tmp:
+        workbook.save(tmp)
+        tmp.seek(0)
+        yield from iter(lambda: tmp.read(STREAM_CHUNK_SIZE), b'')
+
+RESULT_WRITERS = {
+    'csv': iter_csv,
+    'json': iter_json,
+    'ndjson': iter_ndjson,
+    'xlsx': iter_xlsx,
+}
+BINARY_FORMATS = {'xlsx'}  # already compressed, never gzipped again
+
+def _to_bytes(chunk):
+    return chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+
+def iter_result_chunks(rows, result_format):
+    # rows must be re-iterable: CSV makes a first pass to collect the header union
+    if result_format not in RESULT_WRITERS:
         raise ValueError("Unsupported format")
+    return RESULT_WRITERS[result_format](rows)
 
-def process_documents_with_gemini(documents, custom_fields, strict_mode):
-    all_data = []
-    prompt = build_gemini_prompt(custom_fields, strict_mode)
-    for doc in documents:
-        file_obj = doc.file  # mongoengine FileField returns a file-like object
-        extracted_json = extract_data_from_file(file_obj, prompt=prompt)
+def generate_result_file(batch_id, all_data, result_format):
+    content = b''.join(_to_bytes(chunk) for chunk in iter_result_chunks(all_data, result_format))
+    return (f'result_{str(batch_id)}.{result_format}', content)
+
+class _GridFSSink:
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.size = 0
+
+    def write(self, data):
+        self.proxy.write(data)
+        self.size += len(data)
+        return len(data)
+
+def write_result_file(file_field, filename, chunks, compress=False, content_type=None):
+    # Writes text chunks straight into a new GridFS file (optionally gzipped) as they are produced
+    if compress:
+        filename += '.gz'
+    if file_field.grid_id:
+        file_field.delete()  # a re-run batch: the previous file would stay in GridFS unreferenced
+    file_field.new_file(filename=filename, content_type=content_type)
+    sink = _GridFSSink(file_field)
+    out = gzip.GzipFile(filename=filename[:-3], mode='wb', fileobj=sink, mtime=0) if compress else sink
+    for data in _iter_encoded(chunks):
+        out.write(data)
+    if compress:
+        out.close()
+    file_field.close()
+    return filename, sink.size
+
+def store_batch_results(batch, all_data, compress=None):
+    if compress is None:
+        compress = settings.RESULT_FILE_GZIP
+    # Canonical rows first (uncompressed NDJSON, read back line by line for conversions)
+    write_result_file(batch.rows_file, f'rows_{batch.id}.ndjson', iter_ndjson(all_data),
+                      content_type=RESULT_CONTENT_TYPES['ndjson'])
+    compress = compress and batch.result_format not in BINARY_FORMATS
+    with STAGE_SECONDS.time(stage='result_write'):
+        _, batch.result_size = write_result_file(batch.result_file, f'result_{batch.id}.{batch.result_format}',
+                          iter_result_chunks(all_data, batch.result_format), compress=compress,
+                          content_type=RESULT_CONTENT_TYPES[batch.result_format])
+    RESULT_BYTES.observe(batch.result_size, format=batch.result_format)
+    batch.result_compressed = compress
+    store_extracted_rows(batch, all_data)
+
+# Rows inserted per insert_many call
+EXTRACTED_ROWS_CHUNK_SIZE = 1000
+
+def store_extracted_rows(batch, rows):
+    # Replaces the batch's ExtractedRow documents, so a re-run batch never keeps stale rows.
+    # rows may be any iterable in document order; it is inserted in chunks.
+    ExtractedRow.objects(batch=batch.id).delete()
+    documents = batch.documents
+    now = datetime.datetime.utcnow()
+    chunk = []
+    for index, row in enumerate(rows):
+        doc = documents[index] if index < len(documents) else None
+        file_name = batch.file_names[index] if index < len(batch.file_names) else getattr(doc, 'file_name', None)
+        chunk.append(ExtractedRow(
+            batch=batch.id,
+            user=batch.user,
+            document=getattr(doc, 'id', None),  # a document or, without dereferencing, a DBRef
+            index=index,
+            file_name=file_name,
+            data=_as_record(row),
+            values=normalize_record(flatten_record(row)),
+            created_at=now,
+        ))
+        if len(chunk) >= EXTRACTED_ROWS_CHUNK_SIZE:
+            ExtractedRow.objects.insert(chunk, load_bulk=False)
+            chunk = []
+    if chunk:
+        ExtractedRow.objects.insert(chunk, load_bulk=False)
+
+class StoredRows:
+    # Re-iterable view over a batch's stored rows
+    def __init__(self, batch):
+        self.batch = batch
+
+    def __iter__(self):
+        return iter_batch_rows(self.batch)
+
+def iter_batch_rows(batch):
+    if batch.rows_file:
+        batch.rows_file.seek(0)
+        for line in iter(batch.rows_file.readline, b''):
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    elif batch.result_file:
+        # Batches processed before rows were stored separately: read them back from the result file
+        batch.result_file.seek(0)
+        content = batch.result_file.read().decode('utf-8')
+        if batch.result_format == 'json':
+            yield from json.loads(content)
+        elif batch.result_format == 'ndjson':
+            yield from (json.loads(line) for line in content.splitlines() if line.strip())
+        else:
+            yield from csv.DictReader(StringIO(content))
+
+def _etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+def _parse_range_header(range_header, size):
+    # Single byte ranges only; multipart ranges are answered with the full body.
+    # Raises ValueError when the range cannot be satisfied.
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        suffix = int(end)
+        if suffix == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - suffix, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+def _iter_file_range(file_obj, start, length):
+    file_obj.seek(start)
+    remaining = length
+    while remaining > 0:
+        chunk = file_obj.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+def _accepts_gzip(request):
+    return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '').lower()
+
+def _iter_encoded(chunks):
+    # Coalesces small text/bytes chunks into ~STREAM_CHUNK_SIZE byte blocks
+    buffer, buffered = [], 0
+    for chunk in chunks:
+        chunk = _to_bytes(chunk)
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+def _iter_gunzip(file_obj):
+    file_obj.seek(0)
+    with gzip.GzipFile(fileobj=file_obj, mode='rb') as decompressed:
+        yield from iter(lambda: decompressed.read(STREAM_CHUNK_SIZE), b'')
+
+def _response_stream(request, chunks):
+    # Under ASGI Django buffers a sync iterator whole before sending it, so the
+    # blocking chunks are pulled one at a time in a worker thread instead
+    if isinstance(request, ASGIRequest):
+        return iterate_in_thread(chunks)
+    return chunks
+
+def streaming_download_response(request, chunks, etag, filename, content_type):
+    # Body of unknown length (converted or decompressed on the fly), so no Range support
+    response = StreamingHttpResponse(_response_stream(request, chunks), content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private'
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+def stream_file_response(request, file_obj, size, etag, filename, content_type, content_encoding=None):
+    if _etag_matches(request, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    start, end, status = 0, size - 1, 200
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and size and (not if_range or if_range == etag):
         try:
-            all_data.append(json.loads(extracted_json))
-        except Exception as e:
-            print(f"[Batch] Error loading JSON from Gemini response: {e}")
-            all_data.append({})
+            byte_range = _parse_range_header(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if byte_range:
+            start, end = byte_range
+            status = 206
+
+    length = end - start + 1 if size else 0
+    response = StreamingHttpResponse(_response_stream(request, _iter_file_range(file_obj, start, length)),
+                                     status=status, content_type=content_type)
+    response['Content-Length'] = str(length)
+    if status == 206:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    if content_encoding:
+        response['Content-Encoding'] = content_encoding
+        response['Vary'] = 'Accept-Encoding'
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private'
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+def extract_document_data(doc, prompt):
+    try:
+        file_obj = doc.file  # mongoengine FileField returns a file-like object
+        extracted_json = extract_data_from_file(file_obj, prompt=prompt, file_hash=doc.file_hash)
+        data = json.loads(extracted_json)
+    except GeminiRateLimitError:
+        # Not an empty row: fails the batch, which keeps its checkpoints and can be resumed
+        DOCUMENTS_EXTRACTED.inc(outcome='failed')
+        raise
+    except Exception as e:
+        DOCUMENTS_EXTRACTED.inc(outcome='failed')
+        EXTRACTION_ERRORS.inc(reason=type(e).__name__)
+        logger.warning("Error extracting data from document",
+                       extra={'event': 'document_failed', 'document_id': str(doc.id), 'error': str(e)})
+        return {}
+    DOCUMENTS_EXTRACTED.inc(outcome='extracted' if data else 'empty')
+    return data
+
+async def extract_document_data_async(doc, prompt):
+    try:
+        extracted_json = await extract_data_from_file_async(doc.file, prompt=prompt, file_hash=doc.file_hash)
+        data = json.loads(extracted_json)
+    except GeminiRateLimitError:
+        DOCUMENTS_EXTRACTED.inc(outcome='failed')
+        raise
+    except Exception as e:
+        DOCUMENTS_EXTRACTED.inc(outcome='failed')
+        EXTRACTION_ERRORS.inc(reason=type(e).__name__)
+        logger.warning("Error extracting data from document",
+                       extra={'event': 'document_failed', 'document_id': str(doc.id), 'error': str(e)})
+        return {}
+    DOCUMENTS_EXTRACTED.inc(outcome='extracted' if data else 'empty')
+    return data
+
+def plan_document_packs(documents, max_bytes, max_documents):
+    # Groups consecutive small documents into packs of at most max_bytes (raw file size)
+    # and max_documents; larger documents get a pack of their own
+    packs, current, current_bytes = [], [], 0
+    for index, doc in enumerate(documents):
+        size = doc.file.length or 0
+        if size > max_bytes:
+            packs.append([index])
+            continue
+        if current and (current_bytes + size > max_bytes or len(current) >= max_documents):
+            packs.append(current)
+            current, current_bytes = [], 0
+        current.append(index)
+        current_bytes += size
+    if current:
+        packs.append(current)
+    return packs
+
+def extract_pack_data(docs, prompt):
+    if len(docs) == 1:
+        return [extract_document_data(docs[0], prompt)]
+    try:
+        results = extract_data_from_files([doc.file for doc in docs], prompt=prompt,
+                                          file_hashes=[doc.file_hash for doc in docs])
+    except GeminiRateLimitError:
+        raise
+    except Exception as e:
+        logger.warning("Error extracting packed documents", extra={'event': 'pack_failed', 'error': str(e)})
+        results = None
+    if results is None:
+        logger.info("Falling back to one request per document",
+                    extra={'event': 'pack_fallback', 'documents': len(docs)})
+        return [extract_document_data(doc, prompt) for doc in docs]
+    rows = [json.loads(result) for result in results]
+    for row in rows:
+        DOCUMENTS_EXTRACTED.inc(outcome='extracted' if row else 'empty')
+    return rows
+
+def process_documents_with_gemini(documents, custom_fields, strict_mode, concurrency=None, pack=None, on_progress=None):
+    # on_progress(index, row) is called from the worker threads as each document finishes
+    prompt = build_gemini_prompt(custom_fields, strict_mode)
+    documents = list(documents)
+    if concurrency is None:
+        concurrency = settings.GEMINI_CONCURRENCY
+    if pack is None:
+        pack = settings.GEMINI_PACK_DOCUMENTS
+    if pack:
+        packs = plan_document_packs(documents, settings.GEMINI_PACK_MAX_BYTES, settings.GEMINI_PACK_MAX_DOCUMENTS)
+    else:
+        packs = [[index] for index in range(len(documents))]
+
+    def run_pack(indexes):
+        rows = extract_pack_data([documents[i] for i in indexes], prompt)
+        if on_progress:
+            for index, row in zip(indexes, rows):
+                on_progress(index, row)
+        return rows
+
+    if concurrency <= 1 or len(packs) <= 1:
+        pack_results = [run_pack(indexes) for indexes in packs]
+    else:
+        # executor.map yields results in input order, so rows line up with documents
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(packs))) as executor:
+            pack_results = list(executor.map(run_pack, packs))
+
+    all_data = [{}] * len(documents)
+    for indexes, rows in zip(packs, pack_results):
+        for index, row in zip(indexes, rows):
+            all_data[index] = row
     return all_data
 
+async def process_documents_with_gemini_async(documents, custom_fields, strict_mode, concurrency=None, on_progress=None):
+    # asyncio counterpart of process_documents_with_gemini: up to `concurrency` requests in flight
+    # on one event loop. Documents are never packed here. on_progress is blocking and runs in a thread.
+    prompt = build_gemini_prompt(custom_fields, strict_mode)
+    documents = list(documents)
+    if concurrency is None:
+        concurrency = settings.GEMINI_ASYNC_CONCURRENCY
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def run_document(index, doc):
+        async with semaphore:
+            row = await extract_document_data_async(doc, prompt)
+        if on_progress:
+            await asyncio.to_thread(on_progress, index, row)
+        return row
+
+    # gather returns results in input order, so rows line up with documents
+    return list(await asyncio.gather(*(run_document(index, doc) for index, doc in enumerate(documents))))
+
 def custom_login_required(view_func):
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def _wrapped_async_view(request, *args, **kwargs):
+            # The first read of the session may query MongoDB: keep it off the event loop
+            if not await sync_to_async(request.session.get)('user_id'):
+                return HttpResponseRedirect('/login/')
+            return await view_func(request, *args, **kwargs)
+        return _wrapped_async_view
+
     @wraps(view_func)
     def _wrapped_view(request, *args, **kwargs):
         if not request.session.get('user_id'):
@@ -145,82 +640,549 @@ def logout_view(request):
     request.session.flush()
     return redirect('/')
 
+def _recent_batches(user_id):
+    return list(DocumentBatch.objects(user=user_id).only(*DocumentBatch.SUMMARY_FIELDS).order_by('-created_at').limit(5))
+
+def queue_batch(valid_files, user_id, result_format, custom_fields, strict_mode):
+    # Extraction runs in the batch worker (manage.py process_batches), not in this request.
+    # Returns None when nothing could be saved (archives without PDF or image members).
+    user_docs = save_user_documents(valid_files)
+    if not user_docs:
+        return None
+    batch = DocumentBatch(
+        documents=user_docs,
+        status='pending',
+        result_format=result_format,
+        custom_fields=custom_fields,
+        strict_mode=strict_mode,
+        user=user_id,
+        document_count=len(user_docs),
+        file_names=[doc.file_name for doc in user_docs],
+    )
+    batch.save()
+    return batch
+
+def _csrf_rejection(request):
+    # The check CsrfViewMiddleware skips for csrf_exempt views. With the token in the X-CSRFToken
+    # header (the upload page sends it) the check runs against an empty POST, so the body is not
+    # parsed yet; otherwise the middleware reads the token from request.POST.
+    if request.META.get('HTTP_X_CSRFTOKEN'):
+        request._post, request._files = QueryDict(), MultiValueDict()
+        try:
+            return CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {})
+        finally:
+            del request._post, request._files
+    return CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {})
+
+def _parse_upload(request, handler):
+    # Parsing the multipart body writes the uploads into GridFS. If it fails part-way (too many
+    # files, body too large, client disconnected) Django raises and request.FILES is never built.
+    try:
+        return request.FILES.getlist('documents')
+    except Exception:
+        handler.discard_stored()
+        raise
+
 @custom_login_required
-def upload_and_parse_documents(request):
+async def upload_and_parse_documents(request):
+    # GridFS and MongoDB calls block, so they run in threads; the event loop stays free.
+    # Exempt from CsrfViewMiddleware only to run its check here: the GridFS upload handler must be
+    # installed before the body is parsed, and only for logged-in users whose CSRF token is already
+    # checked (see parser/upload_handlers.py). A plain form post carries the token in the body, so
+    # its files go through Django's default handlers instead.
     user_id = request.session.get('user_id')
-    user_batches = DocumentBatch.objects(user=user_id).order_by('-created_at').limit(5)
 
     if request.method == 'POST':
+        rejection = await sync_to_async(_csrf_rejection)(request)
+        if rejection is not None:
+            return rejection
+        if request.META.get('HTTP_X_CSRFTOKEN'):
+            handler = install_upload_handler(request)
+            await sync_to_async(_parse_upload)(request, handler)
         uploaded_files = request.FILES.getlist('documents')
-        allowed_types = ['pdf', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff']
-        valid_files = validate_uploaded_files(uploaded_files, allowed_types)
+        valid_files = validate_uploaded_files(uploaded_files, ALLOWED_FILE_TYPES, allow_archives=True)
         if not valid_files:
-            messages.error(request, 'No valid files found. Please upload PDF or image files.')
+            messages.error(request, 'No valid files found. Please upload PDF or image files, or ZIP/TAR archives of them.')
+            user_batches = await sync_to_async(_recent_batches)(user_id)
             return render(request, 'parser/upload.html', {'user_batches': user_batches})
 
         custom_fields = request.POST.getlist('custom_fields[]')
         strict_mode = bool(request.POST.get('strict_mode'))
         result_format = request.POST.get('result_format', 'csv')
-        if result_format not in ['csv', 'json']:
-            messages.error(request, 'Invalid result format selected. Please choose CSV or JSON.')
+        if result_format not in RESULT_CONTENT_TYPES:
+            await sync_to_async(discard_uploaded_files)(valid_files)
+            messages.error(request, 'Invalid result format selected. Please choose CSV, JSON, NDJSON or XLSX.')
+            user_batches = await sync_to_async(_recent_batches)(user_id)
             return render(request, 'parser/upload.html', {'user_batches': user_batches})
-        user_docs = save_user_documents(valid_files)
-
-        batch = DocumentBatch(
-            documents=user_docs,
-            status='processing',
-            result_format=result_format,
-            custom_fields=custom_fields,
-            strict_mode=strict_mode,
-            user=user_id
-        )
-        batch.save()
-
-        all_data = process_documents_with_gemini(user_docs, custom_fields, strict_mode)
-        try:
-            filename, file_bytes = generate_result_file(batch.id, all_data, result_format)
-            batch.result_file.put(file_bytes, filename=filename)
-            batch.status = 'completed'
-            batch.save()
-            messages.success(request, f"Successfully processed {len(valid_files)} documents!")
-        except Exception as e:
-            batch.status = 'failed'
-            batch.save()
-            messages.error(request, f"Failed to generate result file: {e}")
+        batch = await sync_to_async(queue_batch)(valid_files, user_id, result_format, custom_fields, strict_mode)
+        if batch is None:
+            messages.error(request, 'The uploaded archives contain no PDF or image files, or could not be read.')
+            user_batches = await sync_to_async(_recent_batches)(user_id)
+            return render(request, 'parser/upload.html', {'user_batches': user_batches})
+        messages.success(request, f"Queued {batch.document_count} documents for processing.")
         return redirect('batch_result', batch_id=str(batch.id))
 
-    return render(request, 'parser/upload.html', {'user_batches': user_batches, 'allowed_formats': ['csv', 'json']})
+    user_batches = await sync_to_async(_recent_batches)(user_id)
+    return render(request, 'parser/upload.html', {'user_batches': user_batches, 'allowed_formats': list(RESULT_CONTENT_TYPES)})
+
+# Same as @csrf_exempt, which would wrap the coroutine function in a sync view in Django 4.2
+upload_and_parse_documents.csrf_exempt = True
+
+def _user_batch(batch_id, user_id):
+    # The user's batch, or None when the id is malformed or the batch belongs to someone else
+    try:
+        return DocumentBatch.objects(id=ObjectId(batch_id), user=user_id).first()
+    except InvalidId:
+        return None
 
+# Bytes of a text result shown on the result page
+RESULT_PREVIEW_BYTES = 2048
+
+def _result_preview(batch):
+    # The start of the stored result, read without loading the whole file
+    if batch.status != 'completed' or not batch.result_file or batch.result_format == 'xlsx':
+        return None
+    stored = batch.result_file.get()
+    if batch.result_compressed:
+        with gzip.GzipFile(fileobj=stored, mode='rb') as decompressed:
+            head = decompressed.read(RESULT_PREVIEW_BYTES)
+    else:
+        head = stored.read(RESULT_PREVIEW_BYTES)
+    return head.decode('utf-8', errors='ignore')  # the cut may split a character
+
+@custom_login_required
 def batch_result(request, batch_id):
-    batch = DocumentBatch.objects(id=ObjectId(batch_id)).first()
+    batch = _user_batch(batch_id, request.session.get('user_id'))
+    if not batch:
+        return JsonResponse({'success': False, 'error': 'Batch not found'}, status=404)
+    return render(request, 'parser/batch_result.html', {'batch': batch, 'result_preview': _result_preview(batch)})
+
+@custom_login_required
+def resume_batch_view(request, batch_id):
+    from .jobs import resume_batch  # jobs imports this module
+
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=405)
+    batch = DocumentBatch.objects(id=ObjectId(batch_id), user=request.session.get('user_id')).only('id').first()
+    if not batch:
+        return JsonResponse({'success': False, 'error': 'Batch not found'}, status=404)
+    if resume_batch(batch.id) is None:
+        messages.error(request, 'Only failed or stalled batches can be resumed.')
+    else:
+        messages.success(request, 'Batch queued again. Documents that were already extracted are not sent again.')
+    return redirect('batch_result', batch_id=batch_id)
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+def batch_summary(batch):
+    return {
+        'batch_id': str(batch.id),
+        'status': batch.status,
+        'document_count': batch.document_count,
+        'file_names': batch.file_names,
+        'result_format': batch.result_format,
+        'result_size': batch.result_size,
+        'created_at': _isoformat(batch.created_at),
+        'started_at': _isoformat(batch.started_at),
+        'finished_at': _isoformat(batch.finished_at),
+        'error': batch.error,
+    }
+
+def batch_status(request, batch_id):
+    user_id = request.session.get('user_id')
+    if not user_id:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=401)
+    try:
+        batch = (DocumentBatch.objects(id=ObjectId(batch_id), user=user_id)
+                 .only(*DocumentBatch.SUMMARY_FIELDS).first())
+    except InvalidId:
+        batch = None
+    if not batch:
+        return JsonResponse({'success': False, 'error': 'Batch not found'}, status=404)
+    return JsonResponse({'success': True, **batch_summary(batch)})
+
+# Progress entries read per poll; the rest follow on the next poll
+BATCH_EVENTS_PAGE_SIZE = 500
+
+def _batch_progress(batch_id, seen):
+    # Batch summary plus only the progress entries the client has not seen yet
+    return (DocumentBatch.objects(id=batch_id).only(*DocumentBatch.SUMMARY_FIELDS)
+            .fields(slice__progress=[seen, BATCH_EVENTS_PAGE_SIZE]).first())
+
+def _sse_event(event, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, cls=DjangoJSONEncoder)}')
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+async def iter_batch_events(batch_id, seen=0):
+    # `document` events carry the running count as their id, so a reconnecting
+    # EventSource (Last-Event-ID) resumes where it left off
+    poll_interval = settings.BATCH_EVENTS_POLL_INTERVAL
+    last_status, idle = None, 0.0
+    while True:
+        batch = await sync_to_async(_batch_progress, thread_sensitive=False)(batch_id, seen)
+        if batch is None:
+            return
+        for entry in batch.progress:
+            seen += 1
+            yield _sse_event('document', entry, event_id=seen)
+            idle = 0.0
+        if batch.status != last_status:
+            last_status = batch.status
+            yield _sse_event('status', batch_summary(batch))
+            idle = 0.0
+        if batch.status in ('completed', 'failed') and len(batch.progress) < BATCH_EVENTS_PAGE_SIZE:
+            yield _sse_event('done', batch_summary(batch))
+            return
+        await asyncio.sleep(poll_interval)
+        idle += poll_interval
+        if idle >= settings.BATCH_EVENTS_KEEPALIVE:
+            idle = 0.0
+            yield b': keepalive\n\n'  # comment line, keeps proxies from closing an idle stream
+
+async def batch_events(request, batch_id):
+    # Server-Sent Events stream of per-document progress. Served incrementally under
+    # ASGI; a WSGI server only delivers it once the batch has finished.
+    user_id = await sync_to_async(request.session.get)('user_id')
+    if not user_id:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=401)
+    try:
+        batch_id = ObjectId(batch_id)
+    except InvalidId:
+        return JsonResponse({'success': False, 'error': 'Batch not found'}, status=404)
+    # Other users' batches are reported as missing; later polls go by id only
+    if not await sync_to_async(DocumentBatch.objects(id=batch_id, user=user_id).only('id').first)():
+        return JsonResponse({'success': False, 'error': 'Batch not found'}, status=404)
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    seen = int(last_event_id) if last_event_id.isdigit() else 0
+    response = StreamingHttpResponse(iter_batch_events(batch_id, seen), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx: pass events through unbuffered
+    return response
+
+def _encode_history_cursor(batch):
+    raw = f"{batch.created_at.isoformat()}|{batch.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def _decode_history_cursor(cursor):
+    created_at, batch_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+    return datetime.datetime.fromisoformat(created_at), ObjectId(batch_id)
+
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+def batch_history(request):
+    # Keyset pagination over (created_at, _id) descending, served by the (user, -created_at, -_id) index
+    user_id = request.session.get('user_id')
+    if not user_id:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=401)
+    try:
+        limit = min(max(int(request.GET.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid limit'}, status=400)
+
+    batches = DocumentBatch.objects(user=user_id)
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            created_at, last_id = _decode_history_cursor(cursor)
+        except (ValueError, TypeError, InvalidId):
+            return JsonResponse({'success': False, 'error': 'Invalid cursor'}, status=400)
+        batches = batches.filter(__raw__={'$or': [
+            {'created_at': {'$lt': created_at}},
+            {'created_at': created_at, '_id': {'$lt': last_id}},
+        ]})
+    page = list(batches.only(*DocumentBatch.SUMMARY_FIELDS).order_by('-created_at', '-id').limit(limit + 1))
+    has_more = len(page) > limit
+    page = page[:limit]
+    return JsonResponse({
+        'success': True,
+        'results': [batch_summary(batch) for batch in page],
+        'next_cursor': _encode_history_cursor(page[-1]) if has_more else None,
+    })
+
+ROWS_PAGE_SIZE = 50
+ROWS_MAX_PAGE_SIZE = 500
+# Query parameters that are not row filters
+ROWS_RESERVED_PARAMS = {'page', 'page_size', 'fields', 'file_name'}
+ROWS_FILTER_OPERATORS = ('eq', 'ne', 'gt', 'gte', 'lt', 'lte', 'contains', 'icontains', 'exists')
+
+def _row_field_path(name):
+    # Custom fields may contain spaces; nested values are addressed with dots
+    parts = name.split('.')
+    if not all(parts) or any(part.startswith('$') for part in parts):
+        raise ValueError(f"Invalid field name: {name}")
+    return 'data.' + name
+
+def _filter_candidates(value):
+    # Query strings are untyped, so '12' matches both the string and the number
+    candidates = [value]
+    for cast in (int, float):
+        try:
+            candidates.append(cast(value))
+            break
+        except ValueError:
+            continue
+    if value.lower() in ('true', 'false'):
+        candidates.append(value.lower() == 'true')
+    return candidates
+
+def _row_filter(operator, value):
+    if operator == 'eq':
+        return {'$in': _filter_candidates(value)}
+    if operator == 'ne':
+        return {'$nin': _filter_candidates(value)}
+    if operator in ('gt', 'gte', 'lt', 'lte'):
+        return {'$' + operator: _filter_candidates(value)[-1]}
+    if operator in ('contains', 'icontains'):
+        condition = {'$regex': re.escape(value)}
+        if operator == 'icontains':
+            condition['$options'] = 'i'
+        return condition
+    return {'$exists': value.lower() not in ('0', 'false', 'no')}
+
+def parse_row_filters(params):
+    # `field=value` or `field__<operator>=value` for every non-reserved parameter
+    conditions = []
+    for key, values in params.lists():
+        if key in ROWS_RESERVED_PARAMS:
+            continue
+        name, _, operator = key.rpartition('__') if '__' in key else (key, '', 'eq')
+        if operator not in ROWS_FILTER_OPERATORS:
+            raise ValueError(f"Unknown filter operator: {operator}")
+        path = _row_field_path(name)
+        conditions.extend({path: _row_filter(operator, value)} for value in values)
+    if params.get('file_name'):
+        conditions.append({'file_name': params['file_name']})
+    return conditions
+
+def parse_row_projection(fields):
+    # Whole rows when no fields are requested; otherwise only the requested data fields
+    names = [name.strip() for name in (fields or '').split(',') if name.strip()]
+    return [_row_field_path(name) for name in names]
+
+def _row_json(row):
+    return {
+        'index': row['index'],
+        'document_id': str(row['document']) if row.get('document') else None,
+        'file_name': row.get('file_name'),
+        'data': row.get('data', {}),
+    }
+
+def batch_rows(request, batch_id):
+    # Extracted rows of a batch, page by page, filtered and projected in MongoDB.
+    # Every query is bounded by the unique (batch, index) index.
+    user_id = request.session.get('user_id')
+    if not user_id:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=401)
+    try:
+        batch = DocumentBatch.objects(id=ObjectId(batch_id), user=user_id).only('id', 'status').first()
+    except InvalidId:
+        batch = None
     if not batch:
         return JsonResponse({'success': False, 'error': 'Batch not found'}, status=404)
-    return render(request, 'parser/batch_result.html', {'batch': batch})
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        page_size = min(max(int(request.GET.get('page_size', ROWS_PAGE_SIZE)), 1), ROWS_MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid page or page_size'}, status=400)
+    try:
+        conditions = parse_row_filters(request.GET)
+        projection = parse_row_projection(request.GET.get('fields'))
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    query = {'batch': batch.id}
+    if conditions:
+        query['$and'] = conditions
+    rows = ExtractedRow.objects(__raw__=query)
+    total = rows.count()
+    start = (page - 1) * page_size
+    if conditions:
+        page_rows = rows.order_by('index').skip(start).limit(page_size)
+    else:
+        # Indexes are dense (0..n-1), so an unfiltered page is a range scan rather than a skip
+        page_rows = ExtractedRow.objects(batch=batch.id, index__gte=start, index__lt=start + page_size).order_by('index')
+    if projection:
+        page_rows = page_rows.only('index', 'document', 'file_name', *projection)
+    else:
+        page_rows = page_rows.exclude('values')
+    return JsonResponse({
+        'success': True,
+        'batch_id': str(batch.id),
+        'status': batch.status,
+        'page': page,
+        'page_size': page_size,
+        'total': total,
+        'num_pages': (total + page_size - 1) // page_size,
+        'results': [_row_json(row) for row in page_rows.exclude('id').as_pymongo()],
+    })
+
+AGGREGATE_PERIODS = {'day': '%Y-%m-%d', 'week': '%G-W%V', 'month': '%Y-%m', 'year': '%Y'}
+AGGREGATE_MAX_GROUPS = 1000
+
+def _value_of(key):
+    # The values entry for `key`, or null when the row does not have the field
+    return {'$arrayElemAt': [{'$filter': {'input': '$values', 'cond': {'$eq': ['$$this.key', key]}}}, 0]}
+
+def build_aggregation_pipeline(user_id, metric, group_by=(), period=None, date_field='date',
+                               date_from=None, date_to=None, batch_ids=None):
+    # Groups a user's rows by text fields (and a calendar period of date_field) and
+    # returns count/sum/min/max/avg of the numeric field `metric` for each group.
+    # Amounts in different currencies are never summed together.
+    match = {'user': user_id, 'values': {'$elemMatch': {'key': metric, 'number': {'$exists': True}}}}
+    if batch_ids:
+        match['batch'] = {'$in': batch_ids}
+    if date_from or date_to:
+        date_range = {}
+        if date_from:
+            date_range['$gte'] = date_from
+        if date_to:
+            date_range['$lt'] = date_to
+        match['$and'] = [{'values': {'$elemMatch': {'key': date_field, 'date': date_range}}}]
+
+    project = {'metric': _value_of(metric)}
+    # Key order is the sort order: period, then the group fields. Fields are aliased g0, g1, ...:
+    # a field name such as vendor.name is not a valid _id key (see _group_key).
+    group_id = {}
+    if period:
+        project['period_date'] = _value_of(date_field)
+        group_id['period'] = {'$dateToString': {'format': AGGREGATE_PERIODS[period], 'date': '$period_date.date'}}
+    for index, key in enumerate(group_by):
+        project[f'g{index}'] = _value_of(key)
+        group_id[f'g{index}'] = {'$ifNull': [f'$g{index}.text', f'$g{index}.number']}
+    group_id['currency'] = '$metric.currency'
+    return [
+        {'$match': match},
+        {'$project': project},
+        {'$group': {
+            '_id': group_id,
+            'count': {'$sum': 1},
+            'sum': {'$sum': '$metric.number'},
+            'min': {'$min': '$metric.number'},
+            'max': {'$max': '$metric.number'},
+            'avg': {'$avg': '$metric.number'},
+        }},
+        {'$sort': {'_id': 1}},
+        {'$limit': AGGREGATE_MAX_GROUPS + 1},
+    ]
+
+def _group_key(group_id, group_by, period):
+    # The _id of a build_aggregation_pipeline group under the requested field names;
+    # MongoDB omits missing values from _id
+    key = {'period': group_id.get('period')} if period else {}
+    key.update((name, group_id.get(f'g{index}')) for index, name in enumerate(group_by))
+    key['currency'] = group_id.get('currency')
+    return key
+
+def aggregate_rows(request):
+    # e.g. ?metric=total&group_by=vendor&period=month&date_field=invoice_date
+    # Field names are matched in normalized form ('Invoice Total' == 'invoice_total').
+    user_id = request.session.get('user_id')
+    if not user_id:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=401)
+    metric = normalize_key(request.GET.get('metric', ''))
+    if not metric:
+        return JsonResponse({'success': False, 'error': 'metric is required'}, status=400)
+    group_by = [normalize_key(name) for name in request.GET.get('group_by', '').split(',') if name.strip()]
+    period = request.GET.get('period') or None
+    if period and period not in AGGREGATE_PERIODS:
+        return JsonResponse({'success': False, 'error': f"period must be one of {', '.join(AGGREGATE_PERIODS)}"},
+                            status=400)
+    date_field = normalize_key(request.GET.get('date_field', 'date'))
+    try:
+        date_from, date_to = (parse_date(request.GET[name]) if request.GET.get(name) else None
+                              for name in ('date_from', 'date_to'))
+        batch_ids = [ObjectId(batch_id) for batch_id in request.GET.getlist('batch')]
+    except InvalidId:
+        return JsonResponse({'success': False, 'error': 'Invalid batch id'}, status=400)
+    if any(request.GET.get(name) and value is None for name, value in (('date_from', date_from), ('date_to', date_to))):
+        return JsonResponse({'success': False, 'error': 'Invalid date_from or date_to'}, status=400)
+
+    pipeline = build_aggregation_pipeline(user_id, metric, group_by, period, date_field, date_from, date_to, batch_ids)
+    with STAGE_SECONDS.time(stage='aggregate'):
+        groups = list(ExtractedRow.objects.aggregate(pipeline))
+    truncated = len(groups) > AGGREGATE_MAX_GROUPS
+    return JsonResponse({
+        'success': True,
+        'metric': metric,
+        'group_by': group_by,
+        'period': period,
+        'groups': [{**_group_key(group['_id'], group_by, period),
+                    **{name: group[name] for name in ('count', 'sum', 'min', 'max', 'avg')}}
+                   for group in groups[:AGGREGATE_MAX_GROUPS]],
+        'truncated': truncated,
+    })
+
+def metrics_view(request):
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def healthz(request):
+    # Liveness: the process answers requests; says nothing about MongoDB
+    return JsonResponse({'status': 'ok'})
+
+def readyz(request):
+    # Readiness: this worker has warmed up and MongoDB answers (see parser/startup.py)
+    ready, details = readiness()
+    return JsonResponse({'status': 'ready' if ready else 'not ready', **details}, status=200 if ready else 503)
 
-@csrf_exempt
 def delete_document(request, doc_id):
     if request.method == 'POST':
-        doc = UserDocument.objects(id=ObjectId(doc_id)).first()
+        user_id = request.session.get('user_id')
+        if not user_id:
+            return JsonResponse({'success': False, 'error': 'Authentication required'}, status=401)
+        # Documents have no owner field: they belong to the user whose batch lists them
+        try:
+            doc_id = ObjectId(doc_id)
+        except InvalidId:
+            doc = None
+        else:
+            owned = DocumentBatch.objects(user=user_id, documents=doc_id).only('id').first()
+            doc = UserDocument.objects(id=doc_id).first() if owned else None
         if doc:
             doc.delete()
             return JsonResponse({'success': True})
         else:
-            return JsonResponse({'success': False, 'error': 'Document not found'})
+            return JsonResponse({'success': False, 'error': 'Document not found'}, status=404)
     return JsonResponse({'success': False, 'error': 'Invalid request'})
 
-def download_batch_result(request, batch_id, format):
-    batch = DocumentBatch.objects(id=ObjectId(batch_id)).first()
+async def download_batch_result(request, batch_id, format):
+    # Only the lookups block (in threads); under ASGI the body streams from the event loop
+    user_id = await sync_to_async(request.session.get)('user_id')
+    if not user_id:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=401)
+    batch = await sync_to_async(_user_batch)(batch_id, user_id)
     if not batch:
         return JsonResponse({'success': False, 'error': 'Batch not found'}, status=404)
 
-    if format not in ['csv', 'json']:
+    if format not in RESULT_CONTENT_TYPES:
         return JsonResponse({'success': False, 'error': 'Invalid format'}, status=400)
 
-    all_data = process_documents_with_gemini(batch.documents, batch.custom_fields, batch.strict_mode)
-    filename, file_bytes = generate_result_file(batch.id, all_data, format)
-    content_type = {
-        'csv': 'text/csv',
-        'json': 'application/json',
-    }.get(format, 'application/octet-stream')
+    if batch.status != 'completed' or not batch.result_file:
+        return JsonResponse({'success': False, 'error': 'Batch result is not ready yet'}, status=409)
+
+    content_type = RESULT_CONTENT_TYPES[format]
+    filename = f'result_{batch.id}.{format}'
+    if format == batch.result_format:
+        stored = await sync_to_async(batch.result_file.get)()
+        # GridFS files are written once, so the file id is a strong validator
+        etag = f'"{stored._id}"'
+        if not batch.result_compressed:
+            return stream_file_response(request, stored, stored.length, etag, filename, content_type)
+        if _accepts_gzip(request):
+            return stream_file_response(request, stored, stored.length, etag, filename, content_type,
+                                        content_encoding='gzip')
+        etag = f'"{stored._id}-identity"'
+        if _etag_matches(request, etag):
+            return stream_file_response(request, None, 0, etag, None, content_type)
+        return streaming_download_response(request, _iter_gunzip(stored), etag, filename, content_type)
 
-    return FileResponse(BytesIO(file_bytes), as_attachment=True, filename=filename, content_type=content_type)
+    # Other formats are converted on the fly from the stored rows, never re-extracted
+    source = batch.rows_file if batch.rows_file else batch.result_file
+    etag = f'"{source.grid_id}-{format}"'
+    if _etag_matches(request, etag):
+        return stream_file_response(request, None, 0, etag, None, content_type)
+    chunks = _iter_encoded(iter_result_chunks(StoredRows(batch), format))
+    return streaming_download_response(request, chunks, etag, filename, content_type)
@@ -1,7 +1,6 @@
 import os
 from pathlib import Path
 from decouple import config
-from mongoengine import connect
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -75,8 +74,43 @@ TEMPLATES = [
 WSGI_APPLICATION = 'visionparse_admin.wsgi.application'
 
 # Database configuration
+# Registered by ParserConfig.ready; the client is created on the first query, in each worker process
 MONGO_URI = config('MONGO_URI', default='mongodb://localhost:27017/visionparse')
-connect(host=MONGO_URI)
+MONGO_DB = config('MONGO_DB', default='visionparse')  # when MONGO_URI names no database
+# Startup: warm up (database, indexes, URL and template loading) in the background as each worker starts,
+# and the longest /readyz/ waits for the database (seconds)
+WARM_UP_ON_START = config('WARM_UP_ON_START', default=True, cast=bool)
+READINESS_TIMEOUT = config('READINESS_TIMEOUT', default=2.0, cast=float)
+
+# Extraction pipeline
+# Max number of documents of one batch sent to Gemini at the same time (1 = sequential)
+GEMINI_CONCURRENCY = config('GEMINI_CONCURRENCY', default=4, cast=int)
+# Persistent cache of extraction results keyed by file hash + prompt + endpoint
+GEMINI_CACHE_ENABLED = config('GEMINI_CACHE_ENABLED', default=True, cast=bool)
+GEMINI_CACHE_TTL = config('GEMINI_CACHE_TTL', default=30 * 24 * 3600, cast=int)  # seconds, 0 = never expire
+GEMINI_CACHE_MAX_ENTRIES = config('GEMINI_CACHE_MAX_ENTRIES', default=10000, cast=int)  # 0 = unbounded
+GEMINI_CACHE_MAX_BYTES = config('GEMINI_CACHE_MAX_BYTES', default=256 * 1024 * 1024, cast=int)  # of results, 0 = unbounded
+# In-flight requests per batch when the worker runs with --async (one event loop, no thread per request)
+GEMINI_ASYNC_CONCURRENCY = config('GEMINI_ASYNC_CONCURRENCY', default=100, cast=int)
+# Pack several small documents into one Gemini request (falls back to one request each if the answer can't be split)
+GEMINI_PACK_DOCUMENTS = config('GEMINI_PACK_DOCUMENTS', default=False, cast=bool)
+GEMINI_PACK_MAX_BYTES = config('GEMINI_PACK_MAX_BYTES', default=4 * 1024 * 1024, cast=int)  # raw bytes per request
+GEMINI_PACK_MAX_DOCUMENTS = config('GEMINI_PACK_MAX_DOCUMENTS', default=8, cast=int)
+# Batch worker leases: heartbeat interval, silence after which a processing batch is re-claimed,
+# and claims per batch before it is marked failed (seconds / count)
+BATCH_HEARTBEAT_INTERVAL = config('BATCH_HEARTBEAT_INTERVAL', default=15.0, cast=float)
+BATCH_STALE_AFTER = config('BATCH_STALE_AFTER', default=120.0, cast=float)
+BATCH_MAX_ATTEMPTS = config('BATCH_MAX_ATTEMPTS', default=3, cast=int)
+# Store batch result files gzipped in GridFS (served as-is to clients that accept gzip)
+RESULT_FILE_GZIP = config('RESULT_FILE_GZIP', default=False, cast=bool)
+# ZIP/TAR uploads: PDF and image members taken from one archive, and the largest member accepted (bytes)
+ARCHIVE_MAX_MEMBERS = config('ARCHIVE_MAX_MEMBERS', default=10000, cast=int)
+ARCHIVE_MAX_MEMBER_SIZE = config('ARCHIVE_MAX_MEMBER_SIZE', default=100 * 1024 * 1024, cast=int)
+# Read ambiguous extracted dates such as 05/03/2024 as day/month (5 March) instead of month/day
+NORMALIZE_DAY_FIRST = config('NORMALIZE_DAY_FIRST', default=False, cast=bool)
+# Server-sent progress events (parser/events/<batch_id>/): database poll interval and keep-alive comment interval
+BATCH_EVENTS_POLL_INTERVAL = config('BATCH_EVENTS_POLL_INTERVAL', default=1.0, cast=float)
+BATCH_EVENTS_KEEPALIVE = config('BATCH_EVENTS_KEEPALIVE', default=15.0, cast=float)
 
 #fallback for mongoengine
 DATABASES = {
@@ -114,4 +148,25 @@ STATIC_URL = "/static/"
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
\ No newline at end of file
+# Sessions are stored in MongoDB (expired by a TTL index) and read through a per-process LRU:
+# how long a cached session is trusted (seconds, 0 = always read MongoDB) and how many are kept
+SESSION_ENGINE = config('SESSION_ENGINE', default='parser.session_backend')
+SESSION_CACHE_TTL = config('SESSION_CACHE_TTL', default=30.0, cast=float)
+SESSION_CACHE_MAX_ENTRIES = config('SESSION_CACHE_MAX_ENTRIES', default=10000, cast=int)
+
+# Structured (JSON lines) logging; extraction details are only logged at DEBUG
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'parser.log_formatters.JsonFormatter'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'json'},
+    },
+    'root': {'handlers': ['console'], 'level': 'WARNING'},
+    'loggers': {
+        'parser': {'handlers': ['console'], 'level': LOG_LEVEL, 'propagate': False},
+    },
+}